@@ -0,0 +1,91 @@
+'''
+Seeded generator of synthetic log files for the benchmarks.
+
+The same seed, shape, cardinality and size always give the same file, so that runs
+of the benchmarks on different versions of the scraper scan exactly the same data.
+'''
+
+from datetime import datetime, timedelta
+import gzip
+import random
+
+START = datetime(2015, 3, 1)
+
+METHODS = ['GET'] * 8 + ['POST'] * 2
+STATUSES = [200] * 90 + [301, 302, 304, 400, 403, 404, 404, 500, 502, 503]
+LEVELS = ['DEBUG'] * 4 + ['INFO'] * 10 + ['WARNING'] * 2 + ['ERROR']
+MODULES = ['auth', 'billing', 'cache', 'db', 'http', 'queue', 'search', 'storage']
+ACTIONS = ['login', 'logout', 'view', 'search', 'purchase', 'refund', 'upload', 'delete']
+
+def _access_line(rng, timestamp, user, path):
+    '''A line in the style of an HTTP access log'''
+    return '10.{}.{}.{} - {} [{}] "{} {} HTTP/1.1" {} {} latency={}\n'.format(
+        rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), user,
+        timestamp.strftime('%d/%b/%Y:%H:%M:%S'), rng.choice(METHODS), path,
+        rng.choice(STATUSES), rng.randint(200, 50000), int(rng.expovariate(1 / 40.0)))
+
+def _app_line(rng, timestamp, user, path):
+    '''A line in the style of an application log'''
+    return '{} {} [{}] user={} action={} path={} latency={}\n'.format(
+        timestamp.strftime('%Y-%m-%d %H:%M:%S,%f')[:-3], rng.choice(LEVELS),
+        rng.choice(MODULES), user, rng.choice(ACTIONS), path,
+        int(rng.expovariate(1 / 40.0)))
+
+LINE_SHAPES = {'access' : _access_line, 'app' : _app_line}
+
+# Regexes to run over each shape of line, roughly from the most to the least common in use.
+# The scraper matches from the start of each line, so they either follow the line's layout
+# from the start, or skip to what they're after with .*
+REGEXES = {'access' : [r'\S+ - \S+ \[[^\]]+\] "(?P<method>GET|POST) (?P<path>/\S*) HTTP',
+                       r'.*" (?P<status>5\d\d) ',
+                       r'\S+ - (?P<user>user\d+) \[',
+                       r'.*latency=(?P<latency>\d{3,})',
+                       r'.*"POST /api/\S+/(?P<resource>\w+)'],
+           'app' : [r'.*\] user=(?P<user>\S+) action=(?P<action>\w+)',
+                    r'\S+ \S+ (?P<level>ERROR|WARNING) \[(?P<module>\w+)\]',
+                    r'.*action=purchase path=(?P<path>\S+)',
+                    r'.*latency=(?P<latency>\d{3,})',
+                    r'\S+ \S+ \w+ \[db\] .* action=(?P<action>delete|refund)']}
+
+def make_regexes(shape, count):
+    '''
+    Returns count (name, pattern) pairs to run over lines of the given shape:
+    the shape's own regexes, then literal searches for more paths if count needs more.
+    '''
+    patterns = REGEXES[shape][:count]
+    patterns += [r'.*/api/v\d/item{}/'.format(index) for index in xrange(count - len(patterns))]
+    return [('regex{}'.format(index), pattern) for index, pattern in enumerate(patterns)]
+
+def generate_log(path, size, seed=0, shape='access', cardinality=1000, compress=False):
+    '''
+    Writes a log of about size (uncompressed) bytes to path, gzipped if compress is set.
+    cardinality is how many different users and paths there are, which is what
+    the named groups of the regexes capture. Users are skewed so that a few are
+    much more common than the rest, like they are in real logs.
+    Returns the (lines, bytes) written, before compression.
+    '''
+    rng = random.Random(seed)
+    make_line = LINE_SHAPES[shape]
+    users = ['user{}'.format(index) for index in xrange(cardinality)]
+    paths = ['/api/v{}/item{}/{}'.format(index % 3, index, rng.choice(ACTIONS))
+             for index in xrange(cardinality)]
+    timestamp = START
+    lines = 0
+    written = 0
+    log_file = gzip.open(path, 'wb') if compress else open(path, 'wb')
+    try:
+        batch = []
+        while written < size:
+            timestamp += timedelta(microseconds=rng.randint(0, 20000))
+            user = users[min(int(rng.paretovariate(1.2)) - 1, cardinality - 1)]
+            line = make_line(rng, timestamp, user, rng.choice(paths))
+            batch.append(line)
+            written += len(line)
+            lines += 1
+            if len(batch) >= 10000:
+                log_file.write(''.join(batch))
+                batch = []
+        log_file.write(''.join(batch))
+    finally:
+        log_file.close()
+    return lines, written
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the scraping pipeline, over synthetic logs from log_generator.
+
+Each scenario varies one thing from a baseline (the number of regexes, the number
+or size of the files, gzip, PROCESSOR_COUNT, ...), and is run in its own process so
+that its peak RSS (that of the scraper or of its biggest worker, whichever is bigger)
+is its own. Results are lines/s, MB/s (of uncompressed log) and peak RSS, along with
+the total hits of each regex (so that a run that matched nothing stands out), written as
+JSON so that runs can be compared, e.g.
+
+    python benchmarks/run_benchmarks.py --output before.json
+    (make changes)
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+The generated logs are kept in --data-dir (if given) and reused by later runs.
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_PATH, os.pardir, 'src'))
+
+from log_generator import generate_log, make_regexes
+from log_scraper.base import LogScraper
+import log_scraper.consts as LSC
+
+MB = 1024 * 1024
+
+BASELINE = {'regexes' : 5, 'files' : 4, 'file_size_mb' : 8, 'processors' : 4,
+            'compress' : False, 'shape' : 'access', 'cardinality' : 1000}
+
+# Name, and how the scenario differs from the baseline
+SCENARIOS = [('baseline', {}),
+             ('regexes_1', {'regexes' : 1}),
+             ('regexes_20', {'regexes' : 20}),
+             ('files_1', {'files' : 1}),
+             ('files_16', {'files' : 16, 'file_size_mb' : 2}),
+             ('file_size_32mb', {'files' : 1, 'file_size_mb' : 32}),
+             ('processors_1', {'processors' : 1}),
+             ('processors_8', {'processors' : 8}),
+             ('gzip', {'compress' : True}),
+             ('cardinality_100000', {'cardinality' : 100000}),
+             ('app_shape', {'shape' : 'app'})]
+
+def _dataset(data_dir, settings, scale, seed):
+    '''
+    Generates the files for settings in a directory of their own, unless they're already there.
+    Returns (glob of the files, lines, bytes).
+    '''
+    name = '{shape}_c{cardinality}_{files}x{file_size_mb}mb{gz}'.format(
+        gz='_gz' if settings['compress'] else '', **settings)
+    directory = os.path.join(data_dir, '{}_x{}_s{}'.format(name, scale, seed))
+    extension = '.log.gz' if settings['compress'] else '.log'
+    totals_path = os.path.join(directory, 'totals.json')
+    if not os.path.exists(totals_path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        lines = size = 0
+        for index in xrange(settings['files']):
+            file_lines, file_size = generate_log(
+                os.path.join(directory, 'log{}{}'.format(index, extension)),
+                int(settings['file_size_mb'] * scale * MB), seed=seed + index,
+                shape=settings['shape'], cardinality=settings['cardinality'],
+                compress=settings['compress'])
+            lines += file_lines
+            size += file_size
+        with open(totals_path, 'w') as totals_file:
+            json.dump({'lines' : lines, 'bytes' : size}, totals_file)
+    with open(totals_path) as totals_file:
+        totals = json.load(totals_file)
+    return os.path.join(directory, '*' + extension), totals['lines'], totals['bytes']
+
+def _peak_rss_kb():
+    '''Peak RSS of this process, or of its biggest finished child if that's bigger, in KB'''
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on OS X, and KB everywhere else
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def run_scenario(settings, file_glob, repeat):
+    '''
+    Scrapes the files repeat times with a fresh scraper each time.
+    Returns the wall and CPU seconds of the fastest run, the peak RSS of them all,
+    and the total hits of each regex.
+    '''
+    best = None
+    results = None
+    for _ in xrange(repeat):
+        start_wall, start_cpu = time.time(), os.times()
+        with LogScraper(optional_params={LSC.PROCESSOR_COUNT : settings['processors']},
+                        user_params={LSC.FILENAME : file_glob}) as log_scraper:
+            for name, pattern in make_regexes(settings['shape'], settings['regexes']):
+                log_scraper.add_regex(name=name, pattern=pattern)
+            results = log_scraper.get_log_data()
+        end_cpu = os.times()
+        wall = time.time() - start_wall
+        # Includes the CPU time of the workers, which have all been joined by now
+        cpu = sum(end_cpu[:4]) - sum(start_cpu[:4])
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+    hits = dict((name, regex_hits[LSC.TOTAL_HITS])
+                for name, regex_hits in results[LSC.REGEXES].items())
+    return {'wall_s' : best[0], 'cpu_s' : best[1], 'peak_rss_kb' : _peak_rss_kb(),
+            'hits' : sum(hits.values()), 'regex_hits' : hits}
+
+def _run_in_subprocess(name, args):
+    '''Runs the named scenario in a new process, and returns its results'''
+    command = [sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+               '--data-dir', args.data_dir, '--scale', str(args.scale),
+               '--seed', str(args.seed), '--repeat', str(args.repeat)]
+    # The scraper logs to stdout too, so the results are the last line
+    return json.loads(subprocess.check_output(command).splitlines()[-1])
+
+def _compare(results, baseline_path, out):
+    '''Prints how much faster or slower each scenario got since the baseline results'''
+    with open(baseline_path) as baseline_file:
+        baseline = dict((result['name'], result) for result in json.load(baseline_file)['results'])
+    out.write('{:<20} {:>14} {:>14} {:>8} {:>12}\n'.format(
+        'scenario', 'before lines/s', 'after lines/s', 'change', 'rss change'))
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        out.write('{:<20} {:>14.0f} {:>14.0f} {:>+7.1f}% {:>+11.1f}%\n'.format(
+            result['name'], before['lines_per_s'], result['lines_per_s'],
+            100.0 * (result['lines_per_s'] / before['lines_per_s'] - 1),
+            100.0 * (float(result['peak_rss_kb']) / before['peak_rss_kb'] - 1)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the log scraper on synthetic logs')
+    parser.add_argument('--scenarios', nargs='+', choices=[name for name, _ in SCENARIOS],
+                        help='Scenarios to run. Defaults to all of them')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplies the size of every file, e.g. 0.1 for a quick run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many times to run each scenario. The fastest run is kept')
+    parser.add_argument('--data-dir',
+                        help='Where to keep the generated logs. Defaults to a temporary directory')
+    parser.add_argument('--output', help='File to write the results to, instead of stdout')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    scenarios = dict(SCENARIOS)
+    if args.run_scenario:
+        settings = dict(BASELINE, **scenarios[args.run_scenario])
+        file_glob, _, _ = _dataset(args.data_dir, settings, args.scale, args.seed)
+        sys.stdout.write('\n' + json.dumps(run_scenario(settings, file_glob, args.repeat)) + '\n')
+        return
+
+    temporary = args.data_dir is None
+    if temporary:
+        args.data_dir = tempfile.mkdtemp(prefix='log_scraper_benchmarks')
+    try:
+        results = []
+        for name in args.scenarios or [name for name, _ in SCENARIOS]:
+            settings = dict(BASELINE, **scenarios[name])
+            _, lines, size = _dataset(args.data_dir, settings, args.scale, args.seed)
+            result = dict(settings, name=name, lines=lines, bytes=size)
+            result.update(_run_in_subprocess(name, args))
+            result['lines_per_s'] = lines / result['wall_s']
+            result['mb_per_s'] = float(size) / MB / result['wall_s']
+            sys.stderr.write('{name}: {lines_per_s:.0f} lines/s, {mb_per_s:.1f} MB/s, '
+                             'peak RSS {peak_rss_kb} KB, {hits} hits\n'.format(**result))
+            missed = sorted(name for name, hits in result['regex_hits'].items() if not hits)
+            if missed:
+                sys.stderr.write('  No hits for {}\n'.format(', '.join(missed)))
+            results.append(result)
+    finally:
+        if temporary:
+            shutil.rmtree(args.data_dir)
+
+    report = {'python' : platform.python_version(), 'platform' : platform.platform(),
+              'cpus' : os.sysconf('SC_NPROCESSORS_ONLN'), 'time' : time.time(),
+              'scale' : args.scale, 'seed' : args.seed, 'repeat' : args.repeat,
+              'results' : results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if args.compare:
+        _compare(results, args.compare, sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+'''
+Aggregations that can be kept in a scraper's results in place of plain dicts of counts.
+
+Each one is picklable, so that it can come back from the worker pool, and mergeable
+with +=, so that the results for chunks, files, days and boxes can be added up.
+copy() returns an independent copy, and empty() a new empty one set up the same way.
+'''
+
+from array import array
+from datetime import datetime
+import abc
+import calendar
+import hashlib
+import heapq
+import math
+import operator
+
+class Aggregator(object):
+    '''Base class for mergeable aggregations. Subclasses have to implement += and empty().'''
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def __iadd__(self, other):
+        raise NotImplementedError
+
+    def copy(self):
+        '''Returns an independent copy'''
+        merged = self.empty()
+        merged += self
+        return merged
+
+    @abc.abstractmethod
+    def empty(self):
+        '''Returns a new empty aggregator with the same settings'''
+        raise NotImplementedError
+
+
+class BucketedCounter(Aggregator):
+    '''
+    Counts of values per time bucket of bucket_size seconds.
+    Values are interned: values[i]'s count for each bucket is counts[i][bucket - origin],
+    in an array that covers every bucket from the first one seen to the last.
+    '''
+
+    TYPECODE = 'l'
+
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self.origin = None
+        self.length = 0
+        self.values = []
+        self.counts = []
+        self._ids = {}
+        self._last_timestamp = (None, None)
+
+    def __iadd__(self, other):
+        if other.bucket_size != self.bucket_size:
+            raise ValueError('Can\'t merge buckets of {}s into buckets of {}s'.format(
+                other.bucket_size, self.bucket_size))
+        if other.origin is None:
+            return self
+        self._cover(other.origin)
+        self._cover(other.origin + other.length - 1)
+        start = other.origin - self.origin
+        end = start + other.length
+        for value, other_counts in zip(other.values, other.counts):
+            counts = self.counts[self._intern(value)]
+            counts[start:end] = array(self.TYPECODE,
+                                      map(operator.add, counts[start:end], other_counts))
+        return self
+
+    def __repr__(self):
+        return 'BucketedCounter(bucket_size={}, values={}, buckets={})'.format(
+            self.bucket_size, len(self.values), self.length)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_last_timestamp'] = (None, None)
+        return state
+
+    def _bucket(self, timestamp):
+        '''Returns the bucket number for a datetime, or a number of seconds since the epoch'''
+        if timestamp == self._last_timestamp[0]:
+            return self._last_timestamp[1]
+        if isinstance(timestamp, datetime):
+            seconds = calendar.timegm(timestamp.utctimetuple())
+        else:
+            seconds = timestamp
+        bucket = int(seconds // self.bucket_size)
+        self._last_timestamp = (timestamp, bucket)
+        return bucket
+
+    def _cover(self, bucket):
+        '''Grows the arrays so that they cover bucket'''
+        if self.origin is None:
+            self.origin = bucket
+        if bucket < self.origin:
+            padding = array(self.TYPECODE, [0]) * (self.origin - bucket)
+            self.counts = [padding + counts for counts in self.counts]
+            self.length += self.origin - bucket
+            self.origin = bucket
+        elif bucket >= self.origin + self.length:
+            padding = array(self.TYPECODE, [0]) * (bucket - self.origin + 1 - self.length)
+            for counts in self.counts:
+                counts.extend(padding)
+            self.length = bucket - self.origin + 1
+
+    def _intern(self, value):
+        '''Returns the index of value, adding it if it's new'''
+        index = self._ids.get(value)
+        if index is None:
+            index = self._ids[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(array(self.TYPECODE, [0]) * self.length)
+        return index
+
+    def add(self, timestamp, value=None, count=1):
+        '''Counts value in the bucket timestamp falls in'''
+        bucket = self._bucket(timestamp)
+        if self.origin is None or not self.origin <= bucket < self.origin + self.length:
+            self._cover(bucket)
+        self.counts[self._intern(value)][bucket - self.origin] += count
+
+    def bucket_start(self, index):
+        '''Returns the (UTC) datetime that the index'th bucket starts at'''
+        return datetime.utcfromtimestamp((self.origin + index) * self.bucket_size)
+
+    def empty(self):
+        return BucketedCounter(self.bucket_size)
+
+    def series(self, value=None):
+        '''
+        Returns the counts for value as a time series:
+        a list of (bucket_start, count), with every bucket in the range, even empty ones.
+        '''
+        index = self._ids.get(value)
+        return [(self.bucket_start(bucket), 0 if index is None else self.counts[index][bucket])
+                for bucket in xrange(self.length)]
+
+    def to_dict(self):
+        '''Returns {value : {bucket_start : count}}, leaving out empty buckets'''
+        return dict((value, dict((self.bucket_start(bucket), count)
+                                 for bucket, count in enumerate(counts) if count))
+                    for value, counts in zip(self.values, self.counts))
+
+
+class QuantileSketch(Aggregator):
+    '''
+    Count, sum, min and max of numeric values, plus quantiles that are within
+    relative_accuracy of the true value (a DDSketch): values are counted in
+    logarithmically sized bins, so memory only grows with the range of the values,
+    and is capped at max_bins per sign by merging the bins nearest zero.
+    Values that aren't numbers are counted in invalid and otherwise ignored.
+    '''
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.count = 0
+        self.invalid = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.zeros = 0
+        self.positive = {}
+        self.negative = {}
+
+    def __iadd__(self, other):
+        if (other.relative_accuracy, other.max_bins) != (self.relative_accuracy, self.max_bins):
+            raise ValueError('Can\'t merge sketches with different settings')
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.count += other.count
+        self.invalid += other.invalid
+        self.sum += other.sum
+        self.zeros += other.zeros
+        for bins, other_bins in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            self._collapse(bins)
+        return self
+
+    def __repr__(self):
+        return 'QuantileSketch(relative_accuracy={}, max_bins={})'.format(
+            self.relative_accuracy, self.max_bins)
+
+    def __str__(self):
+        return ', '.join('{}: {}'.format(key, value)
+                         for key, value in sorted(self.summary().items()))
+
+    def _collapse(self, bins):
+        '''Merges the bins nearest zero until there are at most max_bins'''
+        if len(bins) <= self.max_bins:
+            return
+        indexes = sorted(bins)
+        extra = indexes[:len(indexes) - self.max_bins + 1]
+        bins[extra[-1]] = sum(bins.pop(index) for index in extra[:-1]) + bins[extra[-1]]
+
+    def _value(self, index):
+        '''Returns the value a bin stands for, the one its bounds are both closest to'''
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value):
+        '''Adds a value, which can be a number or a string of one'''
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            self.invalid += 1
+            return
+        if math.isnan(value) or math.isinf(value):
+            self.invalid += 1
+            return
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value == 0:
+            self.zeros += 1
+            return
+        bins = self.positive if value > 0 else self.negative
+        index = int(math.ceil(math.log(abs(value)) / self._log_gamma))
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def empty(self):
+        return QuantileSketch(self.relative_accuracy, self.max_bins)
+
+    def mean(self):
+        '''Returns the mean, or None if there are no values'''
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, quantile):
+        '''Returns the value at the given quantile (0 to 1), or None if there are no values'''
+        if not self.count:
+            return None
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self._value(index), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def summary(self):
+        '''Returns the count, sum, min, max, mean, p50, p95 and p99 as a dict'''
+        return {'count' : self.count, 'sum' : self.sum, 'min' : self.min, 'max' : self.max,
+                'mean' : self.mean(), 'p50' : self.quantile(0.5),
+                'p95' : self.quantile(0.95), 'p99' : self.quantile(0.99)}
+
+
+class TopK(Aggregator):
+    '''
+    Approximate counts of the most frequent values (Space-Saving), for groups with too many
+    distinct values to count them all. At most capacity values are tracked: a new value
+    takes over the least counted one's slot, starting from its count. So counts can only be
+    overestimated, by at most the error kept for each value, which is never more than
+    total / capacity. Any value seen more often than that is guaranteed to be tracked.
+    top() returns the k most frequent. capacity defaults to 10 * k.
+    '''
+
+    def __init__(self, k=100, capacity=None):
+        self.k = k
+        self.capacity = capacity or 10 * k
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # Min-heap of (count, value), one per tracked value. Counts only go up,
+        # so an entry can be out of date, but never above the value's real count.
+        self._heap = []
+
+    def __iadd__(self, other):
+        if (other.k, other.capacity) != (self.k, self.capacity):
+            raise ValueError('Can\'t merge top-k counts with different settings')
+        # A value one side isn't tracking could have been seen up to its minimum count times
+        own_floor, other_floor = self.min_count(), other.min_count()
+        counts = {}
+        errors = {}
+        for value in set(self.counts) | set(other.counts):
+            counts[value] = self.counts.get(value, own_floor) + \
+                other.counts.get(value, other_floor)
+            errors[value] = self.errors.get(value, own_floor) + \
+                other.errors.get(value, other_floor)
+        kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = dict((value, counts[value]) for value in kept)
+        self.errors = dict((value, errors[value]) for value in kept)
+        self.total += other.total
+        self._heap = [(count, value) for value, count in self.counts.iteritems()]
+        heapq.heapify(self._heap)
+        return self
+
+    def __repr__(self):
+        return 'TopK(k={}, capacity={})'.format(self.k, self.capacity)
+
+    def __str__(self):
+        return ', '.join('{}: {}'.format(value, count) for value, count, _ in self.top(10))
+
+    def _pop_min(self):
+        '''Removes the least counted value, and returns its count'''
+        while True:
+            count, value = heapq.heappop(self._heap)
+            if self.counts[value] == count:
+                del self.counts[value]
+                del self.errors[value]
+                return count
+            heapq.heappush(self._heap, (self.counts[value], value))
+
+    def add(self, value):
+        '''Counts a value'''
+        self.total += 1
+        if value in self.counts:
+            self.counts[value] += 1
+            return
+        floor = 0
+        if len(self.counts) >= self.capacity:
+            floor = self._pop_min()
+        self.counts[value] = floor + 1
+        self.errors[value] = floor
+        heapq.heappush(self._heap, (floor + 1, value))
+
+    def empty(self):
+        return TopK(self.k, self.capacity)
+
+    def min_count(self):
+        '''The most times a value that isn't being tracked could have been seen'''
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+
+    def top(self, k=None):
+        '''
+        Returns the k (defaults to the k it was made with) most frequent values as a list of
+        (value, count, error), most frequent first. The true count is within
+        [count - error, count].
+        '''
+        return [(value, self.counts[value], self.errors[value])
+                for value in heapq.nlargest(k or self.k, self.counts, key=self.counts.get)]
+
+
+class DistinctCount(Aggregator):
+    '''
+    Approximate count of distinct values (a HyperLogLog). Values are hashed (md5) into
+    2 ** precision registers of a byte each, so memory is fixed whatever the number of
+    values, and the estimate is typically within 1.04 / sqrt(2 ** precision) of the true
+    count: about 0.8% for the default precision of 14, in 16KB. precision can be 4 to 16.
+    Missing values (None, e.g. an optional group that didn't match) are counted in invalid
+    and otherwise ignored.
+    '''
+
+    HASH_BITS = 64
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision has to be between 4 and 16, not {}'.format(precision))
+        self.precision = precision
+        self.total = 0
+        self.invalid = 0
+        self.registers = bytearray(1 << precision)
+
+    def __iadd__(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Can\'t merge distinct counts with different precisions')
+        self.total += other.total
+        self.invalid += other.invalid
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def __repr__(self):
+        return 'DistinctCount(precision={})'.format(self.precision)
+
+    def __str__(self):
+        return '~{} distinct in {}'.format(self.estimate(), self.total)
+
+    def add(self, value):
+        '''Counts a value'''
+        if value is None:
+            self.invalid += 1
+            return
+        self.total += 1
+        hashed = int(hashlib.md5(str(value)).hexdigest()[:self.HASH_BITS // 4], 16)
+        register = hashed >> (self.HASH_BITS - self.precision)
+        # Position of the first 1 bit in the rest of the hash
+        rest = hashed & ((1 << (self.HASH_BITS - self.precision)) - 1)
+        rank = self.HASH_BITS - self.precision - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def empty(self):
+        return DistinctCount(self.precision)
+
+    def estimate(self):
+        '''Returns the estimated number of distinct values'''
+        size = len(self.registers)
+        alpha = {16 : 0.673, 32 : 0.697, 64 : 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        empty = self.registers.count('\x00')
+        # Linear counting is more accurate while lots of registers are still empty
+        if estimate <= 2.5 * size and empty:
+            estimate = size * math.log(float(size) / empty)
+        return int(round(estimate))
@@ -0,0 +1,70 @@
+'''
+A saved listing of an archive directory, so that finding a day's archived files
+doesn't mean listing a directory of hundreds of thousands of files every run.
+
+The listing is only redone when the directory's mtime changes, which it does
+whenever a file is added, removed or renamed in it. Names are indexed by the
+dates (YYYYMMDD) in them, so that a glob pattern for a given day only has to be
+checked against the names for that day.
+
+A directory changed within a second of it being listed might have changed again
+since without its mtime moving on, so that listing is redone next time round.
+'''
+
+import fnmatch
+import os
+import re
+import time
+
+DATE_TOKEN = re.compile(r'(?<!\d)\d{8}(?!\d)')
+# A date in a glob pattern that can only match a date token in a name,
+# i.e. one that no wildcard could run on into more digits
+PATTERN_DATE_TOKEN = re.compile(r'(?<![\d*?\]])\d{8}(?![\d*?\[])')
+
+# How close to the listing a change to the directory has to be for the listing not to be trusted
+MTIME_RESOLUTION = 1
+
+class ArchiveManifest(object):
+    '''The names in a directory as of its mtime, indexed by the dates in them'''
+
+    def __init__(self, directory, mtime, names, listed_at):
+        self.directory = directory
+        self.mtime = mtime
+        self.names = names
+        self.listed_at = listed_at
+        self.by_date = {}
+        for name in names:
+            for token in set(DATE_TOKEN.findall(name)):
+                self.by_date.setdefault(token, []).append(name)
+
+    @classmethod
+    def get(cls, directory, store):
+        '''
+        Returns the manifest for directory, loading it from store if it's still valid,
+        or listing the directory and saving it otherwise.
+        '''
+        directory = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime
+        manifest = store.get(directory)
+        if manifest is not None and manifest.is_fresh(mtime):
+            return manifest
+        listed_at = time.time()
+        manifest = cls(directory, mtime, os.listdir(directory), listed_at)
+        store.put(directory, manifest)
+        return manifest
+
+    def is_fresh(self, mtime):
+        '''Whether the listing is still good for the directory as of mtime'''
+        return mtime == self.mtime and mtime < self.listed_at - MTIME_RESOLUTION
+
+    def match(self, pattern):
+        '''
+        Returns the names in the directory that match the glob pattern, skipping
+        hidden ones like glob() does. Only the names with the pattern's date
+        in them are looked at, if it has one.
+        '''
+        tokens = PATTERN_DATE_TOKEN.findall(pattern)
+        names = self.by_date.get(tokens[0], []) if tokens else self.names
+        if not pattern.startswith('.'):
+            names = [name for name in names if not name.startswith('.')]
+        return fnmatch.filter(names, pattern)
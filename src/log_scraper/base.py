@@ -25,16 +25,25 @@ For usage examples, please see the unit-tests.
 '''
 
 from Crypto.pct_warnings import CryptoRuntimeWarning
-from datetime import date
-from glob import glob
+from datetime import date, datetime, timedelta
+from glob import glob, has_magic
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
+import atexit
 import collections
 import contextlib
 import copy_reg
 import gzip
+import hashlib
+import inspect
+import itertools
+import json
 import logging
+import mmap
 import os
+import pipes
+import Queue
 import re
 import socket
 import sys
@@ -43,6 +52,16 @@ import time
 import types
 import warnings
 import log_scraper.consts as LSC
+from log_scraper.aggregators import Aggregator, BucketedCounter
+from log_scraper.archive_manifest import ArchiveManifest
+from log_scraper.gzip_index import GzipIndex, gen_gzip_data
+from log_scraper import remote_scanner
+from log_scraper.ssh_pool import SSHConnectionPool
+from log_scraper.store import FileStore, locked
+from log_scraper.streams import SFTPReader, StreamReader, TimedReader
+from log_scraper.timestamp_index import TimestampIndex
+from log_scraper.matching import MatchRecorder, RegexDispatcher, RegexPlanner, is_line_bound, \
+                                 leading_literal, required_literals
 
 # C'est la vie...
 warnings.filterwarnings('ignore', category=CryptoRuntimeWarning)
@@ -53,6 +72,44 @@ _LOGGING_SETUP_LOCK = threading.Lock()
 
 TIMEOUT = 99999999
 
+# How much of the start and end of a local copy has to match the remote file
+# for the rest of the remote file to be fetched and appended to it
+DELTA_CHECK_SIZE = 4096
+DELTA_READ_SIZE = 1024 * 1024
+
+# Copies in TMP_PATH are written to <name>.part and renamed into place once complete,
+# and <name>.lock is locked while they're being checked and refreshed
+PART_SUFFIX = '.part'
+LOCK_SUFFIX = '.lock'
+
+# How long since a copy in TMP_PATH was last used before it can be evicted, in seconds,
+# so that copies another scraper has just prepared aren't deleted before it opens them
+TMP_EVICTION_GRACE = 60 * 60
+
+# SSH connections to remote boxes, shared by every scraper in the process.
+# Each scraper only closes the ones to the boxes it used; the rest are closed at exit
+SSH_POOL = SSHConnectionPool()
+atexit.register(SSH_POOL.close)
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# What DATE and END_DATE look like
+DATE_FORMAT = '%Y%m%d'
+
+# How much of a memory-mapped file each regex is run over in one go
+MMAP_BLOCK_SIZE = 32 * 1024 * 1024
+
+# How much of the start of a file is kept in its checkpoint to spot it being replaced
+CHECKPOINT_HEAD_SIZE = 1024
+
+# How far apart the restart points in a gzip index are when it's only needed for seeking
+# to time windows, rather than for splitting the file into chunks
+GZIP_SEEK_SPACING = 1024 * 1024
+
+# How many lines at the start of each file (or chunk) exclusive regexes are timed on,
+# to plan the order to run them in for the rest of it
+PLAN_SAMPLE_LINES = 1000
+
 class LogScraperException(Exception):
     '''Base LogScraper Exception class'''
     pass
@@ -75,15 +132,45 @@ class RegexObject(object):
     Also provides an easy way to get all the named groups from the regex,
     which you can then use for aggregation or what have you
     '''
-    def __init__(self, name=None, pattern=None):
+    def __init__(self, name=None, pattern=None, prefilter=True, bucket_size=None,
+                 group_aggregators=None, exclusive_group=None):
         '''
         Initialize the object.
-        Throws BadRegexException if the user gives a bad pattern.
+        prefilter - If True, lines that don't contain the literal text the pattern
+          requires are rejected with a plain substring test before the regex is run.
+          Set to False to always run the regex.
+        bucket_size - If given, hits are also counted per time bucket of this many seconds,
+          in total and for each value of each named group, under BUCKET_HITS.
+          Needs the scraper to be able to tell the time of each line (see TIMESTAMP_REGEX).
+        group_aggregators - Dict of named group to an Aggregator from the aggregators module,
+          to aggregate that group's values with instead of counting each one, e.g.
+          {'latency_ms' : QuantileSketch()} for the count, sum, min, max and quantiles,
+          {'user' : TopK(100)} for approximate counts of just the 100 most common users,
+          or {'user' : DistinctCount()} for an estimate of how many different users there are.
+        exclusive_group - Name of a set of regexes that never match the same line,
+          e.g. one per request method. Once one of the set has matched a line, the rest
+          aren't run on it, and the set is run in the order that's quickest going by how
+          they do on the first lines of each file (see RegexPlanner). Results are the same
+          as running every regex, so long as no line can really match two of the set.
+        Throws BadRegexException if the user gives a bad pattern, or aggregators for
+        groups it doesn't have.
         '''
         self.name = name
         self._pattern = pattern
+        self._bucket_size = bucket_size
+        self._exclusive_group = exclusive_group
         self._matcher = None
+        self._prefilter = prefilter
+        self._leading_literal = ''
+        self._required_literal = ''
+        self._block_matcher = None
         self._create_matcher()
+        self._group_aggregators = {}
+        for group, aggregator in (group_aggregators or {}).items():
+            if group not in self.get_groups():
+                raise BadRegexException('Pattern {} has no group named {} '
+                                        'to aggregate'.format(self._pattern, group))
+            self._group_aggregators[group] = aggregator.empty()
 
     def __repr__(self):
         return 'RegexObject(name={}, pattern={})'.format(self.name, self._pattern)
@@ -102,6 +189,55 @@ class RegexObject(object):
         except Exception:
             raise BadRegexException('Invalid pattern: {}. '
                                     'Could not create matcher'.format(self._pattern))
+        self._block_matcher = None
+        if is_line_bound(self._pattern):
+            self._block_matcher = re.compile('^(?:' + self._pattern + ')', re.MULTILINE)
+        self._leading_literal = ''
+        self._required_literal = ''
+        if self._prefilter:
+            self._leading_literal = leading_literal(self._pattern)
+            literals = required_literals(self._pattern)
+            if literals:
+                self._required_literal = literals[0]
+
+    def get_bucket_size(self):
+        '''Returns how many seconds each time bucket covers, or None if hits aren't bucketed'''
+        return self._bucket_size
+
+    def get_exclusive_group(self):
+        '''Returns the name of the set of mutually exclusive regexes this is in, if any'''
+        return self._exclusive_group
+
+    def get_block_matcher(self):
+        '''
+        Returns a MULTILINE version of the matcher, anchored at the start of each line,
+        for running finditer over a whole block of lines at once.
+        None if the pattern can match across line breaks, so can't be run that way.
+        '''
+        return self._block_matcher
+
+    def get_leading_literal(self):
+        '''
+        Returns the literal text every match of this regex starts with.
+        Empty if the pattern doesn't start with a literal or prefiltering is off.
+        '''
+        return self._leading_literal
+
+    def get_required_literal(self):
+        '''
+        Returns the longest literal text every match of this regex contains.
+        Empty if there is none or prefiltering is off.
+        '''
+        return self._required_literal
+
+    def match(self, line):
+        '''
+        Same as get_matcher().match(line), but skips running the regex
+        if the line doesn't contain the required literal.
+        '''
+        if self._required_literal and self._required_literal not in line:
+            return None
+        return self._matcher.match(line)
 
     def get_matcher(self):
         '''Returns the matcher object'''
@@ -123,6 +259,18 @@ class RegexObject(object):
         '''Returns a list of all named groups found in the regex'''
         return self._matcher.groupindex.keys()
 
+    def get_group_aggregator(self, group):
+        '''
+        Returns a new empty aggregator for the given group's values,
+        or None if each value is just counted
+        '''
+        aggregator = self._group_aggregators.get(group)
+        return None if aggregator is None else aggregator.empty()
+
+    def is_count_only(self):
+        '''Whether hits and group values are only counted, without buckets or aggregators'''
+        return not self._bucket_size and not self._group_aggregators
+
 
 def _pickle_method(method):
     '''
@@ -195,10 +343,60 @@ class LogScraper(object):
         self._init_optional_params(optional_params)
         self._validate_user_params()
 
+        self._timestamp_matcher = None
+        if self._optional_params[LSC.TIMESTAMP_REGEX]:
+            try:
+                self._timestamp_matcher = re.compile(self._optional_params[LSC.TIMESTAMP_REGEX])
+            except re.error as err:
+                raise BadRegexException('Bad timestamp regex {}: {}'.format(
+                    self._optional_params[LSC.TIMESTAMP_REGEX], err))
+        # The last timestamp parsed and what it was parsed from,
+        # since neighbouring lines tend to share the same one
+        self._last_timestamp = (None, None)
+
         self._regexes = []
         self._init_regexes()
 
         self._file_list = []
+        # Which box each file in the file list came from, for remote levels
+        self._file_hosts = {}
+        # Which day each file in the file list is for, when it was found by date
+        self._file_dates = {}
+        # The archive manifests loaded while finding files, by directory
+        self._archive_manifests = {}
+        # The result cache keys of the remote files for days before today, by where they're
+        # copied to, and the results that were found for them so that they weren't copied
+        self._remote_cache_keys = {}
+        self._remote_cached_results = {}
+        # The metrics for the current or last run, if INSTRUMENT is set
+        self._metrics = None
+        # The time spent reading compressed data for the file being scanned, if INSTRUMENT
+        # is set and it's gzipped, so that its decompression can be timed apart from it
+        self._compressed_read_time = None
+
+        # Started lazily on first use, and reused by every call until close()
+        self._pool = None
+        # The boxes this scraper has connected to, whose pooled connections close() closes
+        self._ssh_hosts = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        '''
+        The scraper gets pickled whenever one of its methods is sent to the pool.
+        The pool itself can't be pickled, and the workers have no use for it anyway.
+        '''
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        # Only the parent adds up the run's metrics
+        state['_metrics'] = None
+        # Nor do they need the cached results of the files they won't be scanning
+        state['_remote_cached_results'] = {}
+        return state
 
     def __repr__(self):
         return ('LogScraper(default_filename={}, default_filepath={}, '
@@ -218,65 +416,76 @@ class LogScraper(object):
 
 # public:
 
-    def add_regex(self, name, pattern):
+    def add_regex(self, name, pattern, prefilter=True, bucket_size=None, group_aggregators=None,
+                  exclusive_group=None):
         '''
         Add a regex to the list of regexes to run.
+        See RegexObject for what prefilter, bucket_size, group_aggregators
+        and exclusive_group do.
         Throws BadRegexException if the user gives a bad pattern.
         '''
-        self._regexes.append(RegexObject(name=name, pattern=pattern))
+        self._regexes.append(RegexObject(name=name, pattern=pattern, prefilter=prefilter,
+                                         bucket_size=bucket_size,
+                                         group_aggregators=group_aggregators,
+                                         exclusive_group=exclusive_group))
 
     def clear_regexes(self):
         '''Resets the list of regexes to run'''
         self._regexes = []
 
+    def close(self):
+        '''
+        Shuts down the scraper's worker pool, waiting for the workers to exit,
+        and closes the pooled SSH connections to the boxes it used, unless another
+        scraper has them checked out.
+        The scraper can still be used afterwards; a new pool is started when needed.
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        SSH_POOL.close(self._ssh_hosts)
+        self._ssh_hosts = set()
+
     def get_log_data(self):
         '''
         Main driver function for scraping logs.
         Returns the data as a dict
         '''
 
-        #Make sure there's some files to run on
-        self._file_list = self._get_file_list()
-        try:
-            self._validate_file_list()
-        except InvalidArgumentException as err:
-            LOGGER.error('InvalidArgumentException: %s', err)
-            return None
-
-        regex_hits = {}
-        regex_hits[LSC.REGEXES] = {}
-
-        for regex in self._regexes:
-            regex_hits[LSC.REGEXES][regex.name] = {}
-            regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS] = {}
-            for group in regex.get_groups():
-                regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS][group] = \
-                    collections.OrderedDict()
-
-        if self._user_params.get(LSC.DEBUG):
-            self._print_regex_patterns()
+        results = []
+        regex_hits = None
+        for result, regex_hits in self.iter_log_data():
+            results.append(result)
 
-        results = self._multiprocess_files(self._process_file_for_aggregates)
-
-        if results is None:
+        if regex_hits is None:
             return None
 
-        for result in results:
-            for regex_name, hits in result[LSC.REGEXES].items():
-                self._combine_hits(hits, regex_hits[LSC.REGEXES][regex_name])
+        # Files finish in whatever order, so put them back in file list order
+        self._sort_by_file_list(results)
 
-        #Sort the group data
-        for hits in regex_hits[LSC.REGEXES].values():
-            if LSC.GROUP_HITS in hits:
-                for group, group_hits in hits[LSC.GROUP_HITS].items():
-                    hits[LSC.GROUP_HITS][group] = \
-                        collections.OrderedDict(sorted(group_hits.iteritems()))
+        self._sort_group_hits(regex_hits)
 
         if len(results) > 1:
             regex_hits[LSC.FILE_HITS] = results
 
+        host_hits = self._sum_hits_by(results, self._file_hosts)
+        if len(host_hits) > 1:
+            regex_hits[LSC.HOST_HITS] = host_hits
+
+        day_hits = self._sum_hits_by(results, self._file_dates)
+        if len(day_hits) > 1:
+            regex_hits[LSC.DAY_HITS] = day_hits
+
         return regex_hits
 
+    def get_metrics(self):
+        '''
+        Returns the metrics for the last run (see LSC.METRICS),
+        or None if INSTRUMENT isn't set or nothing has been run yet
+        '''
+        return self._metrics
+
     def get_regexes(self):
         '''Returns the list of regexes stored'''
         return self._regexes
@@ -287,22 +496,86 @@ class LogScraper(object):
         '''
 
         #Make sure there's some files to run on
-        self._file_list = self._get_file_list()
         try:
+            self._validate_date_range()
+            self._file_list = self._get_file_list()
+            self._file_hosts = {}
             self._validate_file_list()
+            self._validate_timestamps()
         except InvalidArgumentException as err:
             LOGGER.error('InvalidArgumentException: %s', err)
             return None
 
         if self._user_params.get(LSC.DEBUG, None):
             self._print_regex_patterns()
-        matches = self._multiprocess_files(self._process_file_for_matches)
+        self._metrics = self._new_run_metrics()
+        if self._is_remote_scan():
+            matches = self._sort_by_file_list(list(self._scan_remote('matches'))) or None
+        else:
+            matches = self._multiprocess_files(self._process_file_for_matches)
+        for result in matches or []:
+            self._add_file_metrics(result)
+        self._finish_run_metrics()
         return matches
 
     def get_user_params(self):
         '''Getter for user_params'''
         return self._user_params
 
+    def iter_log_data(self):
+        '''
+        Streaming version of get_log_data.
+        Yields a (file_result, running_total) tuple as soon as each file is done,
+        in whatever order the files finish in.
+        running_total is the same dict every time, updated in place with each new file,
+        so copy it if you need a snapshot. Its group data is not sorted.
+        If INSTRUMENT is set, it gets the run's METRICS once every file is done.
+        Stopping early kills off the work still running for the remaining files.
+        Yields nothing if there are no files to run on.
+        '''
+
+        #Make sure there's some files to run on
+        try:
+            self._validate_date_range()
+            self._file_list = self._get_file_list()
+            self._file_hosts = {}
+            self._validate_file_list()
+            self._validate_timestamps()
+        except InvalidArgumentException as err:
+            LOGGER.error('InvalidArgumentException: %s', err)
+            return
+
+        regex_hits = {}
+        regex_hits[LSC.REGEXES] = {}
+
+        for regex in self._regexes:
+            regex_hits[LSC.REGEXES][regex.name] = {}
+            regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS] = {}
+            for group in regex.get_groups():
+                regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS][group] = \
+                    regex.get_group_aggregator(group) or collections.OrderedDict()
+
+        if self._user_params.get(LSC.DEBUG):
+            self._print_regex_patterns()
+
+        self._metrics = self._new_run_metrics()
+        if self._is_remote_scan():
+            results = self._scan_remote('aggregates')
+        else:
+            results = self._imap_files(self._process_file_for_aggregates,
+                                       chunk_func=self._process_chunk_for_aggregates)
+        for result in results:
+            started = time.time()
+            for regex_name, hits in result[LSC.REGEXES].items():
+                self._combine_hits(hits, regex_hits[LSC.REGEXES][regex_name])
+            self._add_file_metrics(result)
+            self._add_run_time(LSC.MERGE_TIME, started)
+            yield result, regex_hits
+
+        if self._metrics is not None:
+            regex_hits[LSC.METRICS] = self._metrics
+            self._finish_run_metrics()
+
     def print_stats_per_file(self, regex_hits, out=sys.stdout):
         '''Prints stats for each file separately'''
         if regex_hits is None:
@@ -403,6 +676,97 @@ class LogScraper(object):
         Call this in your derived class constructor.'''
         pass
 
+    def _extract_timestamp(self, line):
+        '''
+        Returns the timestamp of the given line, or None if it doesn't have one.
+        By default, TIMESTAMP_REGEX is matched at the start of the line and its
+        'timestamp' group (or the whole match, if there isn't one) is parsed with
+        TIMESTAMP_FORMAT. Override if your logs need something smarter.
+        Whatever gets returned has to compare in time order with START_TIME and END_TIME.
+        '''
+        if self._timestamp_matcher is None:
+            return None
+        match = self._timestamp_matcher.match(line)
+        if match is None:
+            return None
+        if 'timestamp' in self._timestamp_matcher.groupindex:
+            raw = match.group('timestamp')
+        else:
+            raw = match.group(0)
+        if raw == self._last_timestamp[0]:
+            return self._last_timestamp[1]
+        timestamp = self._parse_timestamp(raw)
+        self._last_timestamp = (raw, timestamp)
+        return timestamp
+
+    def _emit_metrics(self, metrics):
+        '''
+        Called with the metrics (see LSC.METRICS) at the end of each run, if INSTRUMENT is set.
+        Only logs a summary of them by default. Override to forward them to your own telemetry.
+        '''
+        LOGGER.debug('Scanned %d files in %.3fs, copying for %.3fs and merging for %.3fs',
+                     len(metrics[LSC.FILE_HITS]), metrics[LSC.WALL_TIME],
+                     metrics[LSC.COPY_TIME], metrics[LSC.MERGE_TIME])
+
+    def _add_compressed_read_time(self, seconds):
+        '''Adds to the time spent reading compressed data for the file being scanned'''
+        self._compressed_read_time += seconds
+
+    def _add_file_metrics(self, result):
+        '''Adds a file's metrics to the run's, if it has any'''
+        if self._metrics is None or LSC.METRICS not in result:
+            return
+        self._metrics[LSC.FILE_HITS][result[LSC.FILENAME]] = result[LSC.METRICS]
+        self._combine_hits(result[LSC.METRICS][LSC.REGEXES], self._metrics[LSC.REGEXES])
+
+    def _add_run_time(self, key, started):
+        '''Adds the time since started to the run's metrics under key, if INSTRUMENT is set'''
+        if self._metrics is not None:
+            self._metrics[key] += time.time() - started
+
+    @classmethod
+    def _append_remote_file(cls, sftp, filepath, local_file):
+        '''
+        Brings local_file up to date with the remote filepath by fetching only
+        the bytes past its end, if the remote file still starts with local_file's
+        contents (going by its first and last few KB). If the remote file hasn't grown,
+        local_file's mtime is still brought up to date, so that it counts as a fresh copy.
+        Returns False without touching local_file if it doesn't,
+        e.g. because the remote file was rotated or truncated.
+        '''
+        if not os.path.exists(local_file):
+            return False
+        local_size = os.path.getsize(local_file)
+        remote_size = sftp.stat(filepath).st_size
+        if local_size == 0 or remote_size < local_size:
+            return False
+
+        check_size = min(local_size, DELTA_CHECK_SIZE)
+        with open(local_file, 'rb') as local:
+            head = local.read(check_size)
+            local.seek(local_size - check_size)
+            tail = local.read(check_size)
+
+        with contextlib.closing(sftp.open(filepath, 'rb')) as remote:
+            if remote.read(check_size) != head:
+                return False
+            remote.seek(local_size - check_size)
+            if remote.read(check_size) != tail:
+                return False
+            if remote_size == local_size:
+                os.utime(local_file, None)
+                return True
+
+            remote.prefetch(remote_size)
+            with open(local_file, 'ab') as local:
+                while True:
+                    data = remote.read(DELTA_READ_SIZE)
+                    if not data:
+                        break
+                    local.write(data)
+        LOGGER.debug('Fetched the last %d bytes of %s', remote_size - local_size, filepath)
+        return True
+
     def _are_logs_archived(self, log_date):
         '''
         Returns whether logs are on netapp or on local box.
@@ -421,6 +785,89 @@ class LogScraper(object):
 
         return False
 
+    def _aggregate_lines(self, lines, regex_hits):
+        '''
+        Runs the regexes over each line and aggregates the hits into regex_hits.
+        Only the regexes whose leading literal fits the line are actually run.
+        If any regexes are exclusive, the first PLAN_SAMPLE_LINES lines are run as usual
+        while timing each regex, and the rest in the order the RegexPlanner makes of that.
+        '''
+        dispatcher = RegexDispatcher(self._regexes)
+        if all(regex.get_exclusive_group() is None for regex in self._regexes):
+            self._run_regexes(lines, dispatcher, regex_hits)
+            return
+
+        lines = iter(lines)
+        planner = RegexPlanner(self._regexes)
+        self._run_regexes(itertools.islice(lines, PLAN_SAMPLE_LINES), dispatcher, regex_hits,
+                          planner=planner)
+        if planner.get_overlapping_groups():
+            LOGGER.warning('Regexes in %s matched the same line, so aren\'t exclusive',
+                           ', '.join(planner.get_overlapping_groups()))
+        order, exclusive = planner.plan()
+        self._run_regexes(lines, RegexDispatcher(order), regex_hits, exclusive=exclusive)
+
+    def _block_scan(self, log_file, start=0, end=None):
+        '''
+        Generator that memory-maps the uncompressed log_file and yields
+        (buffer, block_start, block_end) for line-aligned blocks covering the
+        lines that start in [start, end). Only for use with block matchers,
+        which have to skip any match that starts right at block_end.
+        '''
+        with open(log_file, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            if end is None or end > size:
+                end = size
+            if start >= end:
+                return
+            buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            with contextlib.closing(buf):
+                start = self._find_line_start(buf, start)
+                end = self._find_line_start(buf, end)
+                while start < end:
+                    block_end = min(start + MMAP_BLOCK_SIZE, end)
+                    if block_end < end:
+                        block_end = buf.rfind('\n', start, block_end) + 1 or \
+                            self._find_line_start(buf, block_end)
+                    yield buf, start, block_end
+                    start = block_end
+
+    def _block_scan_for_aggregates(self, log_file, regex_hits, start=0, end=None):
+        '''
+        Aggregates the hits for the lines of log_file that start in [start, end)
+        into regex_hits, running each regex over big blocks of the memory-mapped file.
+        '''
+        metrics = regex_hits.get(LSC.METRICS)
+        for buf, block_start, block_end in self._block_scan(log_file, start, end):
+            lines = self._count_block_lines(buf, block_start, block_end, metrics)
+            for regex in self._regexes:
+                hits = regex_hits[LSC.REGEXES][regex.name]
+                started, hits_before = time.time(), hits[LSC.TOTAL_HITS]
+                for match in regex.get_block_matcher().finditer(buf, block_start, block_end):
+                    if match.start() == block_end:
+                        continue
+                    hits[LSC.TOTAL_HITS] += 1
+                    for agg_key, agg_dict in hits[LSC.GROUP_HITS].items():
+                        self._sum_group_matches(agg_dict, match, agg_key)
+                if metrics is not None:
+                    self._count_evaluations(metrics, regex, hits[LSC.TOTAL_HITS] - hits_before,
+                                            time.time() - started, lines)
+
+    def _bucket_line(self, line, match, bucket_hits):
+        '''
+        Counts a line in the time bucket it was logged in, in total and for each
+        of the named groups of the regex's match on it. Lines without a timestamp
+        aren't bucketed.
+        '''
+        timestamp = self._extract_timestamp(line)
+        if timestamp is None:
+            return
+        for group, counter in bucket_hits.items():
+            if group == LSC.TOTAL_HITS:
+                counter.add(timestamp)
+            else:
+                counter.add(timestamp, match.group(group))
+
     @classmethod
     def _calc_stats(cls, items):
         '''Calculates the min, max and average items processed per key'''
@@ -455,38 +902,312 @@ class LogScraper(object):
 
         for group, hits in match_groups.items():
             if isinstance(hits, collections.Mapping):
-                cls._combine_hits(match_groups[group], combining_dict[group])
+                cls._combine_hits(match_groups[group], combining_dict.setdefault(group, {}))
             else:
                 if combining_dict.get(group, None):
                     combining_dict[group] += hits
+                elif isinstance(hits, Aggregator):
+                    # Copied, as merging into it later would change the result it came from
+                    combining_dict[group] = hits.copy()
                 else:
                     combining_dict[group] = hits
 
+    def _copy_remote_file(self, filepath, local_file, box):
+        '''
+        Copies filepath to local_file over the pooled SSH connection to box.
+        If local_file is an older copy of filepath, only what's been appended since is fetched.
+        The copy is made in a .part file that's only renamed to local_file once it's complete,
+        so a crash never leaves a truncated local_file behind. The next copy picks up
+        from whatever made it into the .part file.
+        Throws IOError if the copy fails.
+        '''
+        part_file = local_file + PART_SUFFIX
+        with self._ssh_connection(box) as conn:
+            if conn is None:
+                raise IOError('Could not connect to {}'.format(box))
+            if os.path.exists(local_file):
+                os.rename(local_file, part_file)
+            #Temporarily copy file to current box.
+            #This is being done because reading the file over SSH
+            #slows everything down insanely.
+            if not self._append_remote_file(conn.sftp(), filepath, part_file):
+                conn.sftp().get(filepath, part_file)
+            os.rename(part_file, local_file)
+
     @classmethod
-    def _copy_remote_file(cls, filepath, local_file, box):
-        '''Creates an SSH connection and copies filepath to local_file'''
-        ssh = cls._open_ssh_connection(box)
-        if ssh is None:
-            return ''
-        with contextlib.closing(ssh):
-            with contextlib.closing(ssh.open_sftp()) as sftp:
-                #Temporarily copy file to current box.
-                #This is being done because reading the file over SSH
-                #slows everything down insanely.
-                sftp.get(filepath, local_file)
+    def _count_block_lines(cls, buf, block_start, block_end, metrics):
+        '''
+        Adds the lines and bytes in a block to metrics, if there are any, and returns
+        how many lines there were, which is how many times each regex was run on.
+        '''
+        if metrics is None:
+            return 0
+        lines = buf[block_start:block_end].count('\n')
+        metrics[LSC.LINES_READ] += lines
+        metrics[LSC.BYTES_READ] += block_end - block_start
+        return lines
+
+    @classmethod
+    def _count_evaluations(cls, metrics, regex, hits, elapsed, evaluations=1):
+        '''Adds evaluations of regex, hits of them and the time they took to metrics'''
+        regex_metrics = metrics[LSC.REGEXES][regex.name]
+        regex_metrics[LSC.EVALUATIONS] += evaluations
+        regex_metrics[LSC.TOTAL_HITS] += hits
+        regex_metrics[LSC.MATCH_TIME] += elapsed
+
+    def _evict_tmp_files(self):
+        '''
+        Deletes the least recently used copies in TMP_PATH until they fit in TMP_CACHE_SIZE,
+        leaving alone the ones in the file list, any being copied right now and any used
+        in the last TMP_EVICTION_GRACE seconds (which another scraper may be about to scan).
+        Only files with a lock file next to them are considered copies. The .part files
+        that crashed copies left behind count too. Lock files are never deleted, since
+        another process could be waiting on one.
+        '''
+        budget = self._optional_params[LSC.TMP_CACHE_SIZE]
+        if budget <= 0:
+            return
+
+        tmp_path = self._optional_params[LSC.TMP_PATH]
+        copies = []
+        for name in os.listdir(tmp_path):
+            path = os.path.join(tmp_path, name)
+            # The copy a file belongs to, which is what the lock file is named after
+            copy = path[:-len(PART_SUFFIX)] if name.endswith(PART_SUFFIX) else path
+            if name.endswith(LOCK_SUFFIX) or not os.path.exists(copy + LOCK_SUFFIX):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            copies.append((stat.st_atime, stat.st_size, path, copy))
+
+        total_size = sum(size for _, size, _, _ in copies)
+        in_use = set(os.path.abspath(log_file) for log_file in self._file_list)
+        for atime, size, path, copy in sorted(copies):
+            if total_size <= budget:
+                break
+            if os.path.abspath(copy) in in_use or atime > time.time() - TMP_EVICTION_GRACE:
+                continue
+            with locked(copy + LOCK_SUFFIX, blocking=False) as is_locked:
+                if not is_locked:
+                    continue
+                # It could have been refreshed or used since it was listed
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    total_size -= size
+                    continue
+                if stat.st_atime > time.time() - TMP_EVICTION_GRACE:
+                    continue
+                LOGGER.debug('Evicting %s from %s', os.path.basename(path), tmp_path)
+                os.remove(path)
+                total_size -= stat.st_size
+        if total_size > budget:
+            LOGGER.warning('Copies in %s take up %d bytes, over the budget of %d',
+                           tmp_path, total_size, budget)
+
+    @classmethod
+    def _find_last_line_end(cls, log_file, size):
+        '''Returns the offset just past the last newline in the first size bytes of log_file'''
+        with open(log_file, 'rb') as handle:
+            position = size
+            while position > 0:
+                block_start = max(0, position - 64 * 1024)
+                handle.seek(block_start)
+                newline = handle.read(position - block_start).rfind('\n')
+                if newline != -1:
+                    return block_start + newline + 1
+                position = block_start
+        return 0
+
+    @classmethod
+    def _find_line_start(cls, buf, position):
+        '''Returns the offset of the first line in buf that starts at or after position'''
+        if position <= 0:
+            return 0
+        if position >= len(buf):
+            return len(buf)
+        newline = buf.find('\n', position - 1)
+        return len(buf) if newline == -1 else newline + 1
+
+    def _filter_time_window(self, lines):
+        '''
+        Generator that passes on the lines whose timestamps are in the time window,
+        or all of them if there isn't one. Lines without a timestamp (e.g. stack traces)
+        go with the line before them, and are dropped if that isn't known.
+        '''
+        window = self._get_time_window()
+        if window is None:
+            for line in lines:
+                yield line
+            return
+
+        start, end = window
+        current = None
+        for line in lines:
+            timestamp = self._extract_timestamp(line)
+            if timestamp is not None:
+                current = timestamp
+            if current is None:
+                continue
+            if (start is None or current >= start) and (end is None or current < end):
+                yield line
+
+    def _finish_file_result(self, log_file, result, checkpoint=None, cache_key=None):
+        '''
+        Wraps up the merged result for a file scanned in chunks: saves it in the
+        file's checkpoint and in the result cache if it should be, and sorts the group data.
+        '''
+        if result is None:
+            result = self._new_file_hits(log_file)
+        # The metrics are for this run's scan only
+        metrics = result.pop(LSC.METRICS, None)
+        if checkpoint is not None:
+            checkpoint['result'] = result
+            self._get_checkpoint_store().put(checkpoint['path'], checkpoint)
+        if cache_key is not None:
+            self._get_result_cache().put(cache_key, result)
+        if metrics is not None:
+            result[LSC.METRICS] = metrics
+        self._sort_group_hits(result)
+        return result
+
+    def _finish_run_metrics(self):
+        '''Wraps up the run's metrics, if INSTRUMENT is set, and passes them to _emit_metrics'''
+        if self._metrics is None:
+            return
+        self._metrics[LSC.WALL_TIME] = time.time() - self._metrics[LSC.WALL_TIME]
+        self._emit_metrics(self._metrics)
 
     def _gen_lines(self, filename):
-        '''Generator that yields one line at a time from a file'''
-        with self._get_file_handle(filename) as handle:
-            for line in handle:
+        '''
+        Generator that yields one line at a time from a file.
+        If there's a time window, only the lines in it are yielded,
+        and only the part of the file they're in is read, if it's indexed.
+        '''
+        if self._get_time_window() is not None:
+            start, end = self._get_time_range(filename)
+            if end is not None:
+                for line in self._gen_lines_in_range(filename, start, end):
+                    yield line
+                return
+
+        with self._open_log_file(filename) as handle:
+            for line in self._filter_time_window(handle):
+                yield line
+
+    def _gen_lines_in_range(self, filename, start, end):
+        '''
+        Generator that yields every line of a file that starts at
+        an (uncompressed) byte offset in [start, end).
+        The line straddling start belongs to the previous range,
+        and the last line yielded may run past end, so ranges that
+        cover a file between them yield each line exactly once.
+        Gzipped files are read through their index.
+        If there's a time window, only the lines in it are yielded, and lines
+        without a timestamp belong to the range the line before them is in.
+        '''
+        if self._is_gzip_file(filename):
+            handle = self._get_gzip_index(filename).open_at(
+                start, self._time_compressed_reads(open(filename, 'rb')))
+            if handle.prev_char not in ('', '\n'):
+                handle.readline()
+        else:
+            handle = open(filename, 'rb')
+            if start > 0:
+                handle.seek(start - 1)
+                handle.readline()
+
+        with handle:
+            lines = self._gen_lines_until(handle, end)
+            if self._get_time_window() is not None:
+                # Lines without a timestamp go with the line before them, so they're
+                # left to this range rather than to the one that starts in them
+                lines = itertools.chain(lines, self._gen_untimed_lines(handle))
+            for line in self._filter_time_window(lines):
+                yield line
+
+    @classmethod
+    def _gen_lines_until(cls, handle, end):
+        '''Generator that yields the lines from handle that start before the offset end'''
+        position = handle.tell()
+        while position < end:
+            line = handle.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+    @classmethod
+    def _gen_timed_lines(cls, lines, metrics):
+        '''
+        Generator that yields lines, adding how many there were,
+        their size and how long reading them took to metrics
+        '''
+        lines = iter(lines)
+        count = size = 0
+        read_time = 0.0
+        try:
+            while True:
+                started = time.time()
+                line = next(lines, None)
+                read_time += time.time() - started
+                if line is None:
+                    return
+                count += 1
+                size += len(line)
                 yield line
+        finally:
+            metrics[LSC.LINES_READ] += count
+            metrics[LSC.BYTES_READ] += size
+            metrics[LSC.READ_TIME] += read_time
+
+    def _gen_untimed_lines(self, handle):
+        '''Generator that yields the lines from handle up to the next one with a timestamp'''
+        for line in iter(handle.readline, ''):
+            if self._extract_timestamp(line) is not None:
+                return
+            yield line
 
     def _get_box_from_level(self, level):
         '''Returns the mapped box name for the given production level'''
         return self._optional_params[LSC.LEVELS_TO_BOXES].get(level, None)
 
+    def _get_boxes_from_level(self, level):
+        '''Returns the list of boxes the given production level maps to'''
+        boxes = self._get_box_from_level(level)
+        if boxes is None:
+            return []
+        if isinstance(boxes, basestring):
+            return [boxes]
+        return list(boxes)
+
+    def _get_checkpoint_store(self):
+        '''Returns the store that incremental mode keeps its per-file checkpoints in'''
+        return FileStore(self._optional_params[LSC.CHECKPOINT_PATH])
+
+    @classmethod
+    def _get_cpu_time(cls):
+        '''Returns the user and system CPU time this process has used so far'''
+        return sum(os.times()[:2])
+
+    def _get_dates(self):
+        '''
+        Returns the days to look for files on: every day from DATE to END_DATE,
+        just DATE if there's no END_DATE, or [None] if there's no DATE either.
+        '''
+        log_date = self._user_params.get(LSC.DATE, None)
+        end_date = self._user_params.get(LSC.END_DATE, None)
+        if log_date is None or end_date is None:
+            return [log_date]
+        start = datetime.strptime(log_date, DATE_FORMAT).date()
+        end = datetime.strptime(end_date, DATE_FORMAT).date()
+        return [(start + timedelta(days=day)).strftime(DATE_FORMAT)
+                for day in xrange((end - start).days + 1)]
+
     @classmethod
-    def _get_file_handle(cls, log_file):
+    def _get_file_handle(cls, log_file, remote_handle=None, wrap_compressed=None):
         '''
         Returns a handle connected to the given file.
         Needed because it grabs over ssh if needed,
@@ -494,13 +1215,25 @@ class LogScraper(object):
         in which case, some fancy stuff is needed to open it properly.
         The first two characters of the header are inspected to see
         whether the file is a gzipped file or plaintext.
+        remote_handle, if given, is an open handle on the remote file being streamed
+        (see STREAM_REMOTE), which is read instead of opening log_file locally.
+        wrap_compressed, if given, is called with the handle a gzipped file's compressed
+        data is read through, and returns the handle to read it through instead.
         '''
         LOGGER.info('Opening file %s', log_file)
+        if wrap_compressed is None:
+            wrap_compressed = lambda handle: handle
+
+        if remote_handle is not None:
+            if remote_handle.peek(2) == GZIP_MAGIC:
+                return StreamReader(gen_gzip_data(wrap_compressed(remote_handle)),
+                                    on_close=remote_handle.close)
+            return remote_handle
 
         handle = open(log_file, 'rb')
-        if handle.read(2) == '\x1f\x8b':
+        if handle.read(2) == GZIP_MAGIC:
             handle.seek(0)
-            handle = gzip.GzipFile(fileobj=handle)
+            handle = gzip.GzipFile(fileobj=wrap_compressed(handle))
         else:
             handle.seek(0)
         return handle
@@ -508,47 +1241,60 @@ class LogScraper(object):
     def _get_file_list(self):
         '''Checks the default filename or wildcard search and the prod level set,
            and returns a list of all files found on the relevant box at the
-           given path. If no level value is given, looks on current box'''
+           given path. If no level value is given, looks on current box.
+           With a date range, the files for every day in it are found,
+           each on whichever box or archive it lives in for that day.'''
 
         file_list = list()
         level = self._user_params.get(LSC.LEVEL, None)
-        log_date = self._user_params.get(LSC.DATE, None)
         filename = self._user_params.get(LSC.FILENAME, None)
+        self._file_dates = {}
+        self._archive_manifests = {}
 
-        if (level is not None
-                and not self._are_logs_archived(log_date)):
-            if (self._optional_params.get(LSC.FORCE_COPY, False)
-                    or socket.gethostname() != self._get_box_from_level(level)):
-                ssh = self._open_ssh_connection(self._get_box_from_level(level))
-                if ssh is None:
-                    return file_list
-                with contextlib.closing(ssh):
-                    with contextlib.closing(ssh.open_sftp()) as sftp:
-                        filename_regex = \
-                            self._make_file_name(self._optional_params[LSC.FILENAME_REGEX],
-                                                 log_date, level)
-
-                        files = sftp.listdir(self._default_path)
-                        for name in files:
-                            match = re.match(filename_regex, str(name))
-                            if match is not None:
-                                file_list.append(os.path.join(self._default_path, match.group()))
-                        sftp.close()
-                        ssh.close()
-                        return file_list
-
-        #By default, let's look at the default_filepath
-        if filename is None:
-            filename = self._make_file_path()
-            file_list = glob(filename)
-
-        else:
+        if filename is not None and not self._is_remote():
             files = filename.split(',')
             for file_iter in files:
                 file_list += glob(file_iter)
-        file_list = sorted([f for f in file_list if os.path.isfile(f)])
+            return sorted([f for f in file_list if os.path.isfile(f)])
 
-        return file_list
+        dates = self._get_dates()
+        boxes = self._get_boxes_from_level(level) if level is not None else []
+        remote_days = [(box, log_date) for log_date in dates if self._is_remote_day(log_date)
+                       for box in boxes]
+        listings = self._map_on_threads(lambda pair: self._list_remote_files(*pair), remote_days)
+        for (_, log_date), box_files in zip(remote_days, listings):
+            self._file_dates.update((box_file, log_date) for box_file in box_files)
+            file_list += box_files
+
+        #By default, let's look at the default_filepath
+        for log_date in dates:
+            if self._is_remote_day(log_date):
+                continue
+            if len(boxes) > 1:
+                day_files = []
+                for box in boxes:
+                    day_files += self._glob(self._make_file_path(box, log_date))
+            else:
+                day_files = self._glob(self._make_file_path(log_date=log_date))
+            day_files = [f for f in day_files if os.path.isfile(f)]
+            self._file_dates.update((day_file, log_date) for day_file in day_files)
+            file_list += day_files
+
+        return sorted(file_list)
+
+    def _get_gzip_index(self, log_file):
+        '''Returns the random-access index for the gzipped log_file, building it if needed'''
+        return GzipIndex.get(log_file, self._optional_params[LSC.GZIP_INDEX_PATH],
+                             self._optional_params[LSC.CHUNK_SIZE] or GZIP_SEEK_SPACING)
+
+    def _get_local_copy_path(self, remote_path):
+        '''Returns where the box:path remote file is copied to in TMP_PATH'''
+        level = self._user_params.get(LSC.LEVEL, None)
+        box, path = self._split_remote_path(remote_path)
+        name_parts = [level, os.path.split(path)[1]]
+        if len(self._get_boxes_from_level(level)) > 1:
+            name_parts.insert(1, box)
+        return os.path.join(self._optional_params[LSC.TMP_PATH], '_'.join(name_parts))
 
     def _get_log_file(self, log_file):
         '''
@@ -558,58 +1304,466 @@ class LogScraper(object):
         local_copy_lifetime_in_hours,
         which is an int value specifying how many hours before we recopy.
         '''
-        level = self._user_params.get(LSC.LEVEL, None)
         debug = self._user_params.get(LSC.DEBUG, None)
 
-        remote_file = os.path.split(log_file)[1]
-        local_filepath = os.path.join(self._optional_params[LSC.TMP_PATH],
-                                      '_'.join([level, remote_file]))
-
-        mtime = 0
-        if os.path.exists(local_filepath):
-            mtime = os.path.getmtime(local_filepath)
+        local_filepath = self._get_local_copy_path(log_file)
+        box, log_file = self._split_remote_path(log_file)
 
         try:
-            now = time.time()
-            max_time_before_recopy = now - self._optional_params[LSC.LOCAL_COPY_LIFETIME]*60*60
-
-            if mtime < max_time_before_recopy:
+            # Another scraper on this box could be after the same file
+            with locked(local_filepath + LOCK_SUFFIX):
+                mtime = 0
                 if os.path.exists(local_filepath):
-                    os.remove(local_filepath)
-                if debug:
-                    LOGGER.debug('Copying file from %s:%s to %s temporarily',
-                                 self._get_box_from_level(level),
-                                 log_file,
-                                 local_filepath)
-                self._copy_remote_file(log_file, local_filepath,
-                                       self._get_box_from_level(level))
-                if debug:
-                    LOGGER.debug('Done copying file')
-        except IOError as err:
-            LOGGER.error('Couldn\'t copy %s from %s. Error: %s', log_file,
-                         self._get_box_from_level(level), str(err))
+                    mtime = os.path.getmtime(local_filepath)
+
+                now = time.time()
+                max_time_before_recopy = \
+                    now - self._optional_params[LSC.LOCAL_COPY_LIFETIME]*60*60
+
+                if mtime < max_time_before_recopy:
+                    if debug:
+                        LOGGER.debug('Copying file from %s:%s to %s temporarily',
+                                     box,
+                                     log_file,
+                                     local_filepath)
+                    self._copy_remote_file(log_file, local_filepath, box)
+                    if debug:
+                        LOGGER.debug('Done copying file')
+
+                # The access time keeps track of when the copy was last used, for eviction
+                os.utime(local_filepath, (now, os.path.getmtime(local_filepath)))
+        except (IOError, OSError) as err:
+            LOGGER.error('Couldn\'t copy %s from %s. Error: %s', log_file, box, str(err))
             return ''
 
         return local_filepath
 
-    def _make_file_path(self):
+    def _get_pool(self):
+        '''Returns the scraper's worker pool, starting it up if it isn't running yet'''
+        if self._pool is None:
+            self._pool = Pool(processes=self._optional_params[LSC.PROCESSOR_COUNT])
+        return self._pool
+
+    def _get_result_cache(self):
+        '''Returns the store that the results for archived files are cached in'''
+        return FileStore(self._optional_params[LSC.RESULT_CACHE_PATH],
+                         self._optional_params[LSC.RESULT_CACHE_SIZE])
+
+    def _get_result_cache_key(self, log_file):
+        '''
+        Returns the key to cache log_file's results under,
+        or None if they shouldn't be cached: only archived files and the files for days
+        before today are, since they're done being written to,
+        and only when they're scanned whole rather than for a time window.
+        The key covers the file's path, size and mtime, the scraper class and the regexes.
+        Copies of remote files go by the remote file's path, size and mtime
+        (see _load_remote_cache_keys), since the copy's change every time it's refreshed.
+        '''
+        if not self._optional_params[LSC.RESULT_CACHE_PATH] \
+                or self._get_time_window() is not None:
+            return None
+        if log_file in self._file_hosts:
+            return self._remote_cache_keys.get(log_file)
+        log_date = self._file_dates.get(log_file)
+        archived_path = self._get_archived_file_path()
+        log_file = os.path.abspath(log_file)
+        is_archived = bool(archived_path) and \
+            log_file.startswith(os.path.join(os.path.abspath(archived_path), ''))
+        if not is_archived and (log_date is None
+                                or log_date >= date.today().strftime(DATE_FORMAT)):
+            return None
+        stat = os.stat(log_file)
+        return self._make_result_cache_key(log_file, stat.st_size, stat.st_mtime)
+
+    def _get_time_range(self, log_file):
+        '''
+        Returns the (start, end) range of (uncompressed) byte offsets that the lines
+        in the time window are in, going by log_file's timestamp index.
+        Returns (0, None) if the file can't be indexed, and should be read whole:
+        i.e. TIMESTAMP_INDEX_PATH isn't set, the file is being streamed,
+        or it's gzipped and GZIP_INDEX_PATH isn't set.
+        '''
+        if not self._optional_params[LSC.TIMESTAMP_INDEX_PATH] or self._is_streaming_remote():
+            return 0, None
+        is_gzip = self._is_gzip_file(log_file)
+        if is_gzip and not self._optional_params[LSC.GZIP_INDEX_PATH]:
+            return 0, None
+
+        start, end = self._get_timestamp_index(log_file).find_range(*self._get_time_window())
+        if end is None:
+            if is_gzip:
+                end = self._get_gzip_index(log_file).uncompressed_size
+            else:
+                end = os.path.getsize(log_file)
+        LOGGER.debug('Time window is in bytes [%d, %d) of %s', start, end, log_file)
+        return start, end
+
+    def _get_time_window(self):
+        '''
+        Returns the (start, end) time window from the START_TIME and END_TIME user params,
+        or None if neither is set. Either end can be None for no limit.
+        '''
+        start = self._user_params.get(LSC.START_TIME)
+        end = self._user_params.get(LSC.END_TIME)
+        if start is None and end is None:
+            return None
+        return (None if start is None else self._parse_timestamp(start),
+                None if end is None else self._parse_timestamp(end))
+
+    def _get_timestamp_index(self, log_file):
+        '''
+        Returns the timestamp index for log_file, building it the first time
+        and bringing it up to date if the file has grown since.
+        Indexes are rebuilt from scratch if the file was truncated or replaced,
+        or if a gzipped file changed at all.
+        '''
+        store = FileStore(self._optional_params[LSC.TIMESTAMP_INDEX_PATH])
+        key = os.path.abspath(log_file)
+        stat = os.stat(log_file)
+        is_gzip = self._is_gzip_file(log_file)
+        with open(log_file, 'rb') as handle:
+            head = handle.read(CHECKPOINT_HEAD_SIZE)
+
+        fingerprint = self._timestamp_fingerprint()
+        index = store.get(key)
+        if index is not None and index.fingerprint == fingerprint \
+                and (index.size, index.mtime) == (stat.st_size, stat.st_mtime):
+            return index
+        if index is None or index.fingerprint != fingerprint \
+                or index.inode != stat.st_ino or index.size > stat.st_size \
+                or not head.startswith(index.head) or is_gzip:
+            LOGGER.info('Building timestamp index for %s', log_file)
+            index = TimestampIndex(self._optional_params[LSC.TIMESTAMP_INDEX_SPACING],
+                                   fingerprint)
+
+        if is_gzip:
+            handle = self._get_gzip_index(log_file).open_at(0)
+        else:
+            handle = open(log_file, 'rb')
+            handle.seek(index.end_offset)
+        with handle:
+            index.update(handle, self._extract_timestamp)
+        index.size, index.mtime, index.inode = stat.st_size, stat.st_mtime, stat.st_ino
+        index.head = head[:index.end_offset]
+        store.put(key, index)
+        return index
+
+    def _glob(self, pattern):
+        '''
+        glob(), except that patterns for files in the archives are looked up
+        in the archive manifest, if ARCHIVE_MANIFEST_PATH is set,
+        rather than listing the archive directory every time.
+        '''
+        directory, name = os.path.split(pattern)
+        archived_path = self._get_archived_file_path()
+        if not self._optional_params[LSC.ARCHIVE_MANIFEST_PATH] or not archived_path \
+                or has_magic(directory) or not os.path.isdir(directory) \
+                or not os.path.join(os.path.abspath(directory), '').startswith(
+                    os.path.join(os.path.abspath(archived_path), '')):
+            return glob(pattern)
+
+        manifest = self._archive_manifests.get(directory)
+        if manifest is None:
+            manifest = ArchiveManifest.get(
+                directory, FileStore(self._optional_params[LSC.ARCHIVE_MANIFEST_PATH]))
+            self._archive_manifests[directory] = manifest
+        return [os.path.join(directory, match) for match in manifest.match(name)]
+
+    def _imap_files(self, func, chunk_func=None):
+        '''
+        Streaming version of _multiprocess_files.
+        Yields the result of running func on each file as soon as it's done.
+        If chunk_func is given and chunking, incremental mode, the result cache
+        or a time window is turned on, each file is planned as (log_file, start, end)
+        chunks that chunk_func is run on instead; a file's result is yielded once all
+        of its chunks are in and merged. A time window only splits files into chunks
+        when the default scanning methods are in use.
+        '''
+        if not self._prepare_file_list(use_result_cache=chunk_func is not None):
+            return
+
+        if chunk_func is None or self._is_streaming_remote() \
+                or not (self._is_chunking_enabled() or self._is_incremental()
+                        or self._optional_params[LSC.RESULT_CACHE_PATH]
+                        or self._get_time_window() is not None):
+            for result in self._imap_on_pool(func, self._file_list):
+                yield result
+            return
+
+        chunks = []
+        partial_results = {}
+        checkpoints = {}
+        cache_keys = {}
+        for log_file in self._file_list:
+            cache_key = self._get_result_cache_key(log_file)
+            if cache_key is not None:
+                partial_results[log_file] = self._remote_cached_results.pop(log_file, None)
+                if partial_results[log_file] is None:
+                    partial_results[log_file] = self._get_result_cache().get(cache_key)
+                if partial_results[log_file] is not None:
+                    LOGGER.debug('Using cached results for %s', log_file)
+                    # It may have been cached under another path to the same file
+                    partial_results[log_file][LSC.FILENAME] = log_file
+                    continue
+                cache_keys[log_file] = cache_key
+
+            if self._get_time_window() is not None and self._uses_default_scanning():
+                start, end = self._get_time_range(log_file)
+                if end is None:
+                    chunks.append((log_file, 0, None))
+                else:
+                    chunks += self._split_range(log_file, start, end)
+            elif self._is_incremental() and not self._is_gzip_file(log_file):
+                checkpoint, result, start, end = self._load_checkpoint(log_file)
+                checkpoints[log_file] = checkpoint
+                partial_results[log_file] = result
+                chunks += self._split_range(log_file, start, end)
+            elif self._is_chunking_enabled():
+                chunks += self._split_file(log_file)
+            else:
+                chunks.append((log_file, 0, None))
+        LOGGER.debug('Scanning %d chunks', len(chunks))
+
+        pending = collections.Counter(chunk[0] for chunk in chunks)
+        for log_file in self._file_list:
+            if pending[log_file] == 0:
+                # Cached, or nothing new to scan
+                yield self._finish_file_result(log_file, partial_results.pop(log_file, None),
+                                               checkpoints.get(log_file))
+
+        for chunk_result in self._imap_on_pool(chunk_func, chunks):
+            filename = chunk_result[LSC.FILENAME]
+            started = time.time()
+            if partial_results.get(filename) is not None:
+                self._combine_hits(chunk_result[LSC.REGEXES],
+                                   partial_results[filename][LSC.REGEXES])
+                if LSC.METRICS in chunk_result:
+                    self._combine_hits(chunk_result[LSC.METRICS],
+                                       partial_results[filename].setdefault(LSC.METRICS, {}))
+            else:
+                partial_results[filename] = chunk_result
+            self._add_run_time(LSC.MERGE_TIME, started)
+            pending[filename] -= 1
+            if pending[filename] == 0:
+                yield self._finish_file_result(filename, partial_results.pop(filename),
+                                               checkpoints.get(filename),
+                                               cache_keys.get(filename))
+
+    def _imap_on_pool(self, func, items):
+        '''
+        Generator that runs func over items on the scraper's pool
+        and yields the results in the order they complete.
+        If the caller stops early or the wait is interrupted,
+        the pool is torn down so the remaining work doesn't keep running.
+        '''
+        pool = self._get_pool()
+        results = pool.imap_unordered(func, items)
+        finished = False
+        try:
+            for _ in xrange(len(items)):
+                # See _map_on_pool for why there's a timeout
+                yield results.next(TIMEOUT)
+            finished = True
+        finally:
+            if not finished:
+                self._terminate_pool()
+
+    def _is_chunking_enabled(self):
+        '''Whether big files should be split up into chunks and scanned in parallel'''
+        return self._optional_params[LSC.CHUNK_SIZE] > 0 and self._uses_default_scanning()
+
+    def _is_block_scannable(self, log_file):
+        '''
+        Whether log_file can be memory-mapped and scanned in blocks:
+        it has to be turned on, there can't be a time window, every regex has to have
+        a block matcher and none can be bucketed by time, the file has to be uncompressed,
+        and none of the line-by-line
+        reading and aggregating methods can have been overridden.
+        '''
+        if not self._optional_params[LSC.USE_MMAP] or self._is_streaming_remote() \
+                or self._get_time_window() is not None:
+            return False
+        for regex in self._regexes:
+            if regex.get_block_matcher() is None or regex.get_bucket_size():
+                return False
+        for method_name in ['_gen_lines', '_get_file_handle', '_aggregate_lines',
+                            '_run_regex_and_do_aggregation']:
+            if self._is_overridden(method_name):
+                return False
+        return not self._is_gzip_file(log_file)
+
+    @classmethod
+    def _is_gzip_file(cls, log_file):
+        '''Checks the first two characters of the file for the gzip header'''
+        with open(log_file, 'rb') as handle:
+            return handle.read(2) == GZIP_MAGIC
+
+    def _is_incremental(self):
+        '''Whether files should only be scanned from where the last run left off'''
+        return (bool(self._optional_params[LSC.CHECKPOINT_PATH]) and self._uses_default_scanning()
+                and self._get_time_window() is None)
+
+    def _is_overridden(self, method_name):
+        '''Whether the derived class has its own version of the given LogScraper method'''
+        method = getattr(type(self), method_name)
+        return method.im_func is not getattr(LogScraper, method_name).im_func
+
+    def _is_remote(self):
+        '''Whether any of the files live on another box. See _is_remote_day.'''
+        return any(self._is_remote_day(log_date) for log_date in self._get_dates())
+
+    def _is_remote_day(self, log_date):
+        '''
+        Whether the files for log_date live on another box, i.e. a level was given for logs
+        that haven't been archived yet, on a box other than this one (or FORCE_COPY is set)
+        '''
+        level = self._user_params.get(LSC.LEVEL, None)
+        if not level or self._are_logs_archived(log_date):
+            return False
+        return (self._optional_params.get(LSC.FORCE_COPY, False)
+                or any(box != socket.gethostname() for box in self._get_boxes_from_level(level)))
+
+    def _is_remote_scan(self):
+        '''
+        Whether the files should be scanned on the remote box.
+        Only the default scanning can be run there, so not if any of it (down to how lines
+        are matched, counted and timestamped) is overridden, and the remote scanner doesn't
+        know about timestamps, so not with a time window either.
+        Every file has to be remote, so not for a date range reaching back into the archives,
+        and it only counts hits, so not if any of the regexes do more than that.
+        '''
+        if not (self._optional_params[LSC.REMOTE_SCAN] and self._is_remote()
+                and not self._spans_archived_days()
+                and all(regex.is_count_only() for regex in self._regexes)
+                and self._get_time_window() is None
+                and self._uses_default_scanning()):
+            return False
+        for method_name in ['_process_file_for_matches', '_aggregate_lines', '_run_regexes',
+                            '_run_regex_and_do_aggregation', '_sum_group_matches',
+                            '_extract_timestamp']:
+            if self._is_overridden(method_name):
+                return False
+        return True
+
+    def _list_remote_files(self, box, log_date=None):
+        '''
+        Returns the files on box whose names match FILENAME_REGEX, as remote paths.
+        log_date defaults to DATE.
+        '''
+        level = self._user_params.get(LSC.LEVEL, None)
+        if log_date is None:
+            log_date = self._user_params.get(LSC.DATE, None)
+        file_list = []
+        with self._ssh_connection(box) as conn:
+            if conn is None:
+                return file_list
+            filename_regex = \
+                self._make_file_name(self._optional_params[LSC.FILENAME_REGEX],
+                                     log_date, level)
+
+            files = conn.sftp().listdir(self._default_path)
+            for name in files:
+                match = re.match(filename_regex, str(name))
+                if match is not None:
+                    file_list.append(self._make_remote_path(
+                        box, os.path.join(self._default_path, match.group())))
+        return file_list
+
+    def _is_streaming_remote(self):
+        '''
+        Whether remote files should be scanned straight off SFTP instead of copied over.
+        Every file has to be remote, so not for a date range reaching back into the archives.
+        '''
+        return (self._optional_params[LSC.STREAM_REMOTE] and self._is_remote()
+                and not self._spans_archived_days())
+
+    def _load_remote_cache_keys(self, remote_files):
+        '''
+        Works out the result cache keys of the remote files for days before today
+        from their size and mtime on the box, keeping them in _remote_cache_keys
+        by where the files are copied to, and keeps the results that are already cached
+        in _remote_cached_results. Returns the set of remote files with cached results,
+        which don't need copying over.
+        '''
+        if not self._optional_params[LSC.RESULT_CACHE_PATH] \
+                or self._get_time_window() is not None:
+            return set()
+        today = date.today().strftime(DATE_FORMAT)
+        default_date = self._user_params.get(LSC.DATE, None)
+        finished = [remote_file for remote_file in remote_files
+                    if self._file_dates.get(remote_file, default_date) is not None
+                    and self._file_dates.get(remote_file, default_date) < today]
+
+        cache = self._get_result_cache()
+        cached = set()
+        for remote_file, stat in zip(finished,
+                                     self._map_on_threads(self._stat_remote_file, finished)):
+            if stat is None:
+                continue
+            local_file = self._get_local_copy_path(remote_file)
+            cache_key = self._make_result_cache_key(remote_file, stat.st_size, stat.st_mtime)
+            self._remote_cache_keys[local_file] = cache_key
+            result = cache.get(cache_key)
+            if result is not None:
+                self._remote_cached_results[local_file] = result
+                cached.add(remote_file)
+        return cached
+
+    def _load_checkpoint(self, log_file):
+        '''
+        Works out how much of log_file is left to scan in incremental mode.
+        Returns a tuple of (checkpoint, result, start, end), where checkpoint is the
+        new checkpoint to save once the scan is done, result is the stored result
+        for everything before start (None if starting from scratch), and
+        [start, end) is the range left to scan, ending after the last complete line.
+        The stored checkpoint is thrown away if the file was truncated or replaced,
+        or if the regexes have changed since.
+        '''
+        stat = os.stat(log_file)
+        end = self._find_last_line_end(log_file, stat.st_size)
+        with open(log_file, 'rb') as handle:
+            head = handle.read(min(CHECKPOINT_HEAD_SIZE, end))
+        checkpoint = {'path' : os.path.abspath(log_file), 'device' : stat.st_dev,
+                      'inode' : stat.st_ino, 'offset' : end, 'head' : head,
+                      'fingerprint' : self._regex_fingerprint()}
+
+        stored = self._get_checkpoint_store().get(checkpoint['path'])
+        if stored is None:
+            return checkpoint, None, 0, end
+        if (stored['device'], stored['inode']) != (stat.st_dev, stat.st_ino) \
+                or stored['offset'] > end or not head.startswith(stored['head']):
+            LOGGER.info('%s was truncated or rotated, rescanning it from the start', log_file)
+            return checkpoint, None, 0, end
+        if stored['fingerprint'] != checkpoint['fingerprint']:
+            LOGGER.info('Regexes changed since %s was last scanned, rescanning it', log_file)
+            return checkpoint, None, 0, end
+        return checkpoint, stored['result'], stored['offset'], end
+
+    def _make_file_path(self, box=None, log_date=None):
         '''Creates and returns the path where files should be globbed for
-           for a given date and production level'''
-        log_date = self._user_params.get(LSC.DATE, None)
+           for a given date and production level.
+           box picks one of the level's boxes, if it has several,
+           and log_date defaults to DATE'''
+        if log_date is None:
+            log_date = self._user_params.get(LSC.DATE, None)
         level = self._user_params.get(LSC.LEVEL, None)
         if log_date is None and level is None:
             return os.path.join(self._default_path,
                                 self._make_file_name(self._default_filename))
 
+        if box is None:
+            boxes = self._get_boxes_from_level(level)
+            if len(boxes) == 1:
+                box = boxes[0]
         if not self._are_logs_archived(log_date):
             return os.path.join(self._default_path,
                                 self._make_file_name(self._default_filename,
                                                      log_date,
-                                                     self._get_box_from_level(level)))
+                                                     box))
 
         return os.path.join(self._get_archived_file_path(),
                             self._make_file_name(self._default_filename,
-                                                 log_date, self._get_box_from_level(level))
+                                                 log_date, box)
                             + '*')
 
     def _make_file_name(self, base_name, log_date=None, box=None):
@@ -626,40 +1780,183 @@ class LogScraper(object):
             parts.append(log_date)
         return '-'.join(parts) + self._default_ext
 
+    def _make_result_cache_key(self, path, size, mtime):
+        '''Returns the result cache key for the file at path, with the given size and mtime'''
+        return '|'.join([path, str(size), repr(mtime), type(self).__module__,
+                         type(self).__name__, self._regex_fingerprint()])
+
+    @classmethod
+    def _make_remote_path(cls, box, path):
+        '''Returns how a file on a remote box is named in the file list: box:path'''
+        return '{}:{}'.format(box, path)
+
+    def _make_remote_request(self, files, mode):
+        '''Returns the JSON request to send the remote scanner for files'''
+        return json.dumps({'files' : files, 'mode' : mode,
+                           'processes' : self._optional_params[LSC.PROCESSOR_COUNT],
+                           'regexes' : [[regex.get_pattern().decode('latin-1'),
+                                         regex.get_required_literal().decode('latin-1')]
+                                        for regex in self._regexes]})
+
+    def _map_on_pool(self, func, items):
+        '''
+        Runs func over items on the scraper's pool and returns the results in order.
+        If the wait is interrupted, the pool is torn down so that no stray work
+        is left running in it; a fresh one gets started by the next call.
+        '''
+        pool = self._get_pool()
+        try:
+            # Why is there a crazy timeout value at the end of this call?
+            # Because python has a bug in it that's been open for years and has not been fixed
+            # outside of v3.3 and above, wherein a KeyboardInterruption is never delivered
+            # when a thread is waiting for a condition, which leads to a hang
+            # if a user hits ^C.
+            # However, if you set a timeout on the call, Condition.wait() will receive
+            # the interrupt immediately.
+            # See: http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool
+            return pool.map_async(func, items).get(TIMEOUT)
+        except KeyboardInterrupt:
+            self._terminate_pool()
+            raise
+
+    def _imap_on_threads(self, func, items):
+        '''
+        Generator that runs func, which returns an iterable, on each of items in up to
+        MAX_CONNECTIONS threads, and yields what they all return as soon as it comes in.
+        For work that's mostly waiting on remote boxes and can be streamed, e.g. one scan
+        per box. Stopping early tells the threads to stop at their next value.
+        '''
+        items = list(items)
+        if len(items) <= 1:
+            for item in items:
+                for value in func(item):
+                    yield value
+            return
+
+        todo = Queue.Queue()
+        for item in items:
+            todo.put(item)
+        done = Queue.Queue()
+        stopped = threading.Event()
+
+        def _work():
+            '''Runs func on items until there are none left, passing on what it returns'''
+            try:
+                while not stopped.is_set():
+                    try:
+                        item = todo.get_nowait()
+                    except Queue.Empty:
+                        break
+                    for value in func(item):
+                        done.put(('value', value))
+                        if stopped.is_set():
+                            break
+            except Exception:
+                done.put(('error', sys.exc_info()))
+            finally:
+                done.put(('finished', None))
+
+        threads = [threading.Thread(target=_work)
+                   for _ in xrange(min(len(items), self._optional_params[LSC.MAX_CONNECTIONS]))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                # Same crazy timeout as in _map_on_pool, so that ^C gets through
+                kind, value = done.get(True, TIMEOUT)
+                if kind == 'finished':
+                    running -= 1
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                else:
+                    yield value
+        finally:
+            stopped.set()
+
+    def _map_on_threads(self, func, items):
+        '''
+        Runs func on each of items in up to MAX_CONNECTIONS threads.
+        For work that's mostly waiting on remote boxes, e.g. one task per box.
+        '''
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(len(items), self._optional_params[LSC.MAX_CONNECTIONS]))
+        try:
+            return pool.map_async(func, items).get(TIMEOUT)
+        finally:
+            pool.terminate()
+
     def _multiprocess_files(self, func):
         '''
         Creates a pool to run the given function func
         through several files at once.
         '''
+        if not self._prepare_file_list():
+            return None
 
-        # First copy any remote files as needed and create final file list
-        if (self._user_params.get(LSC.LEVEL, None)
-                and not self._are_logs_archived(self._user_params.get(LSC.DATE, None))):
-            if (self._optional_params.get(LSC.FORCE_COPY, False)
-                    or socket.gethostname() != \
-                      self._get_box_from_level(self._user_params.get(LSC.LEVEL, None))):
-                pool = Pool(processes=self._optional_params[LSC.PROCESSOR_COUNT])
-                # Why is there a crazy timeout value at the end of this call?
-                # Because python has a bug in it that's been open for years and has not been fixed
-                # outside of v3.3 and above, wherein a KeyboardInterruption is never delivered
-                # when a thread is waiting for a condition, which leads to a hang
-                # if a user hits ^C.
-                # However, if you set a timeout on the call, Condition.wait() will receive
-                # the interrupt immediately.
-                # See: http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool
-                file_list = pool.map_async(self._get_log_file, self._file_list).get(TIMEOUT)
-                self._file_list = sorted(filter(lambda x: x != '', file_list))
-                pool = None
+        results = self._map_on_pool(func, self._file_list)
+        return results
 
-        LOGGER.debug('Final file list: %s', self._file_list)
+    def _new_file_hits(self, log_file):
+        '''Returns an empty per-file result, ready to aggregate hits into'''
+        regex_hits = {LSC.FILENAME : log_file, LSC.REGEXES : {}}
+        for regex in self._regexes:
+            regex_hits[LSC.REGEXES][regex.name] = {}
+            regex_hits[LSC.REGEXES][regex.name][LSC.TOTAL_HITS] = 0
+            regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS] = {}
+            for group in regex.get_groups():
+                regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS][group] = \
+                    regex.get_group_aggregator(group) or {}
+            if regex.get_bucket_size():
+                regex_hits[LSC.REGEXES][regex.name][LSC.BUCKET_HITS] = dict(
+                    (group, BucketedCounter(regex.get_bucket_size()))
+                    for group in regex.get_groups() + [LSC.TOTAL_HITS])
+        return regex_hits
 
-        if self._file_list == []:
-            LOGGER.error('No files found to process.')
+    def _new_regex_metrics(self):
+        '''Returns empty metrics for each regex'''
+        return dict((regex.name, {LSC.EVALUATIONS : 0, LSC.TOTAL_HITS : 0, LSC.MATCH_TIME : 0.0})
+                    for regex in self._regexes)
+
+    def _new_run_metrics(self):
+        '''Returns empty metrics for a run if INSTRUMENT is set, or None otherwise'''
+        if not self._optional_params[LSC.INSTRUMENT]:
             return None
+        # WALL_TIME is when the run started, until _finish_run_metrics
+        return {LSC.FILE_HITS : collections.OrderedDict(), LSC.REGEXES : self._new_regex_metrics(),
+                LSC.WALL_TIME : time.time(), LSC.COPY_TIME : 0.0, LSC.MERGE_TIME : 0.0}
 
-        pool = Pool(processes=self._optional_params[LSC.PROCESSOR_COUNT])
-        results = pool.map_async(func, self._file_list).get(TIMEOUT)
-        return results
+    def _open_log_file(self, filename):
+        '''
+        Opens filename with _get_file_handle, straight off its box if it's being streamed,
+        and timing the reads of its compressed data if INSTRUMENT is set
+        '''
+        options = {}
+        if self._is_streaming_remote():
+            options['remote_handle'] = self._open_remote_file(filename)
+        if self._optional_params[LSC.INSTRUMENT]:
+            options['wrap_compressed'] = self._time_compressed_reads
+        return self._get_file_handle(filename, **options)
+
+    def _open_remote_file(self, remote_path):
+        '''
+        Opens the file at box:path for reading straight off SFTP.
+        The box's pooled connection stays checked out until the returned reader is closed.
+        Throws IOError if the box can't be connected to.
+        '''
+        box, path = self._split_remote_path(remote_path)
+        checkout = self._ssh_connection(box)
+        conn = checkout.__enter__()
+        try:
+            if conn is None:
+                raise IOError('Could not connect to {}'.format(box))
+            return SFTPReader(conn.sftp().open(path, 'rb'),
+                              on_close=lambda: checkout.__exit__(None, None, None))
+        except Exception:
+            checkout.__exit__(*sys.exc_info())
+            raise
 
     @classmethod
     def _open_ssh_connection(cls, server):
@@ -682,6 +1979,62 @@ class LogScraper(object):
 
         return None
 
+    def _parse_timestamp(self, value):
+        '''
+        Turns a timestamp string into a datetime using TIMESTAMP_FORMAT.
+        Strings are left as they are if there's no format, and so is anything that isn't one.
+        Returns None if the string doesn't fit the format.
+        '''
+        if not isinstance(value, basestring) or not self._optional_params[LSC.TIMESTAMP_FORMAT]:
+            return value
+        try:
+            return datetime.strptime(value, self._optional_params[LSC.TIMESTAMP_FORMAT])
+        except ValueError:
+            return None
+
+    def _prepare_file_list(self, use_result_cache=False):
+        '''
+        Copies over any remote files as needed and creates the final file list.
+        If use_result_cache is set, remote files whose results are in the result cache
+        aren't copied, and are only in the file list by where they'd have been copied to.
+        Returns False if that leaves no files to process.
+        '''
+        started = time.time()
+        self._remote_cache_keys = {}
+        self._remote_cached_results = {}
+        if self._is_streaming_remote():
+            self._file_hosts = dict((remote_file, self._split_remote_path(remote_file)[0])
+                                    for remote_file in self._file_list)
+        elif self._is_remote():
+            # With a date range, the days that have been archived are already local
+            default_date = self._user_params.get(LSC.DATE, None)
+            remote_files = [f for f in self._file_list
+                            if self._is_remote_day(self._file_dates.get(f, default_date))]
+            remote_set = set(remote_files)
+            local_files = [f for f in self._file_list if f not in remote_set]
+            cached = self._load_remote_cache_keys(remote_files) if use_result_cache else set()
+            to_copy = [f for f in remote_files if f not in cached]
+            copies = dict(zip(to_copy, self._map_on_pool(self._get_log_file, to_copy)))
+            file_list = [self._get_local_copy_path(f) if f in cached else copies[f]
+                         for f in remote_files]
+            self._file_hosts = dict((local_file, self._split_remote_path(remote_file)[0])
+                                    for remote_file, local_file in zip(remote_files, file_list)
+                                    if local_file != '')
+            for remote_file, local_file in zip(remote_files, file_list):
+                log_date = self._file_dates.pop(remote_file, None)
+                if local_file != '' and log_date is not None:
+                    self._file_dates[local_file] = log_date
+            self._file_list = sorted(local_files + filter(lambda x: x != '', file_list))
+            self._evict_tmp_files()
+        self._add_run_time(LSC.COPY_TIME, started)
+
+        LOGGER.debug('Final file list: %s', self._file_list)
+
+        if self._file_list == []:
+            LOGGER.error('No files found to process.')
+            return False
+        return True
+
     @classmethod
     def _pretty_print(cls, result, options, out=sys.stdout):
         '''
@@ -695,6 +2048,10 @@ class LogScraper(object):
                 for group, group_hits in hits[LSC.GROUP_HITS].items():
                     if group == LSC.TOTAL_HITS:
                         continue
+                    if isinstance(group_hits, Aggregator):
+                        out.write('\n{} {}: {}\n'.format(regex_name, group.capitalize(),
+                                                          group_hits))
+                        continue
                     out.write('\n{} hits per {}:\n'.format(regex_name, group.capitalize()))
                     cls._pretty_print_dict(group_hits)
                     out.write('\n{} max, min and average:\n'.format(regex_name))
@@ -735,52 +2092,168 @@ class LogScraper(object):
            processing on the files.'''
 
         regex_hits = {LSC.FILENAME : log_file, LSC.REGEXES : {}}
-        with self._get_file_handle(log_file) as file_handle:
-            for regex in self._regexes:
-                regex_hits[LSC.REGEXES][regex.name] = {}
-                regex_hits[LSC.REGEXES][regex.name][LSC.MATCHES] = []
+        for regex in self._regexes:
+            regex_hits[LSC.REGEXES][regex.name] = {}
+            regex_hits[LSC.REGEXES][regex.name][LSC.MATCHES] = []
+        self._start_file_metrics(regex_hits)
+        metrics = regex_hits.get(LSC.METRICS)
 
-            for line in file_handle:
+        if self._is_block_scannable(log_file):
+            for buf, block_start, block_end in self._block_scan(log_file):
+                lines = self._count_block_lines(buf, block_start, block_end, metrics)
                 for regex in self._regexes:
-                    matcher = regex.get_matcher()
-                    if matcher.match(line) != None:
-                        regex_hits[LSC.REGEXES][regex.name][LSC.MATCHES].append(line)
-
+                    matches = regex_hits[LSC.REGEXES][regex.name][LSC.MATCHES]
+                    started, hits_before = time.time(), len(matches)
+                    for match in regex.get_block_matcher().finditer(buf, block_start, block_end):
+                        if match.start() == block_end:
+                            continue
+                        line_end = buf.find('\n', match.end())
+                        matches.append(buf[match.start():len(buf) if line_end == -1
+                                           else line_end + 1])
+                    if metrics is not None:
+                        self._count_evaluations(metrics, regex, len(matches) - hits_before,
+                                                time.time() - started, lines)
+            self._stop_file_metrics(regex_hits)
+            return regex_hits
+
+        dispatcher = RegexDispatcher(self._regexes)
+        for line in self._time_lines(self._gen_lines(log_file), regex_hits):
+            for regex, prefix in dispatcher.candidates(line):
+                if prefix and not line.startswith(prefix):
+                    continue
+                if metrics is None:
+                    match = regex.match(line)
+                else:
+                    started = time.time()
+                    match = regex.match(line)
+                    self._count_evaluations(metrics, regex, match is not None,
+                                            time.time() - started)
+                if match != None:
+                    regex_hits[LSC.REGEXES][regex.name][LSC.MATCHES].append(line)
+
+        self._stop_file_metrics(regex_hits)
         return regex_hits
 
 
+    def _process_chunk_for_aggregates(self, chunk):
+        '''
+        Extracts the data from the (log_file, start, end) chunk and returns.
+        A chunk with an end of None is the whole file.
+        The group data is left unsorted, as the chunk results still need merging.
+        '''
+        log_file, start, end = chunk
+        if end is None:
+            return self._process_file_for_aggregates(log_file)
+
+        regex_hits = self._new_file_hits(log_file)
+        self._start_file_metrics(regex_hits)
+        if self._is_block_scannable(log_file):
+            self._block_scan_for_aggregates(log_file, regex_hits, start, end)
+        else:
+            self._aggregate_lines(self._time_lines(self._gen_lines_in_range(log_file, start, end),
+                                                   regex_hits), regex_hits)
+        self._stop_file_metrics(regex_hits)
+        return regex_hits
+
     def _process_file_for_aggregates(self, log_file):
         '''Extracts the data from the given log_file and returns.
            Override if you need to run several regexes or do any special
            processing on the files.'''
 
-        regex_hits = {LSC.FILENAME : log_file, LSC.REGEXES : {}}
-        for regex in self._regexes:
-            regex_hits[LSC.REGEXES][regex.name] = {}
-            regex_hits[LSC.REGEXES][regex.name][LSC.TOTAL_HITS] = 0
-            regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS] = {}
-            for group in regex.get_groups():
-                regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS][group] = {}
+        regex_hits = self._new_file_hits(log_file)
+        self._start_file_metrics(regex_hits)
+        if self._is_block_scannable(log_file):
+            self._block_scan_for_aggregates(log_file, regex_hits)
+        else:
+            self._aggregate_lines(self._time_lines(self._gen_lines(log_file), regex_hits),
+                                  regex_hits)
+        self._stop_file_metrics(regex_hits)
+        self._sort_group_hits(regex_hits)
 
-        for line in self._gen_lines(log_file):
-            for regex in self._regexes:
-                group_hits = regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS]
-                regex_hits[LSC.REGEXES][regex.name][LSC.TOTAL_HITS] += \
-                    self._run_regex_and_do_aggregation(line,
-                                                       regex.get_matcher(),
-                                                       group_hits)
-        #Sort the group data
-        for hits in regex_hits[LSC.REGEXES].values():
-            for group, group_hits in hits[LSC.GROUP_HITS].items():
-                hits[LSC.GROUP_HITS][group] = \
-                    collections.OrderedDict(sorted(group_hits.iteritems()))
+        return regex_hits
 
+    def _read_remote_result(self, payload, mode):
+        '''Turns a file's result from the remote scanner back into the usual per-file result'''
+        filename = payload['filename'].encode('utf-8')
+        if mode == 'matches':
+            regex_hits = {LSC.FILENAME : filename, LSC.REGEXES : {}}
+            for regex, hits in zip(self._regexes, payload['regexes']):
+                regex_hits[LSC.REGEXES][regex.name] = \
+                    {LSC.MATCHES : [line.encode('latin-1') for line in hits['matches']]}
+            return regex_hits
+
+        regex_hits = self._new_file_hits(filename)
+        for regex, hits in zip(self._regexes, payload['regexes']):
+            regex_hits[LSC.REGEXES][regex.name][LSC.TOTAL_HITS] = hits['total_hits']
+            group_hits = regex_hits[LSC.REGEXES][regex.name][LSC.GROUP_HITS]
+            for group, counts in hits['group_hits'].items():
+                group_hits[str(group)] = dict((None if value is None else value.encode('latin-1'),
+                                               count) for value, count in counts)
+        self._sort_group_hits(regex_hits)
         return regex_hits
 
+    def _regex_fingerprint(self):
+        '''
+        Returns a hash of the names, patterns and settings of the regexes being run,
+        and of how timestamps are extracted if any of them are bucketed by time
+        '''
+        fingerprint = [(regex.name, regex.get_pattern(), regex.get_bucket_size(),
+                        [(group, regex.get_group_aggregator(group))
+                         for group in sorted(regex.get_groups())])
+                       for regex in self._regexes]
+        if any(regex.get_bucket_size() for regex in self._regexes):
+            fingerprint.append(self._timestamp_fingerprint())
+        return hashlib.sha1(repr(fingerprint)).hexdigest()
+
+    def _run_regexes(self, lines, dispatcher, regex_hits, planner=None, exclusive=None):
+        '''
+        Runs the regexes the dispatcher hands out over each line, in the order it hands them
+        out, and aggregates the hits into regex_hits. With a planner, each run is timed and
+        recorded in it. exclusive is a dict of regex name to exclusive group, for the groups
+        to stop running the rest of once one has matched a line.
+        '''
+        metrics = regex_hits.get(LSC.METRICS)
+        timed = metrics is not None or planner is not None
+        # Bucketed regexes are run through recorders, so that the match they made can be
+        # bucketed without running them again (unless an override matched some other way)
+        recorders = dict((regex.name, MatchRecorder(regex)) for regex in self._regexes
+                         if regex.get_bucket_size())
+        for line in lines:
+            if planner is not None:
+                planner.new_line()
+            matched_groups = ()
+            for regex, prefix in dispatcher.candidates(line):
+                if prefix and not line.startswith(prefix):
+                    continue
+                group = exclusive.get(regex.name) if exclusive else None
+                if group is not None and group in matched_groups:
+                    continue
+                hits = regex_hits[LSC.REGEXES][regex.name]
+                matcher = recorders.get(regex.name, regex)
+                if not timed:
+                    hit = self._run_regex_and_do_aggregation(line, matcher, hits[LSC.GROUP_HITS])
+                else:
+                    started = time.time()
+                    hit = self._run_regex_and_do_aggregation(line, matcher, hits[LSC.GROUP_HITS])
+                    elapsed = time.time() - started
+                    if metrics is not None:
+                        self._count_evaluations(metrics, regex, hit, elapsed)
+                    if planner is not None:
+                        planner.observe(regex, hit, elapsed)
+                hits[LSC.TOTAL_HITS] += hit
+                if hit:
+                    if matcher is not regex:
+                        self._bucket_line(line, matcher.last_match or regex.match(line),
+                                          hits[LSC.BUCKET_HITS])
+                        matcher.last_match = None
+                    if group is not None:
+                        matched_groups += (group,)
+
     @classmethod
     def _run_regex_and_do_aggregation(cls, line, matcher, aggregators):
         '''
-        Given the text and a regular expression,
+        Given the text and a regular expression
+        (a compiled pattern or a RegexObject, anything with a match method),
         adds found values for each regex group to the aggregators dict,
         and returns 1.
         If no match is found, returns 0
@@ -796,23 +2269,249 @@ class LogScraper(object):
             return None
         return 0
 
+    def _scan_remote(self, mode):
+        '''
+        Generator that runs the remote_scanner module over SSH on each of the level's boxes
+        at once, in the given mode ('aggregates' or 'matches'), on the files in the file list,
+        and yields the result for each file as soon as its box sends it back.
+        '''
+        files_by_box = collections.OrderedDict()
+        for remote_path in self._file_list:
+            box, path = self._split_remote_path(remote_path)
+            files_by_box.setdefault(box, []).append(path)
+            self._file_hosts[remote_path] = box
+
+        def _scan_box(box):
+            '''Scans the files on one box'''
+            return self._scan_remote_box(box, files_by_box[box], mode)
+
+        for result in self._imap_on_threads(_scan_box, files_by_box.keys()):
+            yield result
+
+    def _scan_remote_box(self, box, files, mode):
+        '''
+        Generator that runs the remote_scanner module on box over SSH,
+        and yields the result for each of files as soon as the box sends it back
+        '''
+        request = self._make_remote_request(files, mode)
+        command = '{} -c {}'.format(self._optional_params[LSC.REMOTE_PYTHON],
+                                    pipes.quote(inspect.getsource(remote_scanner)))
+
+        with self._ssh_connection(box) as conn:
+            if conn is None:
+                return
+            LOGGER.debug('Scanning %d files on %s', len(files), box)
+            stdin, stdout, stderr = conn.ssh.exec_command(command)
+            stdin.write(request)
+            stdin.channel.shutdown_write()
+            for line in stdout:
+                payload = json.loads(line)
+                if 'error' in payload:
+                    LOGGER.error('Couldn\'t scan %s on %s. Error: %s', payload['filename'], box,
+                                 payload['error'])
+                    continue
+                result = self._read_remote_result(payload, mode)
+                result[LSC.FILENAME] = self._make_remote_path(box, result[LSC.FILENAME])
+                yield result
+            if stdout.channel.recv_exit_status() != 0:
+                LOGGER.error('Remote scan on %s failed: %s', box, stderr.read())
+
+    def _sort_by_file_list(self, results):
+        '''Sorts per-file results into the order of the file list, in place, and returns them'''
+        file_order = dict((filename, index) for index, filename in enumerate(self._file_list))
+        results.sort(key=lambda result: file_order.get(result[LSC.FILENAME], len(file_order)))
+        return results
+
+    @classmethod
+    def _sort_group_hits(cls, regex_hits):
+        '''Sorts the group data for each regex in the results'''
+        for hits in regex_hits[LSC.REGEXES].values():
+            if LSC.GROUP_HITS in hits:
+                for group, group_hits in hits[LSC.GROUP_HITS].items():
+                    if isinstance(group_hits, Aggregator):
+                        continue
+                    hits[LSC.GROUP_HITS][group] = \
+                        collections.OrderedDict(sorted(group_hits.iteritems()))
+
+    def _spans_archived_days(self):
+        '''Whether any of the days being looked at have been archived'''
+        return any(self._are_logs_archived(log_date) for log_date in self._get_dates())
+
+    def _split_file(self, log_file):
+        '''
+        Splits the file into (log_file, start, end) chunks of about CHUNK_SIZE bytes.
+        Gzipped files are split at the checkpoints in their index,
+        if GZIP_INDEX_PATH is set and the file has more than one.
+        Files that can't be split or are not bigger than the chunk size
+        come back as a single chunk with an end of None, i.e. the whole file.
+        '''
+        chunk_size = self._optional_params[LSC.CHUNK_SIZE]
+        size = os.path.getsize(log_file)
+        if chunk_size <= 0 or size <= chunk_size:
+            return [(log_file, 0, None)]
+
+        if self._is_gzip_file(log_file):
+            if not self._optional_params[LSC.GZIP_INDEX_PATH]:
+                return [(log_file, 0, None)]
+            ranges = self._get_gzip_index(log_file).ranges()
+            if len(ranges) == 1:
+                return [(log_file, 0, None)]
+            return [(log_file, start, end) for start, end in ranges]
+
+        return self._split_range(log_file, 0, size)
+
+    def _split_range(self, log_file, start, end):
+        '''
+        Splits the [start, end) byte range of an uncompressed file into
+        (log_file, start, end) chunks of about CHUNK_SIZE bytes,
+        or just the one chunk if chunking is turned off.
+        '''
+        if start >= end:
+            return []
+        chunk_size = self._optional_params[LSC.CHUNK_SIZE]
+        if not self._is_chunking_enabled() or end - start <= chunk_size:
+            return [(log_file, start, end)]
+        return [(log_file, chunk_start, min(chunk_start + chunk_size, end))
+                for chunk_start in xrange(start, end, chunk_size)]
+
+    @classmethod
+    def _split_remote_path(cls, remote_path):
+        '''Splits a remote file's box:path name into (box, path)'''
+        box, path = remote_path.split(':', 1)
+        return box, path
+
+    def _ssh_connection(self, box):
+        '''
+        Context manager that checks out the pooled SSH connection to box,
+        opening one if needed. Yields None if it can't connect.
+        '''
+        self._ssh_hosts.add(box)
+        return SSH_POOL.connection(box, self._open_ssh_connection,
+                                   self._optional_params[LSC.SSH_IDLE_TIMEOUT],
+                                   self._optional_params[LSC.MAX_CONNECTIONS])
+
+    def _start_file_metrics(self, regex_hits):
+        '''
+        If INSTRUMENT is set, adds empty metrics to a file's (or chunk's) result,
+        to be filled in while it's scanned, and wrapped up by _stop_file_metrics.
+        '''
+        if not self._optional_params[LSC.INSTRUMENT]:
+            return
+        # WALL_TIME and CPU_TIME are when the scan started, until _stop_file_metrics
+        self._compressed_read_time = None
+        regex_hits[LSC.METRICS] = {LSC.BYTES_READ : 0, LSC.LINES_READ : 0,
+                                   LSC.WALL_TIME : time.time(), LSC.CPU_TIME : self._get_cpu_time(),
+                                   LSC.READ_TIME : 0.0, LSC.DECOMPRESS_TIME : 0.0,
+                                   LSC.REGEXES : self._new_regex_metrics()}
+
+    def _stat_remote_file(self, remote_path):
+        '''Returns the SFTP stat of the box:path remote file, or None if it can't be had'''
+        box, path = self._split_remote_path(remote_path)
+        try:
+            with self._ssh_connection(box) as conn:
+                if conn is None:
+                    return None
+                return conn.sftp().stat(path)
+        except (IOError, OSError) as err:
+            LOGGER.error('Couldn\'t stat %s on %s. Error: %s', path, box, str(err))
+            return None
+
+    def _stop_file_metrics(self, regex_hits):
+        '''Wraps up the metrics in a file's (or chunk's) result, if it has any'''
+        metrics = regex_hits.get(LSC.METRICS)
+        if metrics is None:
+            return
+        metrics[LSC.WALL_TIME] = time.time() - metrics[LSC.WALL_TIME]
+        metrics[LSC.CPU_TIME] = self._get_cpu_time() - metrics[LSC.CPU_TIME]
+        if self._compressed_read_time is not None:
+            metrics[LSC.DECOMPRESS_TIME] = max(metrics[LSC.READ_TIME]
+                                               - self._compressed_read_time, 0.0)
+            self._compressed_read_time = None
+
+    def _sum_hits_by(self, results, keys):
+        '''
+        Adds up the per-file results for each key the files map to in keys,
+        e.g. the box or the day each file is for.
+        Returns a dict of key to {REGEXES : ...}, sorted by key, leaving out unmapped files.
+        '''
+        key_hits = {}
+        for result in results:
+            key = keys.get(result[LSC.FILENAME])
+            if key is None:
+                continue
+            if key not in key_hits:
+                key_hits[key] = {LSC.REGEXES : self._new_file_hits(None)[LSC.REGEXES]}
+            for regex_name, hits in result[LSC.REGEXES].items():
+                self._combine_hits(hits, key_hits[key][LSC.REGEXES][regex_name])
+        for hits in key_hits.values():
+            self._sort_group_hits(hits)
+        return collections.OrderedDict(sorted(key_hits.items()))
+
     @classmethod
     def _sum_group_matches(cls, group_sums, match, regex_group):
         '''
         Takes a regex match and a group value and populates the given dict
-        with counts for each unique value for the regex group in the match.
+        with counts for each unique value for the regex group in the match,
+        or adds the value to the group's aggregator if it has one.
         If the regex match fails, returns silently.
         '''
 
         try:
             key = match.group(regex_group)
-            if not key in group_sums:
+            if isinstance(group_sums, Aggregator):
+                group_sums.add(key)
+            elif not key in group_sums:
                 group_sums[key] = 1
             else:
                 group_sums[key] += 1
         except IndexError:
             return
 
+    def _terminate_pool(self):
+        '''Kills the scraper's worker pool without waiting for outstanding work'''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _time_lines(self, lines, regex_hits):
+        '''
+        Returns lines as they are, or, if regex_hits has metrics, wrapped
+        so that the lines read, their size and the time taken reading them are counted
+        '''
+        metrics = regex_hits.get(LSC.METRICS)
+        if metrics is None:
+            return lines
+        return self._gen_timed_lines(lines, metrics)
+
+    def _time_compressed_reads(self, handle):
+        '''
+        Returns the handle a gzipped file is read through as it is, or, if INSTRUMENT is set,
+        wrapped so that the time spent reading it (rather than decompressing it) is counted
+        '''
+        if not self._optional_params[LSC.INSTRUMENT]:
+            return handle
+        if self._compressed_read_time is None:
+            self._compressed_read_time = 0.0
+        return TimedReader(handle, self._add_compressed_read_time)
+
+    def _timestamp_fingerprint(self):
+        '''Returns what identifies how timestamps are extracted, for the timestamp indexes'''
+        return repr((type(self).__module__, type(self).__name__,
+                     self._optional_params[LSC.TIMESTAMP_REGEX],
+                     self._optional_params[LSC.TIMESTAMP_FORMAT]))
+
+    def _uses_default_scanning(self):
+        '''
+        Chunked scanning bypasses _process_file_for_aggregates and
+        _gen_lines/_get_file_handle, so it's only safe if none of them
+        have been overridden.
+        '''
+        for method_name in ['_process_file_for_aggregates', '_gen_lines', '_get_file_handle']:
+            if self._is_overridden(method_name):
+                return False
+        return True
+
     def _validate_file_list(self):
         '''Makes sure that there are files to process'''
 
@@ -822,12 +2521,50 @@ class LogScraper(object):
                                                'Please provide a valid path to a '
                                                'log file.'.format(self._user_params[LSC.FILENAME]))
             else:
+                level = self._user_params.get(LSC.LEVEL, None)
                 raise InvalidArgumentException(('No files found at {} on {}. '
                                                 'Please provide a valid path to a log file.'
                                                ).format(self._make_file_path(),
-                                                        'the current box'
-                                                        if not
-                                                        self._user_params.get(LSC.LEVEL, None)
-                                                        else
-                                                        self._get_box_from_level(self._user_params[LSC.LEVEL])))
+                                                        'the current box' if not level else
+                                                        ', '.join(self._get_boxes_from_level(level))))
+
+    def _validate_date_range(self):
+        '''Makes sure that DATE and END_DATE, if given, are dates in the right order'''
+        end_date = self._user_params.get(LSC.END_DATE, None)
+        if end_date is None:
+            return
+        log_date = self._user_params.get(LSC.DATE, None)
+        if log_date is None:
+            raise InvalidArgumentException('END_DATE needs a DATE to start from.')
+        try:
+            dates = self._get_dates()
+        except ValueError:
+            raise InvalidArgumentException('DATE {} and END_DATE {} should both look like '
+                                           'YYYYMMDD.'.format(log_date, end_date))
+        if not dates:
+            raise InvalidArgumentException('END_DATE {} is before DATE {}.'.format(end_date,
+                                                                                   log_date))
+
+    def _validate_timestamps(self):
+        '''
+        Makes sure that there's a way to tell the time of each line
+        if a time window is given or any regex is bucketed by time
+        '''
+        window = self._get_time_window()
+        is_bucketed = any(regex.get_bucket_size() for regex in self._regexes)
+        if window is None and not is_bucketed:
+            return
+        if self._timestamp_matcher is None and not self._is_overridden('_extract_timestamp'):
+            raise InvalidArgumentException('Time windows and buckets need a TIMESTAMP_REGEX '
+                                           'to find the timestamp on each line with.')
+        if is_bucketed and not self._optional_params[LSC.TIMESTAMP_FORMAT] \
+                and not self._is_overridden('_extract_timestamp'):
+            raise InvalidArgumentException('Time buckets need a TIMESTAMP_FORMAT to turn '
+                                           'timestamps into times with.')
+        if window is None:
+            return
+        for name, value in zip([LSC.START_TIME, LSC.END_TIME], window):
+            if value is None and self._user_params.get(name) is not None:
+                raise InvalidArgumentException('{} {} does not match the TIMESTAMP_FORMAT {}'.format(
+                    name, self._user_params[name], self._optional_params[LSC.TIMESTAMP_FORMAT]))
 
@@ -22,6 +22,8 @@ FORCE_COPY = 'force_copy'
 
 # Mapping of what level corresponds to what boxname, so that users can just say things like
 # --sandbox or --production.
+# A level can also map to a list of boxes, in which case files are listed, fetched and scanned
+# on all of them at once, and the results come with a per-box breakdown under HOST_HITS.
 
 LEVELS_TO_BOXES = 'levels_to_boxes'
 
@@ -33,18 +35,135 @@ LOCAL_COPY_LIFETIME = 'local_copy_lifetime'
 # Where to copy over any files grabbed over SSH
 TMP_PATH = 'tmp_path'
 
+# How many bytes the copies in TMP_PATH can take up. After copying, the least recently used
+# copies that aren't needed for the current run, and haven't been used in the last hour,
+# are deleted to get back under it.
+# Defaults to 0, which means copies are kept forever
+TMP_CACHE_SIZE = 'tmp_cache_size'
+
 # How many processors to use while doing multiprocessing on the files
 PROCESSOR_COUNT = 'processor_count'
 
+# Uncompressed files bigger than this many bytes are split into chunks of about this size,
+# which are then scanned in parallel. Defaults to 0, which means files are never split
+CHUNK_SIZE = 'chunk_size'
+
+# If this key is set to true, uncompressed files are memory-mapped and each regex is run over
+# big blocks of the file at once, instead of line by line. Only regexes that can't match across
+# a line break are run this way; if any regex can, the file is read line by line as usual
+USE_MMAP = 'use_mmap'
+
+# Directory to keep random-access indexes of gzipped files in. When set, gzipped files bigger
+# than CHUNK_SIZE get an index of restart points built for them (once, and rebuilt only if the
+# file changes), so that they can be split into chunks and scanned in parallel too.
+# Defaults to '', which means gzipped files are always scanned whole
+GZIP_INDEX_PATH = 'gzip_index_path'
+
+# Directory to keep per-file checkpoints in. When set, the scraper runs in incremental mode:
+# each uncompressed file's inode, size and last scanned offset are stored along with its
+# aggregates, and later runs only scan the bytes appended since, merging them into the stored
+# totals. Files that were truncated or rotated are rescanned from the start, and so is everything
+# if the regexes change. Only complete lines are scanned; a partial last line waits for the next run.
+# Defaults to '', which means every run scans every file in full
+CHECKPOINT_PATH = 'checkpoint_path'
+
+# Directory to cache the results of scanning archived files in. Archived files never change,
+# so their aggregates are stored keyed by the file's path, size and mtime and by the regexes run,
+# and repeated queries over the same archives are answered without rescanning them.
+# The files found for days before today are cached the same way, so that the days of a date
+# range (see END_DATE) that are already done are skipped on later runs. Remote files for those
+# days are keyed by their size and mtime on the box, and aren't copied over again if cached.
+# Defaults to '', which turns the cache off
+RESULT_CACHE_PATH = 'result_cache_path'
+
+# How many bytes the result cache can take up before the least recently used results are evicted.
+# Defaults to 256MB
+RESULT_CACHE_SIZE = 'result_cache_size'
+
+# Directory to keep listings of the archive directories in. When set, archived files are
+# looked up in a saved listing of their directory, indexed by the dates in the file names,
+# which is only redone when the directory's mtime changes, rather than globbing the
+# archive directory on every run. Defaults to '', which means the archives are always globbed
+ARCHIVE_MANIFEST_PATH = 'archive_manifest_path'
+
+# Whether to scan files on a remote level's box itself rather than copying them over first.
+# A small self-contained scanner is run there over SSH, and only the per-file results
+# come back. Needs python on the remote box. Defaults to False
+REMOTE_SCAN = 'remote_scan'
+
+# The python to run the remote scanner with. Defaults to 'python'
+REMOTE_PYTHON = 'remote_python'
+
+# How many seconds an SSH connection to a remote box can sit unused before it's closed.
+# Connections are kept open and reused for listing, copying and scanning files on a box,
+# rather than reconnecting for each file. Defaults to 300
+SSH_IDLE_TIMEOUT = 'ssh_idle_timeout'
+
+# The most SSH connections each process keeps open at once. Also how many boxes are listed,
+# or scanned with REMOTE_SCAN, at the same time. Defaults to 8
+MAX_CONNECTIONS = 'max_connections'
+
+# Whether to scan files on a remote level's boxes straight off SFTP, rather than copying them
+# to TMP_PATH first. Downloading and scanning then overlap, and nothing is written to local disk,
+# but the files are downloaded again on every run. Defaults to False
+STREAM_REMOTE = 'stream_remote'
+
+# Regex that finds the timestamp at the start of each line, for time windows (see START_TIME).
+# If it has a group named 'timestamp', that's the timestamp, otherwise the whole match is.
+# Lines without one are taken to be part of the line before. Defaults to ''
+TIMESTAMP_REGEX = 'timestamp_regex'
+
+# strptime format to parse the timestamps found by TIMESTAMP_REGEX with. Defaults to '',
+# which means the timestamps are compared as strings, which works for e.g. ISO 8601 ones
+TIMESTAMP_FORMAT = 'timestamp_format'
+
+# Directory to keep timestamp indexes in. When set, each file scanned for a time window gets a
+# sparse index of where in it each point in time is, built the first time and topped up as the
+# file grows, so that only the part of the file the window covers has to be read.
+# Gzipped files need GZIP_INDEX_PATH set as well to be seeked into.
+# Defaults to '', which means files are always read whole and each line's timestamp checked
+TIMESTAMP_INDEX_PATH = 'timestamp_index_path'
+
+# How many lines apart the entries in a timestamp index are. Defaults to 10000
+TIMESTAMP_INDEX_SPACING = 'timestamp_index_spacing'
+
+# If this key is set to True, scans are timed: each file's result gets a METRICS block with how
+# much of it was read and how long that took, and how often each regex was run on it, how often
+# it matched and how long that took. get_log_data's result also gets a METRICS block with all the
+# files' metrics, the totals for each regex, and how long was spent copying files over and merging
+# results. The metrics are also passed to _emit_metrics, which can be overridden to forward them
+# elsewhere, and can be got from get_metrics() after a run. Timing every regex run slows scans down
+# somewhat. Defaults to False
+INSTRUMENT = 'instrument'
+
 # Defaults
 OPTIONAL_PARAMS = {DAYS_BEFORE_ARCHIVING : 0, FILENAME_REGEX : '',
                    LEVELS_TO_BOXES : {}, LOCAL_COPY_LIFETIME : 0,
                    TMP_PATH : '', PROCESSOR_COUNT : 4,
-                   FORCE_COPY : False}
+                   FORCE_COPY : False, CHUNK_SIZE : 0, USE_MMAP : False,
+                   GZIP_INDEX_PATH : '', CHECKPOINT_PATH : '',
+                   RESULT_CACHE_PATH : '', RESULT_CACHE_SIZE : 256 * 1024 * 1024,
+                   REMOTE_SCAN : False, REMOTE_PYTHON : 'python', SSH_IDLE_TIMEOUT : 300,
+                   MAX_CONNECTIONS : 8, STREAM_REMOTE : False, TMP_CACHE_SIZE : 0,
+                   TIMESTAMP_REGEX : '', TIMESTAMP_FORMAT : '', TIMESTAMP_INDEX_PATH : '',
+                   TIMESTAMP_INDEX_SPACING : 10000, ARCHIVE_MANIFEST_PATH : '',
+                   INSTRUMENT : False}
 
 # Misc useful params you could query the user for
 DATE = 'date'
 
+# Look at every day from DATE up to and including END_DATE, rather than just DATE.
+# Each day's files are found wherever they live for that day (on the level's boxes,
+# or in the archives), scanned all together, and broken down per day under DAY_HITS
+END_DATE = 'end_date'
+
+# Only look at the lines logged in [START_TIME, END_TIME). Either can be left out for no limit.
+# Can be datetimes, or strings in the TIMESTAMP_FORMAT. Needs TIMESTAMP_REGEX to be set,
+# or _extract_timestamp to be overridden. Not supported by REMOTE_SCAN, so the files are
+# copied over instead.
+START_TIME = 'start_time'
+END_TIME = 'end_time'
+
 # Runs logger in debug mode
 DEBUG = 'debug'
 
@@ -53,6 +172,12 @@ FILENAME = 'filename'
 
 FILE_HITS = 'file_hits'
 
+# Per-box results, when a level maps to more than one box
+HOST_HITS = 'host_hits'
+
+# Per-day results, when there's more than one day
+DAY_HITS = 'day_hits'
+
 # What production level box to look on
 LEVEL = 'level'
 
@@ -63,8 +188,30 @@ PRINT_STATS = 'print_stats'
 REGEXES = 'regexes'
 MATCHES = 'matches'
 GROUP_HITS = 'group_hits'
+# Per time bucket counts, for regexes with a bucket_size: BucketedCounters for the total hits
+# and for each named group, keyed by TOTAL_HITS and the group names
+BUCKET_HITS = 'bucket_hits'
 TOTAL_HITS = 'total_hits'
 
+# Performance metrics, when INSTRUMENT is set. Each file's have BYTES_READ and LINES_READ,
+# WALL_TIME and CPU_TIME spent scanning it, READ_TIME spent reading its lines, DECOMPRESS_TIME
+# (the part of READ_TIME that wasn't spent reading the compressed data, for gzipped files) and,
+# under REGEXES, the EVALUATIONS, TOTAL_HITS and MATCH_TIME for each regex.
+# The run's have those for each file under FILE_HITS, the totals for each regex under REGEXES,
+# and the WALL_TIME of the whole run, the COPY_TIME spent copying remote files over and the
+# MERGE_TIME spent merging the files' results. All times are in seconds.
+METRICS = 'metrics'
+BYTES_READ = 'bytes_read'
+LINES_READ = 'lines_read'
+WALL_TIME = 'wall_time'
+CPU_TIME = 'cpu_time'
+READ_TIME = 'read_time'
+DECOMPRESS_TIME = 'decompress_time'
+EVALUATIONS = 'evaluations'
+MATCH_TIME = 'match_time'
+COPY_TIME = 'copy_time'
+MERGE_TIME = 'merge_time'
+
 # Stats dict
 MAX_KEY = 'max_key'
 MIN_KEY = 'min_key'
@@ -0,0 +1,265 @@
+'''
+Random access into gzip files, in the style of zlib's zran example.
+
+A gzip file can normally only be read from the start. GzipIndex makes one
+sequential pass over the file and records checkpoints that decompression can
+be restarted from:
+  * the start of every gzip member, which needs nothing but the offset
+  * every byte-aligned flush point (an empty stored block, 00 00 ff ff),
+    which also needs the last 32K of uncompressed data as the window
+Python's zlib can't prime an inflater at an arbitrary bit offset, so unlike
+zran proper, only these byte-aligned points can be used. Files written with
+periodic flushes (gzip --rsyncable, pigz, bgzip, or concatenated members)
+get plenty of checkpoints; a plain single-stream gzip only gets the first one.
+
+Checkpoints are kept at least `spacing` uncompressed bytes apart, and the index
+is saved to a sidecar file so that it only has to be built once per archive.
+It gets rebuilt if the archive's size or mtime change.
+'''
+
+import cPickle
+import hashlib
+import os
+import struct
+import zlib
+
+from log_scraper.streams import StreamReader
+
+GZIP_MAGIC = '\x1f\x8b'
+WINDOW_SIZE = 32 * 1024
+READ_SIZE = 1024 * 1024
+
+# How much compressed data to decompress both ways when checking a flush point candidate
+_PROBE_SIZE = 16 * 1024
+_SYNC_MARKER = '\x00\x00\xff\xff'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_TRAILER_SIZE = 8
+_INDEX_VERSION = 1
+
+def _primed_inflater(window):
+    '''
+    Returns a raw inflater that has already seen window as its history,
+    by feeding it a stored block holding the window and throwing away the output.
+    '''
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    if window:
+        inflater.decompress('\x00' + struct.pack('<HH', len(window), len(window) ^ 0xffff)
+                            + window)
+    return inflater
+
+def _last_window(window, data):
+    '''Returns the last WINDOW_SIZE bytes of window + data'''
+    if len(data) >= WINDOW_SIZE:
+        return data[-WINDOW_SIZE:]
+    return (window + data)[-WINDOW_SIZE:]
+
+def gen_gzip_data(handle, window=None):
+    '''
+    Generator that decompresses everything from the current position of handle
+    to the end of the file, across gzip members, yielding the uncompressed data.
+    If window is None, handle has to be at the start of a gzip member. Otherwise
+    it has to be at a flush point, with window the uncompressed data before it.
+    Stops quietly at anything after the last member that isn't another member
+    (e.g. zero padding).
+    '''
+    raw = window is not None
+    inflater = _primed_inflater(window) if raw else None
+    pending = ''
+    skip = 0
+    while True:
+        if not pending or (inflater is None and len(pending) < 2):
+            data = handle.read(READ_SIZE)
+            if not data:
+                break
+            pending += data
+            continue
+        if skip:
+            dropped = min(skip, len(pending))
+            pending = pending[dropped:]
+            skip -= dropped
+            continue
+        if inflater is None:
+            if pending[:2] != GZIP_MAGIC:
+                break
+            inflater = zlib.decompressobj(_GZIP_WBITS)
+
+        data = inflater.decompress(pending)
+        if data:
+            yield data
+        pending = inflater.unused_data
+        if pending:
+            # The stream ended. A raw stream is still followed by the gzip trailer.
+            if raw:
+                skip = _TRAILER_SIZE
+                raw = False
+            inflater = None
+
+    if inflater is not None:
+        data = inflater.flush()
+        if data:
+            yield data
+
+
+class IndexedGzipReader(StreamReader):
+    '''
+    Read-only file-like object over the uncompressed data of a gzip file,
+    starting at some uncompressed offset. Supports readline(), iteration and tell().
+    prev_char is the uncompressed character just before the starting offset,
+    or an empty string at the start of the file.
+    '''
+
+    def __init__(self, handle, offset, window, prev_char):
+        super(IndexedGzipReader, self).__init__(gen_gzip_data(handle, window), offset,
+                                                on_close=handle.close)
+        self.prev_char = prev_char
+
+    def skip(self, size):
+        '''Skips forward size bytes, keeping track of the last character skipped'''
+        while size > 0:
+            data = self.read(min(size, READ_SIZE))
+            if not data:
+                break
+            self.prev_char = data[-1]
+            size -= len(data)
+
+
+class GzipIndex(object):
+    '''
+    List of checkpoints into a gzip file. Each checkpoint is a tuple of
+    (compressed_offset, uncompressed_offset, window, prev_char), where window
+    is None at the start of a gzip member. See the module docs.
+    '''
+
+    def __init__(self, path, size, mtime, spacing, checkpoints, uncompressed_size):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.spacing = spacing
+        self.checkpoints = checkpoints
+        self.uncompressed_size = uncompressed_size
+
+    @classmethod
+    def build(cls, path, spacing):
+        '''Builds the index for the gzip file at path with one pass over the file'''
+        stat = os.stat(path)
+        checkpoints = [(0, 0, None, '')]
+        uncompressed_size = 0
+        window = ''
+        inflater = zlib.decompressobj(_GZIP_WBITS)
+
+        with open(path, 'rb') as handle, open(path, 'rb') as probe_handle:
+            offset = 0
+            while True:
+                data = handle.read(READ_SIZE)
+                if not data:
+                    break
+                position = 0
+                while position < len(data):
+                    if inflater is None:
+                        # Start of a new member, unless it's trailing junk
+                        if data[position:position + 2] not in (GZIP_MAGIC, GZIP_MAGIC[0]):
+                            return cls(path, stat.st_size, stat.st_mtime, spacing,
+                                       checkpoints, uncompressed_size)
+                        if uncompressed_size - checkpoints[-1][1] >= spacing:
+                            checkpoints.append((offset + position, uncompressed_size,
+                                                None, window[-1:]))
+                        inflater = zlib.decompressobj(_GZIP_WBITS)
+
+                    marker = data.find(_SYNC_MARKER, position)
+                    cut = len(data) if marker == -1 else marker + len(_SYNC_MARKER)
+                    out = inflater.decompress(data[position:cut])
+                    uncompressed_size += len(out)
+                    window = _last_window(window, out)
+
+                    unused = inflater.unused_data
+                    if unused:
+                        position = cut - len(unused)
+                        inflater = None
+                        continue
+                    position = cut
+
+                    if marker != -1 and uncompressed_size - checkpoints[-1][1] >= spacing:
+                        probe_handle.seek(offset + cut)
+                        probe = probe_handle.read(_PROBE_SIZE)
+                        expected = inflater.copy().decompress(probe)
+                        if expected and _primed_inflater(window).decompress(probe) == expected:
+                            checkpoints.append((offset + cut, uncompressed_size,
+                                                window, window[-1:]))
+                offset += len(data)
+
+        return cls(path, stat.st_size, stat.st_mtime, spacing, checkpoints, uncompressed_size)
+
+    @classmethod
+    def get(cls, path, index_dir, spacing):
+        '''
+        Returns the index for the gzip file at path,
+        loading it from index_dir if it's still valid, or building and saving it otherwise.
+        '''
+        index_path = cls.index_path(path, index_dir)
+        index = cls.load(index_path)
+        stat = os.stat(path)
+        if (index is None or index.size != stat.st_size or index.mtime != stat.st_mtime
+                or index.spacing != spacing):
+            index = cls.build(path, spacing)
+            index.save(index_path)
+        return index
+
+    @classmethod
+    def index_path(cls, path, index_dir):
+        '''Where the sidecar index for the file at path lives'''
+        digest = hashlib.sha1(os.path.abspath(path)).hexdigest()[:16]
+        return os.path.join(index_dir, '{}.{}.gzidx'.format(os.path.basename(path), digest))
+
+    @classmethod
+    def load(cls, index_path):
+        '''Loads a saved index. Returns None if there isn't a readable one.'''
+        try:
+            with open(index_path, 'rb') as handle:
+                state = cPickle.load(handle)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if state.get('version') != _INDEX_VERSION:
+            return None
+        checkpoints = [(comp, uncomp, None if window is None else zlib.decompress(window), prev)
+                       for comp, uncomp, window, prev in state['checkpoints']]
+        return cls(state['path'], state['size'], state['mtime'], state['spacing'],
+                   checkpoints, state['uncompressed_size'])
+
+    def open_at(self, offset, handle=None):
+        '''
+        Returns an IndexedGzipReader positioned at the given uncompressed offset,
+        having decompressed only from the closest checkpoint before it.
+        handle, if given, is an open handle on the file to read it through,
+        which the reader closes when it's closed.
+        '''
+        checkpoint = self.checkpoints[0]
+        for candidate in self.checkpoints:
+            if candidate[1] > offset:
+                break
+            checkpoint = candidate
+        compressed_offset, uncompressed_offset, window, prev_char = checkpoint
+
+        if handle is None:
+            handle = open(self.path, 'rb')
+        handle.seek(compressed_offset)
+        reader = IndexedGzipReader(handle, uncompressed_offset, window, prev_char)
+        reader.skip(offset - uncompressed_offset)
+        return reader
+
+    def ranges(self):
+        '''Returns the (start, end) uncompressed byte ranges between the checkpoints'''
+        starts = [checkpoint[1] for checkpoint in self.checkpoints]
+        return zip(starts, starts[1:] + [self.uncompressed_size])
+
+    def save(self, index_path):
+        '''Writes the index out to index_path, atomically'''
+        state = {'version' : _INDEX_VERSION, 'path' : self.path, 'size' : self.size,
+                 'mtime' : self.mtime, 'spacing' : self.spacing,
+                 'uncompressed_size' : self.uncompressed_size,
+                 'checkpoints' : [(comp, uncomp, None if window is None else zlib.compress(window),
+                                   prev)
+                                  for comp, uncomp, window, prev in self.checkpoints]}
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        with open(tmp_path, 'wb') as handle:
+            cPickle.dump(state, handle, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, index_path)
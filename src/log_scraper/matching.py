@@ -0,0 +1,293 @@
+'''
+Helpers for running a set of regexes over lines as cheaply as possible.
+
+The scraper runs every registered regex with match(), i.e. anchored at the start
+of the line. Most patterns start with some fixed text, so instead of running
+every regex on every line, the RegexDispatcher buckets the regexes by the first
+character of their leading literal and only hands back the regexes that could
+possibly match a given line.
+
+Regexes can also be declared mutually exclusive, so that once one of them has
+matched a line the others don't need to be run on it. The RegexPlanner works
+out which order to run those in from how they do on a sample of lines.
+'''
+
+import sre_constants
+import sre_parse
+
+_START_ANCHORS = (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING)
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+def _codes_to_literal(codes):
+    '''
+    Turns a list of character codes into a string.
+    Stops at the first non-ascii character, so that the literal can be compared
+    against both str and unicode lines without any decoding surprises.
+    '''
+    chars = []
+    for code in codes:
+        if code > 127:
+            break
+        chars.append(chr(code))
+    return ''.join(chars)
+
+def _leading_codes(items):
+    '''
+    Walks the parsed pattern and collects the character codes that
+    any match must start with.
+    Returns a tuple of (codes, complete), where complete is True if the
+    whole of items was a literal, so that the caller can keep going.
+    '''
+    codes = []
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL:
+            codes.append(arg)
+        elif opcode == sre_constants.AT and arg in _START_ANCHORS and not codes:
+            continue
+        elif opcode == sre_constants.SUBPATTERN:
+            sub_codes, complete = _leading_codes(arg[-1])
+            codes.extend(sub_codes)
+            if not complete:
+                return codes, False
+        elif opcode in _REPEATS:
+            min_count, _, sub_items = arg
+            if min_count >= 1:
+                codes.extend(_leading_codes(sub_items)[0])
+            return codes, False
+        else:
+            return codes, False
+    return codes, True
+
+def leading_literal(pattern):
+    '''
+    Returns the literal text that any match() of the pattern has to start with,
+    or an empty string if there is none (or if it can't be worked out safely,
+    e.g. for case-insensitive patterns).
+    '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return ''
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ''
+    return _codes_to_literal(_leading_codes(parsed)[0])
+
+def _required_runs(items, runs, current):
+    '''
+    Walks the parsed pattern and appends to runs every run of consecutive
+    character codes that any match has to contain.
+    current is the run being built up; the (possibly new) current run is returned
+    so that literals spread over consecutive groups join up.
+    '''
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL:
+            current.append(arg)
+        elif opcode == sre_constants.SUBPATTERN:
+            current = _required_runs(arg[-1], runs, current)
+        else:
+            runs.append(current)
+            current = []
+            if opcode in _REPEATS and arg[0] >= 1:
+                runs.append(_required_runs(arg[2], runs, []))
+    return current
+
+def required_literals(pattern):
+    '''
+    Returns all the literal strings that any match of the pattern has to contain,
+    longest first. Empty if there are none or they can't be worked out safely.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return []
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return []
+    runs = []
+    runs.append(_required_runs(parsed, runs, []))
+    literals = set(_codes_to_literal(run) for run in runs)
+    literals.discard('')
+    return sorted(literals, key=lambda literal: (-len(literal), literal))
+
+_NEWLINE = ord('\n')
+_NEWLINE_CATEGORIES = (sre_constants.CATEGORY_NOT_DIGIT, sre_constants.CATEGORY_SPACE,
+                       sre_constants.CATEGORY_NOT_WORD, sre_constants.CATEGORY_LINEBREAK)
+_SAFE_CATEGORIES = (sre_constants.CATEGORY_DIGIT, sre_constants.CATEGORY_NOT_SPACE,
+                    sre_constants.CATEGORY_WORD, sre_constants.CATEGORY_NOT_LINEBREAK)
+
+def _set_has_newline(items):
+    '''Whether the character set (the argument of an IN opcode) can match a newline'''
+    negated = False
+    contains = False
+    for opcode, arg in items:
+        if opcode == sre_constants.NEGATE:
+            negated = True
+        elif opcode == sre_constants.LITERAL:
+            contains = contains or arg == _NEWLINE
+        elif opcode == sre_constants.RANGE:
+            contains = contains or arg[0] <= _NEWLINE <= arg[1]
+        elif opcode == sre_constants.CATEGORY and arg in _NEWLINE_CATEGORIES:
+            contains = True
+        elif opcode != sre_constants.CATEGORY or arg not in _SAFE_CATEGORIES:
+            return True
+    return contains != negated
+
+def _can_cross_lines(items, flags):
+    '''
+    Whether the parsed pattern can match a newline or otherwise look beyond
+    the line it's matched on. Anything that isn't understood counts as a yes.
+    '''
+    for opcode, arg in items:
+        if opcode == sre_constants.LITERAL:
+            unsafe = arg == _NEWLINE
+        elif opcode == sre_constants.NOT_LITERAL:
+            unsafe = arg != _NEWLINE
+        elif opcode == sre_constants.ANY:
+            unsafe = bool(flags & sre_constants.SRE_FLAG_DOTALL)
+        elif opcode == sre_constants.IN:
+            unsafe = _set_has_newline(arg)
+        elif opcode == sre_constants.AT:
+            unsafe = arg in (sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END_STRING)
+        elif opcode == sre_constants.GROUPREF:
+            unsafe = False
+        elif opcode == sre_constants.SUBPATTERN:
+            unsafe = _can_cross_lines(arg[-1], flags)
+        elif opcode in _REPEATS:
+            unsafe = _can_cross_lines(arg[2], flags)
+        elif opcode == sre_constants.BRANCH:
+            unsafe = any(_can_cross_lines(branch, flags) for branch in arg[1])
+        elif opcode in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            unsafe = arg[0] < 0 or _can_cross_lines(arg[1], flags)
+        elif opcode == sre_constants.GROUPREF_EXISTS:
+            unsafe = any(_can_cross_lines(branch, flags) for branch in arg[1:] if branch)
+        else:
+            unsafe = True
+        if unsafe:
+            return True
+    return False
+
+def is_line_bound(pattern):
+    '''
+    Returns True if a match of the pattern can never include a newline,
+    look behind its starting point or depend on the start/end of the whole string.
+    For such patterns, finditer over a whole buffer of lines in MULTILINE mode,
+    anchored with ^, finds exactly the lines that match() would.
+    '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return False
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_VERBOSE:
+        return False
+    return not _can_cross_lines(parsed, parsed.pattern.flags)
+
+
+class RegexDispatcher(object):
+    '''
+    Buckets regexes by the first character of their leading literal.
+    candidates() returns, in the order the regexes were given in, (regex, prefix) pairs for
+    all regexes that could match the given line. Regexes with no leading
+    literal are always candidates and come back with an empty prefix.
+    The caller still has to check line.startswith(prefix) for a non-empty
+    prefix before running the regex; the table only narrows on the first char.
+    '''
+
+    def __init__(self, regexes):
+        self._always = []
+        buckets = {}
+        for index, regex in enumerate(regexes):
+            prefix = regex.get_leading_literal()
+            if prefix:
+                buckets.setdefault(prefix[0], []).append((index, regex, prefix))
+            else:
+                self._always.append((index, regex, ''))
+
+        self._table = {}
+        for first_char, entries in buckets.items():
+            merged = sorted(entries + self._always, key=lambda entry: entry[0])
+            self._table[first_char] = [(regex, prefix) for _, regex, prefix in merged]
+        self._always = [(regex, prefix) for _, regex, prefix in self._always]
+
+    def candidates(self, line):
+        '''Returns the (regex, prefix) pairs worth running on line'''
+        return self._table.get(line[:1], self._always)
+
+
+class RegexPlanner(object):
+    '''
+    Works out the order to run regexes in from how they did on a sample of lines.
+    Call new_line() for each sample line, and observe() for each regex run on it.
+
+    Regexes that aren't in an exclusive group have to be run on every line anyway,
+    so they're kept in the order given, ahead of the exclusive ones. Within a group,
+    each hit saves running the rest of it, so running them in increasing order of
+    cost / hits (the time all their runs took over the number of lines they matched)
+    minimizes the expected work per line. Ones that never hit go last, cheapest first.
+    A group with two regexes that matched the same sample line isn't really exclusive,
+    so it's run in full.
+    '''
+
+    def __init__(self, regexes):
+        self._regexes = regexes
+        self._costs = dict((regex.name, 0.0) for regex in regexes)
+        self._hits = dict((regex.name, 0) for regex in regexes)
+        self._line_groups = set()
+        self._overlapping = set()
+
+    def _rank(self, regex):
+        '''Sort key for the regexes in an exclusive group: the best bets first'''
+        hits = self._hits[regex.name]
+        if not hits:
+            return (1, self._costs[regex.name])
+        return (0, self._costs[regex.name] / hits)
+
+    def get_overlapping_groups(self):
+        '''Returns the exclusive groups that had more than one regex match the same line'''
+        return sorted(self._overlapping)
+
+    def new_line(self):
+        '''Starts on the next sample line'''
+        self._line_groups = set()
+
+    def observe(self, regex, hit, elapsed):
+        '''Records that running regex on the current line took elapsed seconds, and whether it hit'''
+        self._costs[regex.name] += elapsed
+        if not hit:
+            return
+        self._hits[regex.name] += 1
+        group = regex.get_exclusive_group()
+        if group is not None:
+            if group in self._line_groups:
+                self._overlapping.add(group)
+            self._line_groups.add(group)
+
+    def plan(self):
+        '''
+        Returns (regexes, exclusive): the regexes in the order to run them in, and a dict
+        of regex name to exclusive group, for the groups that can be cut short after a hit.
+        '''
+        ungrouped = [regex for regex in self._regexes if regex.get_exclusive_group() is None]
+        grouped = sorted([regex for regex in self._regexes
+                          if regex.get_exclusive_group() is not None], key=self._rank)
+        exclusive = dict((regex.name, regex.get_exclusive_group()) for regex in grouped
+                         if regex.get_exclusive_group() not in self._overlapping)
+        return ungrouped + grouped, exclusive
+
+
+class MatchRecorder(object):
+    '''
+    Stands in for a regex, keeping the last match it made in last_match,
+    so that whoever ran it can reuse the match rather than run the regex again.
+    Everything but match() is passed straight through to the regex.
+    '''
+
+    def __init__(self, regex):
+        self._regex = regex
+        self.last_match = None
+
+    def __getattr__(self, name):
+        return getattr(self._regex, name)
+
+    def match(self, line):
+        '''Runs the regex on line, and keeps the match'''
+        self.last_match = self._regex.match(line)
+        return self.last_match
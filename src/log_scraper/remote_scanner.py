@@ -0,0 +1,121 @@
+'''
+Self-contained scanner that LogScraper runs on a remote box in REMOTE_SCAN mode,
+so that only the results come back over SSH instead of the whole log files.
+
+It gets sent over as source and run with whatever python the box has (2.6+ or 3),
+so it can only use the standard library and must not import anything from log_scraper.
+
+Reads a JSON request from stdin:
+    {"files": [path, ...], "regexes": [[pattern, required_literal], ...],
+     "mode": "aggregates" or "matches", "processes": how many files to scan at once}
+and writes out one JSON line per file as soon as it's done, with one entry
+per regex, in the order they were given in:
+    {"filename": path, "regexes": [{"total_hits": n, "group_hits": {group: [[value, count]]}}]}
+    {"filename": path, "regexes": [{"matches": [line, ...]}]}
+or {"filename": path, "error": message} if the file couldn't be scanned.
+Regexes are run on raw bytes, just like LogScraper does, and all text is sent
+as latin-1 decoded bytes so that it survives JSON whatever the logs' encoding.
+'''
+
+import gzip
+import json
+import multiprocessing
+import re
+import sys
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+def _to_bytes(text):
+    '''Turns latin-1 decoded text back into the original bytes'''
+    if isinstance(text, bytes):
+        return text
+    return text.encode('latin-1')
+
+def _to_text(data):
+    '''Decodes bytes as latin-1 so that they can go into JSON'''
+    if data is None:
+        return None
+    return data.decode('latin-1')
+
+def _open(path):
+    '''Opens the file for reading bytes, decompressing it if it's gzipped'''
+    with open(path, 'rb') as handle:
+        magic = handle.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _scan_for_aggregates(handle, regexes):
+    '''Counts the hits for each regex, and for each value of each of its named groups'''
+    totals = [0] * len(regexes)
+    groups = [dict((group, {}) for group in matcher.groupindex) for matcher, _ in regexes]
+    for line in handle:
+        for index, (matcher, literal) in enumerate(regexes):
+            if literal and literal not in line:
+                continue
+            match = matcher.match(line)
+            if match is None:
+                continue
+            totals[index] += 1
+            for group, counts in groups[index].items():
+                value = match.group(group)
+                counts[value] = counts.get(value, 0) + 1
+
+    return [{'total_hits' : total,
+             'group_hits' : dict((group, [[_to_text(value), count]
+                                          for value, count in counts.items()])
+                                 for group, counts in group_counts.items())}
+            for total, group_counts in zip(totals, groups)]
+
+def _scan_for_matches(handle, regexes):
+    '''Collects the lines that match each regex'''
+    matches = [[] for _ in regexes]
+    for line in handle:
+        for index, (matcher, literal) in enumerate(regexes):
+            if literal and literal not in line:
+                continue
+            if matcher.match(line) is not None:
+                matches[index].append(_to_text(line))
+    return [{'matches' : lines} for lines in matches]
+
+def _scan(job):
+    '''Scans one file. job is a tuple of (path, regexes, mode) from the request.'''
+    path, regexes, mode = job
+    regexes = [(re.compile(_to_bytes(pattern)), _to_bytes(literal))
+               for pattern, literal in regexes]
+    try:
+        handle = _open(path)
+        try:
+            if mode == 'matches':
+                hits = _scan_for_matches(handle, regexes)
+            else:
+                hits = _scan_for_aggregates(handle, regexes)
+        finally:
+            handle.close()
+    except (IOError, OSError):
+        return {'filename' : path, 'error' : str(sys.exc_info()[1])}
+    return {'filename' : path, 'regexes' : hits}
+
+def main():
+    '''Reads the request from stdin and writes the results to stdout as they're done'''
+    request = json.loads(sys.stdin.read())
+    jobs = [(path, request['regexes'], request['mode']) for path in request['files']]
+    processes = max(1, min(request.get('processes', 1), len(jobs)))
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_scan, jobs)
+    else:
+        results = (_scan(job) for job in jobs)
+
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
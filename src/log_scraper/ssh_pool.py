@@ -0,0 +1,153 @@
+'''
+A pool of SSH connections, one per host, so that listing, copying and scanning
+remote files don't pay for a fresh connect, key exchange and auth every time.
+
+Connections can't be shared between processes, so the pool keeps track of the
+process it was filled in. A worker forked from the parent (e.g. by multiprocessing)
+starts off with an empty pool of its own and keeps its connections for as long as
+it lives, across all the files it gets handed. Within a process, each connection
+is only used by one thread at a time.
+
+Connections that have been idle for longer than the idle timeout are closed
+the next time the pool is used, and dead ones are replaced. If the pool is
+given a limit on how many connections it can keep open, the least recently
+used idle ones are closed to make room for new ones. Connections are only ever
+closed while nobody has them checked out.
+'''
+
+import contextlib
+import os
+import threading
+import time
+
+class PooledConnection(object):
+    '''An SSH client along with the SFTP session opened on it, if any'''
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        self._sftp = None
+
+    def close(self):
+        '''Closes the SFTP session and the connection'''
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
+    def is_active(self):
+        '''Whether the connection is still up'''
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def sftp(self):
+        '''Returns the connection's SFTP session, opening it the first time'''
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
+        return self._sftp
+
+
+class SSHConnectionPool(object):
+    '''Keeps one open connection per host around for reuse. See the module docs.'''
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def _check_process(self):
+        '''Forgets any connections inherited from the parent process'''
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._connections = {}
+
+    def _close_idle(self, idle_timeout):
+        '''Closes the connections nobody has used in idle_timeout seconds'''
+        cutoff = time.time() - idle_timeout
+        for host, conn in self._connections.items():
+            if conn.last_used < cutoff and conn.lock.acquire(False):
+                try:
+                    del self._connections[host]
+                    conn.close()
+                finally:
+                    conn.lock.release()
+
+    def _close_least_recent(self, max_open):
+        '''Closes the least recently used idle connections until there are at most max_open'''
+        for host, conn in sorted(self._connections.items(), key=lambda item: item[1].last_used):
+            if len(self._connections) <= max_open:
+                return
+            if conn.ssh is not None and conn.lock.acquire(False):
+                try:
+                    del self._connections[host]
+                    conn.close()
+                finally:
+                    conn.lock.release()
+
+    def close(self, hosts=None):
+        '''
+        Closes the connections to hosts, or every connection in the pool if hosts is None.
+        Connections that are checked out are left to be closed once they've gone idle.
+        '''
+        self._check_process()
+        with self._lock:
+            for host, conn in self._connections.items():
+                if hosts is not None and host not in hosts:
+                    continue
+                if conn.lock.acquire(False):
+                    try:
+                        del self._connections[host]
+                        conn.close()
+                    finally:
+                        conn.lock.release()
+
+    @contextlib.contextmanager
+    def connection(self, host, connect, idle_timeout, max_open=None):
+        '''
+        Context manager that checks out the PooledConnection for host,
+        calling connect(host) to open a new SSH client if there isn't a live one.
+        Yields None if connect does. If the connection dies while it's checked out,
+        it's dropped from the pool.
+        '''
+        self._check_process()
+        while True:
+            with self._lock:
+                self._close_idle(idle_timeout)
+                conn = self._connections.get(host)
+                if conn is None:
+                    if max_open is not None:
+                        self._close_least_recent(max_open - 1)
+                    conn = self._connections[host] = PooledConnection(None)
+            conn.lock.acquire()
+            # It could have been closed and dropped from the pool while we waited for it
+            with self._lock:
+                if self._connections.get(host) is conn:
+                    break
+            conn.lock.release()
+
+        try:
+            if conn.ssh is None or not conn.is_active():
+                conn.close()
+                conn.ssh = connect(host)
+            if conn.ssh is None:
+                with self._lock:
+                    if self._connections.get(host) is conn:
+                        del self._connections[host]
+                yield None
+                return
+
+            try:
+                yield conn
+            finally:
+                conn.last_used = time.time()
+                if not conn.is_active():
+                    with self._lock:
+                        if self._connections.get(host) is conn:
+                            del self._connections[host]
+                    conn.close()
+        finally:
+            conn.lock.release()
@@ -0,0 +1,109 @@
+'''
+A simple on-disk key-value store: one pickle file per key in a directory.
+Writes go to a temporary file first and are renamed into place,
+so readers never see a half-written entry, even if the writer crashes.
+If the store is given a maximum size, the least recently used entries
+(going by their mtime, which every get() bumps) are evicted to stay under it.
+Also has a helper for locking files between processes.
+'''
+
+import contextlib
+import cPickle
+import hashlib
+import os
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+@contextlib.contextmanager
+def locked(path, blocking=True):
+    '''
+    Context manager that holds an exclusive lock on the file at path,
+    creating it if needed, so that processes on the same box can take turns.
+    Yields whether the lock was taken, which it always is if blocking.
+    Locking is skipped where fcntl isn't available.
+    '''
+    with open(path, 'a') as handle:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+class FileStore(object):
+    '''Directory-backed store of picklable values, keyed by strings'''
+
+    SUFFIX = '.pkl'
+
+    def __init__(self, directory, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _evict(self):
+        '''Removes the least recently used entries until the store fits in max_size'''
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def _path(self, key):
+        '''Where the entry for key lives'''
+        return os.path.join(self._directory, hashlib.sha1(key).hexdigest() + self.SUFFIX)
+
+    def delete(self, key):
+        '''Removes the entry for key, if there is one'''
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        '''Returns the value stored for key, or None if there isn't a readable one'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as handle:
+                value = cPickle.load(handle)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if self._max_size is not None:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return value
+
+    def put(self, key, value):
+        '''Stores value for key, atomically'''
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as handle:
+            cPickle.dump(value, handle, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        if self._max_size is not None:
+            self._evict()
@@ -0,0 +1,152 @@
+'''
+File-like readers over streams of data that can't be seeked cheaply,
+such as decompressed gzip data or a file being read over SFTP.
+'''
+
+import time
+
+# How much of a remote file is requested at once. The requests for a window
+# are all sent before waiting on any of the replies, so that reading
+# isn't held up by a round trip per request.
+SFTP_REQUEST_SIZE = 32 * 1024
+SFTP_WINDOW_SIZE = 8 * 1024 * 1024
+
+class StreamReader(object):
+    '''
+    Read-only file-like object over an iterator of data, starting at the given offset.
+    Supports read(), readline(), peek(), iteration and tell().
+    on_close is called the first time the reader is closed,
+    e.g. to close whatever the data is being read from.
+    '''
+
+    def __init__(self, data, offset=0, on_close=None):
+        self._data = data
+        self._on_close = on_close
+        # Lines are read out of the buffer by moving _buffer_offset along it,
+        # so that the buffer only gets copied when more data comes in
+        self._buffer = ''
+        self._buffer_offset = 0
+        self._position = offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def _fill(self):
+        '''Pulls some more data into the buffer. Returns False at the end.'''
+        for data in self._data:
+            self._buffer = self._buffer[self._buffer_offset:] + data
+            self._buffer_offset = 0
+            return True
+        return False
+
+    def _take(self, end):
+        '''Returns the buffered data up to end and moves past it'''
+        data = self._buffer[self._buffer_offset:end]
+        self._buffer_offset = end
+        self._position += len(data)
+        return data
+
+    def close(self):
+        '''Calls on_close, if it hasn't been already'''
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    def peek(self, size):
+        '''Returns up to the next size bytes without moving past them'''
+        while len(self._buffer) - self._buffer_offset < size and self._fill():
+            pass
+        return self._buffer[self._buffer_offset:self._buffer_offset + size]
+
+    def read(self, size):
+        '''Reads up to size bytes'''
+        while len(self._buffer) - self._buffer_offset < size and self._fill():
+            pass
+        return self._take(min(self._buffer_offset + size, len(self._buffer)))
+
+    def readline(self):
+        '''Reads the next line, including its newline. Empty at the end.'''
+        newline = self._buffer.find('\n', self._buffer_offset)
+        while newline == -1:
+            searched = len(self._buffer) - self._buffer_offset
+            if not self._fill():
+                return self._take(len(self._buffer))
+            newline = self._buffer.find('\n', searched)
+        return self._take(newline + 1)
+
+    def tell(self):
+        '''Returns the current offset'''
+        return self._position
+
+
+class TimedReader(object):
+    '''
+    Wraps a file-like object, passing how long each read() took to on_read,
+    e.g. to tell the time spent reading a gzip file from the time spent decompressing it.
+    Everything else is passed straight through to the wrapped object.
+    '''
+
+    def __init__(self, handle, on_read):
+        self._handle = handle
+        self._on_read = on_read
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    def read(self, size=-1):
+        '''Reads up to size bytes, or everything left if size is negative'''
+        started = time.time()
+        try:
+            return self._handle.read(size)
+        finally:
+            self._on_read(time.time() - started)
+
+
+def gen_sftp_data(sftp_file, size):
+    '''
+    Generator that reads the first size bytes of an open paramiko SFTPFile,
+    a window of pipelined requests at a time, so that download speed isn't
+    bound by latency but no more than a window's worth is held in memory.
+    '''
+    offset = 0
+    while offset < size:
+        window_end = min(offset + SFTP_WINDOW_SIZE, size)
+        chunks = [(start, min(SFTP_REQUEST_SIZE, window_end - start))
+                  for start in xrange(offset, window_end, SFTP_REQUEST_SIZE)]
+        for data in sftp_file.readv(chunks):
+            yield data
+        offset = window_end
+
+
+class SFTPReader(StreamReader):
+    '''
+    StreamReader over a remote file, read straight off an SFTP session.
+    Reads as much of the file as there was when it was opened.
+    on_close is called after the remote file is closed, e.g. to hand the
+    connection back to a pool.
+    '''
+
+    def __init__(self, sftp_file, on_close=None):
+        super(SFTPReader, self).__init__(gen_sftp_data(sftp_file, sftp_file.stat().st_size),
+                                         on_close=on_close)
+        self._file = sftp_file
+
+    def close(self):
+        '''Closes the remote file'''
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        finally:
+            self._file = None
+            super(SFTPReader, self).close()
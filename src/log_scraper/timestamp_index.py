@@ -0,0 +1,76 @@
+'''
+Sparse index of where in a log file each point in time is.
+
+Every `spacing` lines, the timestamp of the next line that has one is recorded
+along with its (uncompressed) byte offset. Since log lines are written in time
+order, a time window then maps to a byte range by binary searching the index:
+from the last indexed line before the window starts, to the first indexed line
+at or after it ends. Only the lines in between have to be read, and only the
+sampled lines ever have their timestamps parsed while the index is being built.
+
+Indexes are kept up to date as files grow, by indexing just the new lines.
+'''
+
+import bisect
+
+class TimestampIndex(object):
+    '''
+    List of (timestamp, offset) entries for a file. See the module docs.
+    fingerprint identifies how timestamps were extracted, so that the index
+    can be thrown away if that changes.
+    '''
+
+    def __init__(self, spacing, fingerprint):
+        self.spacing = spacing
+        self.fingerprint = fingerprint
+        self.entries = []
+        # Where indexing stopped: just past the last complete line seen
+        self.end_offset = 0
+        self.line_count = 0
+        # Set by the caller, to tell when the file has changed
+        self.size = 0
+        self.mtime = 0
+        self.inode = 0
+        self.head = ''
+        self._pending = False
+
+    def find_range(self, start, end):
+        '''
+        Returns the (start_offset, end_offset) byte range the lines with timestamps
+        in [start, end) are in, as far as the index can tell.
+        Either end of the window can be None for no limit,
+        and end_offset is None if the range runs to the end of the file.
+        '''
+        timestamps = [timestamp for timestamp, _ in self.entries]
+        start_offset = 0
+        if start is not None:
+            first = bisect.bisect_left(timestamps, start) - 1
+            if first >= 0:
+                start_offset = self.entries[first][1]
+        if end is None:
+            return start_offset, None
+        last = bisect.bisect_left(timestamps, end)
+        if last < len(self.entries):
+            return start_offset, self.entries[last][1]
+        return start_offset, None
+
+    def update(self, lines, extract_timestamp):
+        '''
+        Indexes lines, which should be the file's lines from end_offset on.
+        extract_timestamp(line) should return the line's timestamp or None.
+        A last line without a newline is left for next time, as it may not be complete.
+        '''
+        offset = self.end_offset
+        for line in lines:
+            if not line.endswith('\n'):
+                break
+            if self.line_count % self.spacing == 0:
+                self._pending = True
+            if self._pending:
+                timestamp = extract_timestamp(line)
+                if timestamp is not None:
+                    self.entries.append((timestamp, offset))
+                    self._pending = False
+            offset += len(line)
+            self.line_count += 1
+        self.end_offset = offset
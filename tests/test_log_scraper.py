@@ -6,18 +6,37 @@ from collections import OrderedDict
 from datetime import datetime, timedelta
 from StringIO import StringIO
 import gzip
+import inspect
+import json
 import os
+import random
 import shutil
 import socket
+import subprocess
 import sys
+import threading
+import time
 import unittest
+import zlib
 
 BASE_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), os.pardir))
 sys.path.append(BASE_PATH)
 
+from src.log_scraper.archive_manifest import ArchiveManifest
 from src.log_scraper.base import LogScraper, RegexObject
 from src.log_scraper.base import BadRegexException, MissingArgumentException, InvalidArgumentException
+from src.log_scraper.gzip_index import GzipIndex
+from src.log_scraper.matching import RegexDispatcher, RegexPlanner, is_line_bound, leading_literal, \
+                                     required_literals
+from src.log_scraper.store import FileStore, locked
+from src.log_scraper.streams import TimedReader
+from src.log_scraper import remote_scanner
+from src.log_scraper.ssh_pool import SSHConnectionPool
+import src.log_scraper.base
 import src.log_scraper.consts as LSC
+# Aggregators have to be the same classes the scraper checks for, so they're imported the same way
+from log_scraper.aggregators import Aggregator, BucketedCounter, DistinctCount, QuantileSketch, \
+                                   TopK
 
 #DIRS
 ARCHIVE_DIR = 'archived'
@@ -71,6 +90,176 @@ def _write_file_from_pair(filename, inc_dir=LOG_DIR):
     with open(os.path.join(inc_dir, filename[0]), 'w') as mfile:
         mfile.write(filename[1])
 
+def _write_flushed_gzip(filename, parts, inc_dir=LOG_DIR):
+    '''
+    Writes out a gzip file with a full flush between each of the given parts,
+    plus a second gzip member with the last part in it again.
+    Returns the uncompressed contents.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = ''
+    for part in parts[:-1]:
+        data += compressor.compress(part) + compressor.flush(zlib.Z_FULL_FLUSH)
+    data += compressor.compress(parts[-1]) + compressor.flush()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data += compressor.compress(parts[-1]) + compressor.flush()
+    with open(os.path.join(inc_dir, filename), 'wb') as mfile:
+        mfile.write(data)
+    return ''.join(parts) + parts[-1]
+
+class FakeSSHClient(object):
+    '''Stands in for a paramiko SSHClient, to test connection pooling without a server'''
+
+    def __init__(self):
+        self.active = True
+        self.sftp_count = 0
+
+    def close(self):
+        '''Same as paramiko'''
+        self.active = False
+
+    def get_transport(self):
+        '''Returns a fake transport that's active as long as the client is'''
+        return self if self.active else None
+
+    def is_active(self):
+        '''Same as paramiko's Transport.is_active'''
+        return self.active
+
+    def exec_command(self, command):
+        '''Runs the command locally'''
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return (FakeChannelFile(process, process.stdin),
+                FakeChannelFile(process, process.stdout),
+                FakeChannelFile(process, process.stderr))
+
+    def open_sftp(self):
+        '''Returns a fake SFTP session'''
+        self.sftp_count += 1
+        return FakeSFTPClient()
+
+class FakeChannelFile(object):
+    '''Stands in for the paramiko ChannelFiles exec_command returns, over a local process'''
+
+    def __init__(self, process, handle):
+        self.channel = self
+        self._process = process
+        self._handle = handle
+
+    def __iter__(self):
+        return iter(self._handle.readline, '')
+
+    def read(self):
+        '''Same as paramiko'''
+        return self._handle.read()
+
+    def recv_exit_status(self):
+        '''Same as paramiko's Channel.recv_exit_status'''
+        return self._process.wait()
+
+    def shutdown_write(self):
+        '''Same as paramiko's Channel.shutdown_write'''
+        self._process.stdin.close()
+
+    def write(self, data):
+        '''Same as paramiko'''
+        self._handle.write(data)
+
+class FakeSFTPFile(file):
+    '''A local file standing in for a paramiko SFTPFile'''
+
+    def prefetch(self, file_size=None):
+        '''Nothing to prefetch locally'''
+        pass
+
+    def readv(self, chunks):
+        '''Same as paramiko'''
+        for offset, size in chunks:
+            self.seek(offset)
+            yield self.read(size)
+
+    def stat(self):
+        '''Same as paramiko'''
+        return os.fstat(self.fileno())
+
+class FakeSFTPClient(object):
+    '''Stands in for a paramiko SFTPClient, working on local files'''
+
+    def __init__(self):
+        self.fetched = 0
+
+    def close(self):
+        '''Same as paramiko'''
+        pass
+
+    def listdir(self, path):
+        '''Same as paramiko'''
+        return os.listdir(path)
+
+    def get(self, remotepath, localpath):
+        '''Copies the whole file'''
+        self.fetched += os.path.getsize(remotepath)
+        shutil.copyfile(remotepath, localpath)
+
+    def open(self, filename, mode='r'):
+        '''Opens the file, keeping track of how much of it gets read'''
+        fake_sftp = self
+        class _CountingFile(FakeSFTPFile):
+            '''Counts the bytes read'''
+            def read(self, size=-1):
+                data = FakeSFTPFile.read(self, size)
+                fake_sftp.fetched += len(data)
+                return data
+        return _CountingFile(filename, mode)
+
+    def stat(self, path):
+        '''Same as paramiko'''
+        return os.stat(path)
+
+class FakeRemoteScraper(LogScraper):
+    '''A scraper whose remote boxes are all fakes for the local one'''
+
+    @classmethod
+    def _open_ssh_connection(cls, server):
+        '''Fake connect'''
+        return FakeSSHClient()
+
+class FakeArchivingScraper(FakeRemoteScraper):
+    '''A fake remote scraper that also has an archive'''
+
+    def _get_archived_file_path(self):
+        '''Where logs are archived'''
+        return os.path.join(LOG_DIR, ARCHIVE_DIR)
+
+class MetricsCollectingScraper(LogScraper):
+    '''A scraper that keeps the metrics it emits'''
+
+    def __init__(self, *args, **kwargs):
+        super(MetricsCollectingScraper, self).__init__(*args, **kwargs)
+        self.emitted = []
+
+    def _emit_metrics(self, metrics):
+        '''Keeps the metrics'''
+        self.emitted.append(metrics)
+
+class SlowDiskScraper(MetricsCollectingScraper):
+    '''A scraper that takes an extra 50ms over every read of a gzipped file's compressed data'''
+
+    def _time_compressed_reads(self, handle):
+        '''Sleeps after each read, within the time counted as reading'''
+        slow_handle = TimedReader(handle, lambda seconds: time.sleep(0.05))
+        return super(SlowDiskScraper, self)._time_compressed_reads(slow_handle)
+
+class NoTraceScraper(LogScraper):
+    '''A scraper that reads the lines its own way, leaving out Trace's'''
+
+    def _gen_lines(self, filename):
+        '''Skips the lines about Trace'''
+        for line in super(NoTraceScraper, self)._gen_lines(filename):
+            if 'Trace' not in line:
+                yield line
+
 class LogScraperWithOptions(LogScraper):
     '''A sample implementation of the log scraper library that sets some of the optional params'''
 
@@ -98,6 +287,17 @@ class LogScraperWithOptions(LogScraper):
         '''Where logs are archived'''
         return os.path.join(LOG_DIR, ARCHIVE_DIR)
 
+class ArchivePathScraper(LogScraperWithOptions):
+    '''The same scraper, with the path to the archives given by the user'''
+
+    def __init__(self, user_params, archive_path):
+        super(ArchivePathScraper, self).__init__(user_params)
+        self.archive_path = archive_path
+
+    def _get_archived_file_path(self):
+        '''Where logs are archived'''
+        return self.archive_path
+
 class TestLogScraper(unittest.TestCase):
     '''Creates a simple log scraper and tests out all the functionality'''
 
@@ -127,17 +327,37 @@ class TestLogScraper(unittest.TestCase):
 
         _log_scraper = LogScraper()
         expected = ("LogScraper(default_filename=, default_filepath=, "
-                    "optional_params={'levels_to_boxes': {}, 'filename_regex': '', "
-                    "'processor_count': 4, 'local_copy_lifetime': 0, 'tmp_path': '', "
-                    "'force_copy': False, 'days_before_archiving': 0}, user_params={}")
+                    "optional_params={'remote_python': 'python', "
+                    "'processor_count': 4, 'timestamp_index_spacing': 10000, "
+                    "'max_connections': 8, 'levels_to_boxes': {}, "
+                    "'checkpoint_path': '', 'stream_remote': False, "
+                    "'instrument': False, 'filename_regex': '', "
+                    "'archive_manifest_path': '', 'tmp_path': '', "
+                    "'force_copy': False, 'days_before_archiving': 0, "
+                    "'use_mmap': False, 'remote_scan': False, "
+                    "'result_cache_path': '', 'local_copy_lifetime': 0, "
+                    "'chunk_size': 0, 'timestamp_regex': '', 'tmp_cache_size': 0, "
+                    "'timestamp_index_path': '', 'result_cache_size': 268435456, "
+                    "'ssh_idle_timeout': 300, 'gzip_index_path': '', "
+                    "'timestamp_format': ''}, user_params={}")
         self.assertEquals(repr(_log_scraper), expected)
 
         expected = ("Regexes: []\n"
                     "Default filename: \n"
                     "Default filepath: \n"
-                    "Optional params: {'levels_to_boxes': {}, 'filename_regex': '', "
-                    "'processor_count': 4, 'local_copy_lifetime': 0, 'tmp_path': '', "
-                    "'force_copy': False, 'days_before_archiving': 0}\n"
+                    "Optional params: {'remote_python': 'python', "
+                    "'processor_count': 4, 'timestamp_index_spacing': 10000, "
+                    "'max_connections': 8, 'levels_to_boxes': {}, "
+                    "'checkpoint_path': '', 'stream_remote': False, "
+                    "'instrument': False, 'filename_regex': '', "
+                    "'archive_manifest_path': '', 'tmp_path': '', "
+                    "'force_copy': False, 'days_before_archiving': 0, "
+                    "'use_mmap': False, 'remote_scan': False, "
+                    "'result_cache_path': '', 'local_copy_lifetime': 0, "
+                    "'chunk_size': 0, 'timestamp_regex': '', 'tmp_cache_size': 0, "
+                    "'timestamp_index_path': '', 'result_cache_size': 268435456, "
+                    "'ssh_idle_timeout': 300, 'gzip_index_path': '', "
+                    "'timestamp_format': ''}\n"
                     "User params: {}")
         self.assertEquals(str(_log_scraper), expected)
 
@@ -285,6 +505,7 @@ class TestLogScraper(unittest.TestCase):
                          "Pattern: New (?P<group>(Pattern)), Groups: ['group']")
 
         self.assertEqual(regex_obj.get_groups(), ['group'])
+        self.assertEqual(regex_obj.get_leading_literal(), 'New Pattern')
 
 
         _log_scraper.add_regex(name='test_regex', pattern='.*')
@@ -304,6 +525,124 @@ class TestLogScraper(unittest.TestCase):
         with self.assertRaises(BadRegexException):
             _log_scraper.add_regex(name='bad_regex', pattern='?P<whoops')
 
+    def test_regex_dispatcher(self):
+        '''Test the leading literal extraction and the dispatch on it'''
+        self.assertEqual(leading_literal(r'My name is (?P<name>\w+)\.$'), 'My name is ')
+        self.assertEqual(leading_literal(r'^(?:abc)+x'), 'abc')
+        self.assertEqual(leading_literal(r'(ab)(cd)e*'), 'abcd')
+        self.assertEqual(leading_literal(r'(?i)abc'), '')
+        self.assertEqual(leading_literal(r'a|b'), '')
+        self.assertEqual(leading_literal(r'.*Judge'), '')
+
+        regexes = [RegexObject(name='judge', pattern=r'My name is Judge\.$'),
+                   RegexObject(name='anything', pattern=r'.*name'),
+                   RegexObject(name='weather', pattern=r'The weather is (?P<value>\w+)')]
+        dispatcher = RegexDispatcher(regexes)
+        names = [regex.name for regex, _ in dispatcher.candidates('My name is Franklin.')]
+        self.assertEqual(names, ['judge', 'anything'])
+        names = [regex.name for regex, _ in dispatcher.candidates('The weather is icy.')]
+        self.assertEqual(names, ['anything', 'weather'])
+        names = [regex.name for regex, _ in dispatcher.candidates('Judge my name?')]
+        self.assertEqual(names, ['anything'])
+
+    def test_exclusive_regexes(self):
+        '''Exclusive regexes should be run in the planned order, with the same results'''
+        methods = ['GET'] * 14 + ['POST'] * 5 + ['DELETE']
+        lines = ['10.0.0.{} "{} /a/{}" user={}\n'.format(index % 9, methods[index % 20], index % 13,
+                                                         index % 7) for index in xrange(20000)]
+        _write_file('log3.log', ''.join(lines))
+
+        def _scrape(exclusive_group, overlapping=False, **optional_params):
+            '''Scrapes the file with the methods' regexes in exclusive_group'''
+            optional_params[LSC.INSTRUMENT] = True
+            with LogScraper(optional_params=optional_params,
+                            user_params={LSC.FILENAME : os.path.join(LOG_DIR, 'log3.log')}) \
+                    as _log_scraper:
+                for method in ['DELETE', 'POST', 'GET']:
+                    _log_scraper.add_regex(name=method.lower(),
+                                           pattern=r'.*"' + method + r' (?P<path>\S+)"',
+                                           exclusive_group=exclusive_group)
+                if overlapping:
+                    _log_scraper.add_regex(name='any', pattern=r'.*"\w+ (?P<path>/a)',
+                                           exclusive_group=exclusive_group)
+                _log_scraper.add_regex(name='user', pattern=r'.*user=(?P<user>\d+)')
+                return _log_scraper.get_log_data()
+
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 200000}]:
+            expected = _scrape(None, **optional_params)
+            results = _scrape('method', **optional_params)
+            self.assertEqual(results[LSC.REGEXES], expected[LSC.REGEXES])
+            self.assertEqual(results[LSC.REGEXES]['delete'][LSC.TOTAL_HITS], 1000)
+            evaluations = dict((name, regex_metrics[LSC.EVALUATIONS]) for name, regex_metrics
+                               in results[LSC.METRICS][LSC.REGEXES].items())
+            # After the sample lines, the group stops at the first hit, whatever order the
+            # timings put it in (the order itself is checked against fixed timings below)
+            self.assertEqual(evaluations['user'], 20000)
+            self.assertLess(evaluations['get'] + evaluations['post'] + evaluations['delete'], 60000)
+            self.assertEqual(expected[LSC.METRICS][LSC.REGEXES]['delete'][LSC.EVALUATIONS], 20000)
+
+        # A group that isn't really exclusive is run in full
+        expected = _scrape(None, overlapping=True)
+        results = _scrape('method', overlapping=True)
+        self.assertEqual(results[LSC.REGEXES], expected[LSC.REGEXES])
+        self.assertEqual(results[LSC.REGEXES]['any'][LSC.TOTAL_HITS], 20000)
+
+        regexes = [RegexObject(name='slow', pattern=r'a', exclusive_group='x'),
+                   RegexObject(name='fast', pattern=r'b', exclusive_group='x'),
+                   RegexObject(name='never', pattern=r'c', exclusive_group='x'),
+                   RegexObject(name='always', pattern=r'd')]
+        planner = RegexPlanner(regexes)
+        for _ in xrange(10):
+            planner.new_line()
+            for regex, hit, elapsed in zip(regexes, [True, True, False, True], [5, 1, 1, 1]):
+                planner.observe(regex, hit, elapsed)
+        order, exclusive = planner.plan()
+        self.assertEqual([regex.name for regex in order], ['always', 'fast', 'slow', 'never'])
+        self.assertEqual(exclusive, {})
+        self.assertEqual(planner.get_overlapping_groups(), ['x'])
+
+        # At the same cost, the likeliest regexes go first
+        regexes = [RegexObject(name=method, pattern=method, exclusive_group='method')
+                   for method in ['DELETE', 'POST', 'GET']]
+        planner = RegexPlanner(regexes)
+        for index in xrange(1000):
+            planner.new_line()
+            for regex in regexes:
+                planner.observe(regex, regex.name == methods[index % 20], 1)
+        order, exclusive = planner.plan()
+        self.assertEqual([regex.name for regex in order], ['GET', 'POST', 'DELETE'])
+        self.assertEqual(exclusive, {'GET' : 'method', 'POST' : 'method', 'DELETE' : 'method'})
+
+    def test_regex_prefilter(self):
+        '''Test the required literal extraction and the substring prefilter'''
+        self.assertEqual(required_literals(r'.*status=(?P<status>\d+) took (?P<ms>\d+)ms'),
+                         ['status=', ' took ', 'ms'])
+        self.assertEqual(required_literals(r'(ab)(cd)e*'), ['abcd'])
+        self.assertEqual(required_literals(r'.*(?:foo)+bar'), ['bar', 'foo'])
+        self.assertEqual(required_literals(r'.*(foo|bar)'), [])
+        self.assertEqual(required_literals(r'(?i).*status='), [])
+
+        regex_obj = RegexObject(name='status', pattern=r'.*status=(?P<status>\d+)')
+        self.assertEqual(regex_obj.get_required_literal(), 'status=')
+        self.assertEqual(regex_obj.match('GET / status=200\n').group('status'), '200')
+        self.assertEqual(regex_obj.match('GET / code=200\n'), None)
+
+        regex_obj = RegexObject(name='judge', pattern=r'My name is Judge\.$', prefilter=False)
+        self.assertEqual(regex_obj.get_required_literal(), '')
+        self.assertEqual(regex_obj.get_leading_literal(), '')
+        self.assertNotEqual(regex_obj.match('My name is Judge.\n'), None)
+
+        # Results have to be the same either way
+        results = []
+        for prefilter in [True, False]:
+            _log_scraper = LogScraper(user_params={LSC.FILENAME : os.path.join(LOG_DIR, LOG_FILE)})
+            _log_scraper.add_regex(name='judge', pattern=r'.*Judge', prefilter=prefilter)
+            _log_scraper.add_regex(name='weather', pattern=r'.*weather is (?P<value>\w+)',
+                                   prefilter=prefilter)
+            results.append(_log_scraper.get_log_data())
+        self.assertDictEqual(results[0], results[1])
+        self.assertEqual(results[0][LSC.REGEXES]['weather'][LSC.TOTAL_HITS], 3)
+
     def test_remote_file_copying(self):
         '''Tests to see if it copies file over SSH properly'''
 
@@ -400,6 +739,470 @@ class TestLogScraper(unittest.TestCase):
 
         shutil.rmtree(TMP_REMOTE_DIR)
 
+    def test_remote_scanning(self):
+        '''Tests scanning files on the remote box over SSH gives the same results as copying them'''
+
+        default_filepath = {LSC.DEFAULT_PATH : os.path.join(BASE_PATH, 'logs'),
+                            LSC.DEFAULT_FILENAME : LOG_FILE}
+        user_params = {LSC.LEVEL : 'this_box'}
+        optional_params = {LSC.TMP_PATH : TMP_REMOTE_DIR,
+                           LSC.LEVELS_TO_BOXES : {'this_box' : socket.gethostname()},
+                           LSC.FILENAME_REGEX : LOG_FILE_REGEX,
+                           LSC.FORCE_COPY : True,
+                           LSC.REMOTE_SCAN : True,
+                           LSC.REMOTE_PYTHON : sys.executable}
+
+        _log_scraper = LogScraper(default_filepath=default_filepath,
+                                  user_params=user_params,
+                                  optional_params=optional_params)
+        _log_scraper.add_regex(name='group', pattern=r'My name is (?P<name>\w+)\.$')
+        self.assertTrue(_log_scraper._is_remote_scan())
+
+        user_params = {LSC.FILENAME : os.path.join(BASE_PATH, 'logs', LOG_FILE)}
+        _local_scraper = LogScraper(default_filepath=default_filepath, user_params=user_params)
+        _local_scraper.add_regex(name='group', pattern=r'My name is (?P<name>\w+)\.$')
+
+        self.assertDictEqual(_log_scraper.get_log_data()[LSC.REGEXES],
+                             _local_scraper.get_log_data()[LSC.REGEXES])
+        self.assertEqual([result[LSC.REGEXES] for result in _log_scraper.get_regex_matches()],
+                         [result[LSC.REGEXES] for result in _local_scraper.get_regex_matches()])
+
+    def test_ssh_pool(self):
+        '''Connections should be reused until they go idle or die, and never across processes'''
+        connected = []
+        def _connect(host):
+            '''Fake connect that keeps track of every client it opens'''
+            connected.append((host, FakeSSHClient()))
+            return connected[-1][1]
+
+        pool = SSHConnectionPool()
+        for _ in range(3):
+            with pool.connection('box1', _connect, 300) as conn:
+                conn.sftp()
+        with pool.connection('box2', _connect, 300) as conn:
+            self.assertIs(conn.ssh, connected[-1][1])
+        self.assertEqual([host for host, _ in connected], ['box1', 'box2'])
+        self.assertEqual(connected[0][1].sftp_count, 1)
+
+        # Dead connections are replaced
+        connected[0][1].active = False
+        with pool.connection('box1', _connect, 300) as conn:
+            self.assertIs(conn.ssh, connected[-1][1])
+        self.assertEqual(len(connected), 3)
+
+        # Idle ones are closed
+        with pool.connection('box1', _connect, 0) as conn:
+            pass
+        self.assertFalse(connected[1][1].active)
+        self.assertFalse(connected[2][1].active)
+
+        # A forked worker opens its own, and leaves the parent's alone
+        pool._pid = -1
+        with pool.connection('box1', _connect, 300) as conn:
+            self.assertIs(conn.ssh, connected[-1][1])
+        self.assertEqual(len(connected), 5)
+        self.assertTrue(connected[3][1].active)
+
+        with pool.connection('box3', lambda host: None, 300) as conn:
+            self.assertIsNone(conn)
+        pool.close()
+        self.assertFalse(connected[4][1].active)
+
+        # Closing some hosts leaves the rest, and never closes a connection that's checked out
+        pool = SSHConnectionPool()
+        with pool.connection('box1', _connect, 300) as box1:
+            with pool.connection('box2', _connect, 300) as box2:
+                pool.close(['box1', 'box2'])
+                self.assertTrue(box1.ssh.active and box2.ssh.active)
+            pool.close(['box2'])
+            self.assertIsNone(box2.ssh)
+            self.assertTrue(box1.ssh.active)
+        pool.close()
+        self.assertIsNone(box1.ssh)
+
+        # A connection dropped from the pool while someone waited on it isn't handed out
+        checked_out = []
+        def _check_out():
+            '''Checks out box1 once it's free'''
+            with pool.connection('box1', _connect, 300) as conn:
+                checked_out.append((conn, pool._connections.get('box1')))
+        with pool.connection('box1', _connect, 300) as conn:
+            waiter = threading.Thread(target=_check_out)
+            waiter.start()
+            time.sleep(0.1)
+            del pool._connections['box1']
+        waiter.join()
+        self.assertIsNot(checked_out[0][0], conn)
+        self.assertIs(checked_out[0][0], checked_out[0][1])
+        pool.close()
+
+        # Each scraper only closes the connections to the boxes it used
+        scrapers = [LogScraper(), LogScraper()]
+        for _log_scraper, box in zip(scrapers, ['box5', 'box6']):
+            _log_scraper._open_ssh_connection = _connect
+            with _log_scraper._ssh_connection(box):
+                pass
+        scrapers[0].close()
+        self.assertEqual([(host, client.active) for host, client in connected[-2:]],
+                         [('box5', False), ('box6', True)])
+        scrapers[1].close()
+        self.assertFalse(connected[-1][1].active)
+
+    def test_delta_fetch(self):
+        '''Refreshing a local copy of a growing remote file should only fetch the new bytes'''
+        remote_file = os.path.join(LOG_DIR, LOG_FILE_2[0])
+        local_file = os.path.join(LOG_DIR, 'copy.log')
+        sftp = FakeSFTPClient()
+
+        self.assertFalse(LogScraper._append_remote_file(sftp, remote_file, local_file))
+        sftp.get(remote_file, local_file)
+        # Even with nothing to fetch, the copy is as fresh as if it had been copied again
+        os.utime(local_file, (0, 0))
+        self.assertTrue(LogScraper._append_remote_file(sftp, remote_file, local_file))
+        self.assertGreater(os.path.getmtime(local_file), time.time() - 60)
+
+        appended = 'My name is Judge.\n' * 1000
+        with open(remote_file, 'a') as handle:
+            handle.write(appended)
+        sftp.fetched = 0
+        self.assertTrue(LogScraper._append_remote_file(sftp, remote_file, local_file))
+        with open(local_file) as handle:
+            self.assertEqual(handle.read(), LOG_FILE_2[1] + appended)
+        self.assertLess(sftp.fetched, len(appended) + 2 * 4096)
+
+        # Rotated or truncated files get copied in full
+        _write_file_from_pair((LOG_FILE_2[0], LOG_FILE_1[1] * 1000))
+        self.assertFalse(LogScraper._append_remote_file(sftp, remote_file, local_file))
+        _write_file_from_pair(LOG_FILE_2)
+        self.assertFalse(LogScraper._append_remote_file(sftp, remote_file, local_file))
+
+        # And through _get_log_file, with a stale local copy
+        optional_params = {LSC.TMP_PATH : LOG_DIR, LSC.LOCAL_COPY_LIFETIME : 0,
+                           LSC.LEVELS_TO_BOXES : {'this_box' : 'fake_box'}}
+        _log_scraper = LogScraper(user_params={LSC.LEVEL : 'this_box'},
+                                  optional_params=optional_params)
+        _log_scraper._open_ssh_connection = lambda server: FakeSSHClient()
+        local_file = os.path.join(LOG_DIR, 'this_box_' + LOG_FILE_2[0])
+        _write_file_from_pair(('this_box_' + LOG_FILE_2[0], LOG_FILE_2[1][:40]))
+        with open(remote_file, 'a') as handle:
+            handle.write(appended)
+        os.utime(local_file, (time.time() - 60, time.time() - 60))
+        try:
+            self.assertEqual(_log_scraper._get_log_file(
+                LogScraper._make_remote_path('fake_box', remote_file)), local_file)
+        finally:
+            _log_scraper.close()
+        with open(local_file) as handle:
+            self.assertEqual(handle.read(), LOG_FILE_2[1] + appended)
+
+    def test_multiple_boxes(self):
+        '''A level mapped to several boxes should be listed, fetched and scanned on all of them'''
+        _write_file('log1-prod.log', LOG_FILE_1[1])
+        with gzip.open(os.path.join(LOG_DIR, 'log2-prod.log'), 'wb') as handle:
+            handle.write(LOG_FILE_2[1])
+        tmp_dir = os.path.join(LOG_DIR, 'tmp')
+        os.mkdir(tmp_dir)
+        default_filepath = {LSC.DEFAULT_PATH : LOG_DIR, LSC.DEFAULT_FILENAME : LOG_FILE}
+        group_regex = r'My name is (?P<name>\w+)\.$'
+
+        _local_scraper = LogScraper(user_params={LSC.FILENAME : ','.join(
+            [os.path.join(LOG_DIR, 'log1-prod.log'), os.path.join(LOG_DIR, 'log2-prod.log')])})
+        _local_scraper.add_regex(name='group', pattern=group_regex)
+        expected = _local_scraper.get_log_data()
+        expected_matches = [result[LSC.REGEXES] for result in _local_scraper.get_regex_matches()]
+
+        # Copying the files over, scanning them remotely, and streaming them
+        for param in [None, LSC.REMOTE_SCAN, LSC.STREAM_REMOTE]:
+            optional_params = {LSC.TMP_PATH : tmp_dir,
+                               LSC.LEVELS_TO_BOXES : {'prod' : ['box1', 'box2']},
+                               LSC.FILENAME_REGEX : LOG_FILE_REGEX,
+                               LSC.REMOTE_PYTHON : sys.executable}
+            if param is not None:
+                optional_params[param] = True
+            with FakeRemoteScraper(default_filepath=default_filepath,
+                                   optional_params=optional_params,
+                                   user_params={LSC.LEVEL : 'prod'}) as _log_scraper:
+                _log_scraper.add_regex(name='group', pattern=group_regex)
+                self.assertEqual(_log_scraper._get_file_list(),
+                                 ['{}:{}'.format(box, os.path.join(LOG_DIR, name))
+                                  for box in ['box1', 'box2']
+                                  for name in ['log1-prod.log', 'log2-prod.log']])
+                results = _log_scraper.get_log_data()
+                matches = _log_scraper.get_regex_matches()
+
+            self.assertEqual(len(results[LSC.FILE_HITS]), 4)
+            self.assertEqual(results[LSC.REGEXES]['group'][LSC.TOTAL_HITS],
+                             2 * expected[LSC.REGEXES]['group'][LSC.TOTAL_HITS])
+            self.assertEqual(results[LSC.HOST_HITS].keys(), ['box1', 'box2'])
+            for host_hits in results[LSC.HOST_HITS].values():
+                self.assertDictEqual(host_hits[LSC.REGEXES], expected[LSC.REGEXES])
+            self.assertEqual([result[LSC.REGEXES] for result in matches], expected_matches * 2)
+
+            if param is None:
+                self.assertEqual(sorted(name for name in os.listdir(tmp_dir)
+                                        if not name.endswith('.lock')),
+                                 ['prod_box1_log1-prod.log', 'prod_box1_log2-prod.log',
+                                  'prod_box2_log1-prod.log', 'prod_box2_log2-prod.log'])
+                shutil.rmtree(tmp_dir)
+                os.mkdir(tmp_dir)
+            else:
+                self.assertEqual(os.listdir(tmp_dir), [])
+
+        # Scanning remotely would skip any overridden matching or counting
+        optional_params = {LSC.LEVELS_TO_BOXES : {'prod' : ['box1', 'box2']},
+                           LSC.REMOTE_SCAN : True}
+        self.assertTrue(FakeRemoteScraper(optional_params=optional_params,
+                                          user_params={LSC.LEVEL : 'prod'})._is_remote_scan())
+        for method_name in ['_run_regex_and_do_aggregation', '_sum_group_matches',
+                            '_aggregate_lines', '_extract_timestamp']:
+            scraper_class = type('OverridingScraper', (FakeRemoteScraper,),
+                                 {method_name : lambda *args: None})
+            self.assertFalse(scraper_class(optional_params=optional_params,
+                                           user_params={LSC.LEVEL : 'prod'})._is_remote_scan())
+
+        # Each box's results come back as soon as they're ready, not once every box is done
+        released = threading.Event()
+        def _scan(box):
+            '''Yields a result for the box, only once it's been released for the slow one'''
+            if box == 'slow':
+                released.wait(5)
+            if box == 'broken':
+                raise IOError('Could not connect to broken')
+            yield box
+        results = LogScraper()._imap_on_threads(_scan, ['slow', 'fast'])
+        self.assertEqual(next(results), 'fast')
+        released.set()
+        self.assertEqual(list(results), ['slow'])
+        self.assertRaises(IOError, list, LogScraper()._imap_on_threads(_scan, ['fast', 'broken']))
+
+        # No files on any of the boxes
+        with FakeRemoteScraper(default_filepath={LSC.DEFAULT_PATH : LOG_DIR,
+                                                 LSC.DEFAULT_FILENAME : 'missing.log'},
+                               optional_params={LSC.TMP_PATH : tmp_dir,
+                                                LSC.LEVELS_TO_BOXES : {'prod' : ['box1', 'box2']},
+                                                LSC.FILENAME_REGEX : r'missing\.log'},
+                               user_params={LSC.LEVEL : 'prod'}) as _log_scraper:
+            _log_scraper.add_regex(name='group', pattern=group_regex)
+            self.assertIsNone(_log_scraper.get_log_data())
+            self.assertRaisesRegexp(InvalidArgumentException, 'on box1, box2',
+                                    _log_scraper._validate_file_list)
+
+    def test_date_range(self):
+        '''A date range should scan every day's files at once, wherever each day's files live'''
+        _write_file_from_pair((LOG_FILE_1[0].split('.')[0] + '-20150303.log', LOG_FILE_2[1]),
+                              os.path.join(LOG_DIR, ARCHIVE_DIR))
+
+        def _scrape(log_date, end_date=None):
+            '''Scrapes the days from log_date to end_date'''
+            user_params = {LSC.DATE : log_date}
+            if end_date is not None:
+                user_params[LSC.END_DATE] = end_date
+            with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+                return _option_scraper.get_log_data()
+
+        results = _scrape('20150301', '20150303')
+        self.assertEqual(results[LSC.DAY_HITS].keys(), ['20150301', '20150303'])
+        self.assertEqual(len(results[LSC.FILE_HITS]), 3)
+        for log_date, day_hits in results[LSC.DAY_HITS].items():
+            self.assertDictEqual(day_hits[LSC.REGEXES], _scrape(log_date)[LSC.REGEXES])
+        self.assertEqual(results[LSC.REGEXES]['group'][LSC.TOTAL_HITS],
+                         sum(_scrape(log_date)[LSC.REGEXES]['group'][LSC.TOTAL_HITS]
+                             for log_date in ['20150301', '20150303']))
+        self.assertNotIn(LSC.DAY_HITS, _scrape('20150301'))
+
+        # Bad ranges
+        self.assertIsNone(_scrape('20150303', '20150301'))
+        self.assertIsNone(_scrape('20150301', 'tomorrow'))
+        self.assertRaises(InvalidArgumentException, LogScraperWithOptions(
+            user_params={LSC.END_DATE : '20150301'})._validate_date_range)
+
+        # Days before today are done, so their results can be cached even if they aren't archived
+        today = datetime.now()
+        dates = [(today - timedelta(days=days)).strftime('%Y%m%d') for days in [1, 0]]
+        for log_date in dates:
+            _write_file('log1-{}.log'.format(log_date), LOG_FILE_1[1])
+        _option_scraper = LogScraperWithOptions(user_params={LSC.DATE : dates[0],
+                                                             LSC.END_DATE : dates[1]})
+        _option_scraper._optional_params[LSC.DAYS_BEFORE_ARCHIVING] = 3
+        _option_scraper._optional_params[LSC.RESULT_CACHE_PATH] = os.path.join(LOG_DIR, 'cache')
+        file_list = _option_scraper._get_file_list()
+        self.assertEqual(file_list, [os.path.join(LOG_DIR, 'log1-{}.log'.format(log_date))
+                                     for log_date in dates])
+        self.assertIsNotNone(_option_scraper._get_result_cache_key(file_list[0]))
+        self.assertIsNone(_option_scraper._get_result_cache_key(file_list[1]))
+
+        # Archived days are read locally, live ones are fetched from the level's boxes
+        _write_file('log1-prod-{}.log'.format(dates[1]), LOG_FILE_1[1])
+        for box in ['box1', 'box2']:
+            _write_file_from_pair(('log2-{}-{}.log'.format(box, dates[0]), LOG_FILE_2[1]),
+                                  os.path.join(LOG_DIR, ARCHIVE_DIR))
+        tmp_dir = os.path.join(LOG_DIR, 'tmp')
+        os.mkdir(tmp_dir)
+        with FakeArchivingScraper(default_filepath={LSC.DEFAULT_PATH : LOG_DIR,
+                                                 LSC.DEFAULT_FILENAME : LOG_FILE},
+                               optional_params={LSC.TMP_PATH : tmp_dir,
+                                                LSC.LEVELS_TO_BOXES : {'prod' : ['box1', 'box2']},
+                                                LSC.FILENAME_REGEX : LOG_FILE_REGEX,
+                                                LSC.DAYS_BEFORE_ARCHIVING : 1,
+                                                LSC.STREAM_REMOTE : True},
+                               user_params={LSC.LEVEL : 'prod', LSC.DATE : dates[0],
+                                            LSC.END_DATE : dates[1]}) as _log_scraper:
+            _log_scraper.add_regex(name='group', pattern=r'My name is (?P<name>\w+)\.$')
+            self.assertFalse(_log_scraper._is_streaming_remote())
+            results = _log_scraper.get_log_data()
+
+        self.assertEqual(sorted(result[LSC.FILENAME] for result in results[LSC.FILE_HITS]),
+                         [os.path.join(LOG_DIR, ARCHIVE_DIR, 'log2-{}-{}.log'.format(box, dates[0]))
+                          for box in ['box1', 'box2']] +
+                         [os.path.join(tmp_dir, 'prod_{}_log1-prod-{}.log'.format(box, dates[1]))
+                          for box in ['box1', 'box2']])
+        self.assertEqual(results[LSC.DAY_HITS][dates[0]][LSC.REGEXES]['group'][LSC.TOTAL_HITS], 4)
+        self.assertEqual(results[LSC.DAY_HITS][dates[1]][LSC.REGEXES]['group'][LSC.TOTAL_HITS], 6)
+        self.assertEqual(results[LSC.HOST_HITS].keys(), ['box1', 'box2'])
+
+        # Remote days that are done are answered from the result cache without copying them over
+        _write_file('log1-prod-{}.log'.format(dates[0]), LOG_FILE_2[1])
+        def _scrape_remote():
+            '''Scrapes both days off both boxes through the result cache'''
+            with FakeRemoteScraper(default_filepath={LSC.DEFAULT_PATH : LOG_DIR,
+                                                     LSC.DEFAULT_FILENAME : LOG_FILE},
+                                   optional_params={LSC.TMP_PATH : tmp_dir,
+                                                    LSC.LEVELS_TO_BOXES :
+                                                    {'prod' : ['box1', 'box2']},
+                                                    LSC.FILENAME_REGEX : LOG_FILE_REGEX,
+                                                    LSC.RESULT_CACHE_PATH :
+                                                    os.path.join(LOG_DIR, 'remote_cache')},
+                                   user_params={LSC.LEVEL : 'prod', LSC.DATE : dates[0],
+                                                LSC.END_DATE : dates[1]}) as _log_scraper:
+                _log_scraper.add_regex(name='group', pattern=r'My name is (?P<name>\w+)\.$')
+                return _log_scraper.get_log_data()
+
+        expected = _scrape_remote()
+        copies = [os.path.join(tmp_dir, 'prod_{}_log1-prod-{}.log'.format(box, log_date))
+                  for log_date in dates for box in ['box1', 'box2']]
+        for copy in copies:
+            os.remove(copy)
+        results = _scrape_remote()
+        self.assertEqual([os.path.exists(copy) for copy in copies], [False, False, True, True])
+        self.assertEqual(sorted(result[LSC.FILENAME] for result in results[LSC.FILE_HITS]),
+                         sorted(copies))
+        self.assertEqual(results[LSC.DAY_HITS], expected[LSC.DAY_HITS])
+        self.assertEqual(results[LSC.HOST_HITS], expected[LSC.HOST_HITS])
+        self.assertEqual(results[LSC.DAY_HITS][dates[0]][LSC.REGEXES]['group'][LSC.TOTAL_HITS], 4)
+
+    def test_archive_manifest(self):
+        '''Archived files should be found through a saved listing of the archive directory'''
+        archive_dir = os.path.join(LOG_DIR, ARCHIVE_DIR)
+        manifest_dir = os.path.join(LOG_DIR, 'manifests')
+        for day in xrange(2, 30):
+            _write_file('log1-201503{:02d}.log'.format(day), LOG_FILE_2[1], archive_dir)
+        _write_file('.log1-20150301.log', LOG_FILE_2[1], archive_dir)
+
+        def _scrape(use_manifest):
+            '''Scrapes the archived files for 20150301'''
+            with LogScraperWithOptions(user_params={LSC.DATE : '20150301'}) as _option_scraper:
+                if use_manifest:
+                    _option_scraper._optional_params[LSC.ARCHIVE_MANIFEST_PATH] = manifest_dir
+                return _option_scraper.get_log_data()
+
+        os.utime(archive_dir, (time.time() - 60, time.time() - 60))
+        expected = _scrape(False)
+        self.assertDictEqual(_scrape(True), expected)
+        self.assertDictEqual(_scrape(True), expected)
+
+        # Listings are indexed by date, and reused until the directory changes
+        store = FileStore(manifest_dir)
+        manifest = ArchiveManifest.get(archive_dir, store)
+        self.assertEqual(sorted(manifest.match('log*-20150301.log*')),
+                         ['log1-20150301.log', 'log2-20150301.log'])
+        self.assertEqual(manifest.by_date['20150302'], ['log1-20150302.log'])
+        self.assertEqual(len(manifest.match('log1-2015030?.log')), 9)
+        self.assertEqual(manifest.match('.log1-20150301.log'), ['.log1-20150301.log'])
+        self.assertEqual(ArchiveManifest.get(archive_dir, store).listed_at, manifest.listed_at)
+
+        _write_file('log3-20150301.log', LOG_FILE_1[1], archive_dir)
+        manifest = ArchiveManifest.get(archive_dir, store)
+        self.assertIn('log3-20150301.log', manifest.match('log*-20150301.log*'))
+        # Changed too recently to be sure it hasn't changed again since
+        self.assertNotEqual(ArchiveManifest.get(archive_dir, store).listed_at, manifest.listed_at)
+        self.assertEqual(len(_scrape(True)[LSC.FILE_HITS]), 3)
+
+    def test_tmp_cache(self):
+        '''Copies in TMP_PATH should be made atomically, under a lock, and evicted to fit a budget'''
+        tmp_dir = os.path.join(LOG_DIR, 'tmp')
+        os.mkdir(tmp_dir)
+        remote_file = os.path.join(LOG_DIR, LOG_FILE_2[0])
+        local_file = os.path.join(tmp_dir, 'this_box_' + LOG_FILE_2[0])
+        optional_params = {LSC.TMP_PATH : tmp_dir,
+                           LSC.LEVELS_TO_BOXES : {'this_box' : 'fake_box'},
+                           LSC.TMP_CACHE_SIZE : 3 * len(LOG_FILE_2[1])}
+        _log_scraper = LogScraper(user_params={LSC.LEVEL : 'this_box'},
+                                  optional_params=optional_params)
+        _log_scraper._open_ssh_connection = lambda server: FakeSSHClient()
+
+        # What a crashed copy left behind gets picked up from
+        _write_file(os.path.basename(local_file) + '.part', LOG_FILE_2[1][:40], tmp_dir)
+        try:
+            self.assertEqual(_log_scraper._get_log_file('fake_box:' + remote_file), local_file)
+        finally:
+            _log_scraper.close()
+        with open(local_file) as handle:
+            self.assertEqual(handle.read(), LOG_FILE_2[1])
+        self.assertEqual(sorted(os.listdir(tmp_dir)),
+                         [os.path.basename(local_file), os.path.basename(local_file) + '.lock'])
+
+        # Only one process gets to refresh a copy at a time
+        with locked(local_file + '.lock'):
+            with locked(local_file + '.lock', blocking=False) as is_locked:
+                self.assertFalse(is_locked)
+
+        # The least recently used copies go first, but never the ones in use or just used,
+        # and files that aren't copies are left alone. What crashed copies left
+        # behind counts too. Lock files are always left, as someone could be waiting on them.
+        grace = src.log_scraper.base.TMP_EVICTION_GRACE
+        for age, name in [(grace + 10, 'a'), (grace + 40, 'b'), (grace + 30, 'c'), (10, 'd'),
+                          (grace + 20, 'e'), (grace + 50, 'f.part')]:
+            path = os.path.join(tmp_dir, name)
+            _write_file(name, LOG_FILE_2[1], tmp_dir)
+            _write_file(name.split('.')[0] + '.lock', '', tmp_dir)
+            os.utime(path, (time.time() - age, time.time()))
+        _write_file('other', LOG_FILE_2[1] * 10, tmp_dir)
+        _log_scraper._file_list = [local_file, os.path.join(tmp_dir, 'b')]
+        _log_scraper._evict_tmp_files()
+        self.assertEqual(sorted(name for name in os.listdir(tmp_dir)
+                                if not name.startswith('this_box')),
+                         ['a.lock', 'b', 'b.lock', 'c.lock', 'd', 'd.lock', 'e.lock', 'f.lock',
+                          'other'])
+        self.assertTrue(os.path.exists(local_file))
+
+    def test_remote_scanner(self):
+        '''The remote scanner should give the same results as scanning locally'''
+        with gzip.open(os.path.join(LOG_DIR, 'log3.gz'), 'wb') as handle:
+            handle.write(LOG_FILE_2[1] + 'My name is \xe9mile.\n')
+        user_params = {LSC.FILENAME : ','.join([os.path.join(LOG_DIR, LOG_FILE),
+                                                os.path.join(LOG_DIR, 'log*.gz')])}
+        _option_scraper = LogScraperWithOptions(user_params=user_params)
+        expected = {'aggregates' : _option_scraper.get_log_data()[LSC.FILE_HITS],
+                    'matches' : _option_scraper.get_regex_matches()}
+        self.assertEqual(len(expected['matches']), 3)
+
+        for mode in ['aggregates', 'matches']:
+            request = json.loads(_option_scraper._make_remote_request(
+                _option_scraper._file_list + [os.path.join(LOG_DIR, 'missing.log')], mode))
+            process = subprocess.Popen([sys.executable, '-c', inspect.getsource(remote_scanner)],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = process.communicate(json.dumps(request))[0]
+            self.assertEqual(process.returncode, 0)
+
+            payloads = [json.loads(line) for line in output.splitlines()]
+            errors = [payload for payload in payloads if 'error' in payload]
+            self.assertEqual([payload['filename'] for payload in errors],
+                             [os.path.join(LOG_DIR, 'missing.log')])
+            results = [_option_scraper._read_remote_result(payload, mode)
+                       for payload in payloads if 'error' not in payload]
+            results.sort(key=lambda result: result[LSC.FILENAME])
+            self.assertEqual(results, expected[mode])
+
     def test_file_path_creation(self):
         '''Run the file path creation logic through its paces'''
 
@@ -454,6 +1257,12 @@ class TestLogScraper(unittest.TestCase):
                                           log_file_parts[1]]))
         self.assertEquals(_log_scraper._make_file_path(), expected)
 
+        # A level mapped to a list of just the one box is the same as mapping it to the box
+        _log_scraper._optional_params[LSC.LEVELS_TO_BOXES] = {'this_box' : [socket.gethostname()]}
+        self.assertEquals(_log_scraper._make_file_path(), expected)
+        _write_file(os.path.basename(expected), LOG_FILE_1[1])
+        self.assertEquals(_log_scraper._get_file_list(), [expected])
+
         # Archival with box name and date
         test_date = datetime.today() - timedelta(2)
         test_date = test_date.strftime('%Y%m%d')
@@ -511,6 +1320,726 @@ class TestLogScraper(unittest.TestCase):
         self.assertDictEqual(results, expected)
 
 
+    def test_chunked_scanning(self):
+        '''Splitting files into chunks should give the same results as scanning them whole'''
+        user_params = {LSC.FILENAME : os.path.join(LOG_DIR, LOG_FILE)}
+        expected = LogScraperWithOptions(user_params=user_params).get_log_data()
+
+        _option_scraper = LogScraperWithOptions(user_params=user_params)
+        _option_scraper._optional_params[LSC.CHUNK_SIZE] = 10
+        log_file = os.path.join(LOG_DIR, LOG_FILE_2[0])
+        chunks = _option_scraper._split_file(log_file)
+        self.assertEqual(len(chunks), 14)
+        self.assertEqual(chunks[0], (log_file, 0, 10))
+        self.assertEqual(chunks[-1], (log_file, 130, len(LOG_FILE_2[1])))
+
+        # Every line comes back exactly once, whichever chunk it starts in
+        lines = []
+        for _, start, end in chunks:
+            lines += list(_option_scraper._gen_lines_in_range(log_file, start, end))
+        self.assertEqual(lines, LOG_FILE_2[1].splitlines(True))
+
+        self.assertDictEqual(_option_scraper.get_log_data(), expected)
+
+        # Gzipped files are never split
+        zip_file = os.path.join(LOG_DIR, LOG_FILE_2[0] + '.gz')
+        with gzip.open(zip_file, 'wb') as handle:
+            handle.write(LOG_FILE_2[1] * 10)
+        self.assertEqual(_option_scraper._split_file(zip_file), [(zip_file, 0, None)])
+
+    def test_worker_pool(self):
+        '''The scraper should start one pool lazily and reuse it until closed'''
+        user_params = {LSC.FILENAME : os.path.join(LOG_DIR, LOG_FILE)}
+        with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+            self.assertEqual(_option_scraper._pool, None)
+            expected = _option_scraper.get_log_data()
+            pool = _option_scraper._pool
+            self.assertNotEqual(pool, None)
+
+            self.assertDictEqual(_option_scraper.get_log_data(), expected)
+            self.assertEqual(len(_option_scraper.get_regex_matches()), 2)
+            self.assertIs(_option_scraper._pool, pool)
+
+        self.assertEqual(_option_scraper._pool, None)
+
+        # Closed scrapers start up a new pool when used again
+        self.assertDictEqual(_option_scraper.get_log_data(), expected)
+        self.assertIsNot(_option_scraper._pool, pool)
+        _option_scraper.close()
+        self.assertEqual(_option_scraper._pool, None)
+
+    def test_streaming_log_data(self):
+        '''Test getting each file's results as they finish, with a running total'''
+        user_params = {LSC.FILENAME : os.path.join(LOG_DIR, LOG_FILE)}
+        with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+            expected = _option_scraper.get_log_data()
+
+            filenames = []
+            for result, running_total in _option_scraper.iter_log_data():
+                filenames.append(result[LSC.FILENAME])
+                self.assertIn(result, expected[LSC.FILE_HITS])
+            self.assertEqual(sorted(filenames), ['./logs/log1.log', './logs/log2.log'])
+            self.assertDictEqual(running_total[LSC.REGEXES], expected[LSC.REGEXES])
+
+            # Chunked files only come back once all their chunks are done
+            _option_scraper._optional_params[LSC.CHUNK_SIZE] = 10
+            results = [result for result, _ in _option_scraper.iter_log_data()]
+            self.assertEqual(len(results), 2)
+            for result in results:
+                self.assertIn(result, expected[LSC.FILE_HITS])
+
+            # Stopping early tears down the pool
+            for result, running_total in _option_scraper.iter_log_data():
+                break
+            self.assertEqual(_option_scraper._pool, None)
+            self.assertDictEqual(_option_scraper.get_log_data(), expected)
+
+        _log_scraper = LogScraper(user_params={LSC.FILENAME : '/this/path/does/not/exist/'})
+        self.assertEqual(list(_log_scraper.iter_log_data()), [])
+
+    def test_mmap_scanning(self):
+        '''Scanning memory-mapped blocks should give the same results as going line by line'''
+        self.assertTrue(is_line_bound(r'My name is (?P<name>\w+)\.$'))
+        self.assertTrue(is_line_bound(r'.*status=[^\n]+'))
+        self.assertTrue(is_line_bound(r'(a|b)(?=c)\1'))
+        self.assertFalse(is_line_bound(r'.*\s+x'))
+        self.assertFalse(is_line_bound(r'[^x]+'))
+        self.assertFalse(is_line_bound(r'(?s).*'))
+        self.assertFalse(is_line_bound(r'abc\Z'))
+        self.assertFalse(is_line_bound(r'(?<=a)b'))
+
+        # No trailing newline, so the last line still has to be picked up
+        _write_file('log3.log', LOG_FILE_2[1] + 'My name is Judge.')
+        user_params = {LSC.FILENAME : os.path.join(LOG_DIR, LOG_FILE)}
+        expected = LogScraperWithOptions(user_params=user_params).get_log_data()
+        expected_matches = LogScraperWithOptions(user_params=user_params).get_regex_matches()
+
+        block_size = src.log_scraper.base.MMAP_BLOCK_SIZE
+        try:
+            for size in [block_size, 16, 4]:
+                src.log_scraper.base.MMAP_BLOCK_SIZE = size
+                with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+                    _option_scraper._optional_params[LSC.USE_MMAP] = True
+                    self.assertTrue(_option_scraper._is_block_scannable(
+                        os.path.join(LOG_DIR, LOG_FILE_2[0])))
+                    self.assertDictEqual(_option_scraper.get_log_data(), expected)
+                    self.assertEqual(_option_scraper.get_regex_matches(), expected_matches)
+
+                    _option_scraper._optional_params[LSC.CHUNK_SIZE] = 10
+                    self.assertDictEqual(_option_scraper.get_log_data(), expected)
+        finally:
+            src.log_scraper.base.MMAP_BLOCK_SIZE = block_size
+
+        # Falls back to reading line by line if any regex could span lines
+        _option_scraper = LogScraperWithOptions(user_params=user_params)
+        _option_scraper._optional_params[LSC.USE_MMAP] = True
+        _option_scraper.add_regex(name='spaces', pattern=r'My\s+name')
+        self.assertFalse(_option_scraper._is_block_scannable(os.path.join(LOG_DIR, LOG_FILE_2[0])))
+
+    def test_gzip_index(self):
+        '''Test seeking into gzipped files and scanning them in parallel'''
+        index_dir = os.path.join(LOG_DIR, 'index')
+        os.mkdir(index_dir)
+        zip_file = os.path.join(LOG_DIR, 'log3.log.gz')
+        contents = _write_flushed_gzip('log3.log.gz', [LOG_FILE_1[1], LOG_FILE_2[1] * 3,
+                                                       LOG_FILE_1[1] * 2, LOG_FILE_2[1]])
+
+        # A checkpoint for every flush point and member that's far enough along
+        index = GzipIndex.get(zip_file, index_dir, 100)
+        self.assertEqual(index.uncompressed_size, len(contents))
+        self.assertEqual([checkpoint[1] for checkpoint in index.checkpoints], [0, 483, 627, 764])
+        self.assertEqual([checkpoint[2] is None for checkpoint in index.checkpoints],
+                         [True, False, False, True])
+        for offset in [0, 50, 72, 300, 483, 700, 764, 800]:
+            with index.open_at(offset) as reader:
+                self.assertEqual(reader.read(len(contents)), contents[offset:])
+                self.assertEqual(reader.tell(), len(contents))
+            self.assertEqual(index.open_at(offset).prev_char, contents[offset - 1:offset])
+
+        # Saved indexes are reused, until the file changes
+        self.assertEqual(GzipIndex.get(zip_file, index_dir, 100).checkpoints, index.checkpoints)
+        os.utime(zip_file, (time.time(), time.time() - 60))
+        mtime = os.path.getmtime(zip_file)
+        self.assertEqual(GzipIndex.get(zip_file, index_dir, 100).mtime, mtime)
+        self.assertEqual(GzipIndex.load(GzipIndex.index_path(zip_file, index_dir)).mtime, mtime)
+
+        # Plain gzip files only get the one checkpoint
+        plain_zip = os.path.join(LOG_DIR, 'log4.log.gz')
+        with gzip.open(plain_zip, 'wb') as handle:
+            handle.write(contents)
+        self.assertEqual(len(GzipIndex.get(plain_zip, index_dir, 100).checkpoints), 1)
+
+        user_params = {LSC.FILENAME : zip_file}
+        expected = LogScraperWithOptions(user_params=user_params).get_log_data()
+        with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+            _option_scraper._optional_params[LSC.CHUNK_SIZE] = 100
+            self.assertEqual(len(_option_scraper._split_file(zip_file)), 1)
+            _option_scraper._optional_params[LSC.GZIP_INDEX_PATH] = index_dir
+            self.assertEqual(_option_scraper._split_file(zip_file),
+                             [(zip_file, 0, 483), (zip_file, 483, 627),
+                              (zip_file, 627, 764), (zip_file, 764, 901)])
+            self.assertEqual(_option_scraper._split_file(plain_zip), [(plain_zip, 0, None)])
+            self.assertDictEqual(_option_scraper.get_log_data(), expected)
+
+    def test_incremental_scanning(self):
+        '''Incremental mode should only scan what was appended since the last run'''
+        log_file = os.path.join(LOG_DIR, LOG_FILE_2[0])
+        user_params = {LSC.FILENAME : log_file}
+        checkpoint_dir = os.path.join(LOG_DIR, 'checkpoints')
+
+        def _scrape(incremental=True):
+            '''Scrapes log_file, picking up from the last checkpoint if incremental'''
+            with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+                if incremental:
+                    _option_scraper._optional_params[LSC.CHECKPOINT_PATH] = checkpoint_dir
+                    _option_scraper._optional_params[LSC.CHUNK_SIZE] = 20
+                return _option_scraper.get_log_data()
+
+        def _bump_stored_hits(hits):
+            '''Adds to the stored no_group total, so that we can tell the stored result was used'''
+            store = FileStore(checkpoint_dir)
+            checkpoint = store.get(os.path.abspath(log_file))
+            checkpoint['result'][LSC.REGEXES]['no_group'][LSC.TOTAL_HITS] += hits
+            store.put(os.path.abspath(log_file), checkpoint)
+
+        def _assert_bumped(results, expected, hits):
+            '''Checks results are expected, apart from the bumped no_group total'''
+            self.assertEqual(results[LSC.REGEXES]['no_group'][LSC.TOTAL_HITS],
+                             expected[LSC.REGEXES]['no_group'][LSC.TOTAL_HITS] + hits)
+            self.assertEqual(results[LSC.REGEXES]['group'], expected[LSC.REGEXES]['group'])
+
+        self.assertDictEqual(_scrape(), _scrape(incremental=False))
+
+        # The stored totals are added to, and a partial last line is left for later
+        _bump_stored_hits(100)
+        with open(log_file, 'a') as handle:
+            handle.write('My name is Judge.\nMy name is Fra')
+        _assert_bumped(_scrape(), _scrape(incremental=False), 100)
+        checkpoint = FileStore(checkpoint_dir).get(os.path.abspath(log_file))
+        self.assertEqual(checkpoint['offset'], len(LOG_FILE_2[1]) + len('My name is Judge.\n'))
+
+        with open(log_file, 'a') as handle:
+            handle.write('nklin.\n')
+        _assert_bumped(_scrape(), _scrape(incremental=False), 100)
+        self.assertDictEqual(_scrape(), _scrape())
+
+        # A truncated file is scanned again from the start
+        _write_file_from_pair((LOG_FILE_2[0], LOG_FILE_1[1]))
+        self.assertDictEqual(_scrape(), _scrape(incremental=False))
+
+        # So is one that's been replaced by something else of the same size or bigger
+        _bump_stored_hits(100)
+        _write_file_from_pair((LOG_FILE_2[0], LOG_FILE_2[1]))
+        self.assertDictEqual(_scrape(), _scrape(incremental=False))
+
+        # And everything is, if the regexes change
+        _bump_stored_hits(100)
+        _option_scraper = LogScraperWithOptions(user_params=user_params)
+        _option_scraper._optional_params[LSC.CHECKPOINT_PATH] = checkpoint_dir
+        self.assertEqual(_option_scraper._load_checkpoint(log_file)[2], len(LOG_FILE_2[1]))
+        _option_scraper.add_regex(name='weather', pattern=r'The weather is (?P<weather>\w+)')
+        _, result, start, _ = _option_scraper._load_checkpoint(log_file)
+        self.assertIsNone(result)
+        self.assertEqual(start, 0)
+
+    def test_time_window(self):
+        '''Time windows should only count the lines logged in them, seeking to them if indexed'''
+        log_file = os.path.join(LOG_DIR, 'log3.log')
+        start_time = datetime(2015, 3, 1, 10, 0, 0)
+        names = ['Judge', 'Franklin', 'Bob']
+        lines = []
+        for minute in xrange(100):
+            timestamp = (start_time + timedelta(minutes=minute)).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append((start_time + timedelta(minutes=minute),
+                          '{} My name is {}.\n'.format(timestamp, names[minute % 3])))
+            if minute % 10 == 0:
+                lines.append((start_time + timedelta(minutes=minute), 'My name is Trace.\n'))
+        contents = ''.join(line for _, line in lines)
+        with open(log_file, 'w') as handle:
+            handle.write(contents)
+        index_dir = os.path.join(LOG_DIR, 'timestamp_index')
+        os.mkdir(os.path.join(LOG_DIR, 'gzip_index'))
+
+        def _make_scraper(window, filename=log_file, indexed=True, chunk_size=0,
+                          scraper_class=LogScraper):
+            '''Creates a scraper over filename for the (start, end) window'''
+            _log_scraper = scraper_class(optional_params={
+                LSC.TIMESTAMP_REGEX : r'(?P<timestamp>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) ',
+                LSC.TIMESTAMP_FORMAT : '%Y-%m-%d %H:%M:%S',
+                LSC.TIMESTAMP_INDEX_PATH : index_dir if indexed else '',
+                LSC.TIMESTAMP_INDEX_SPACING : 7, LSC.CHUNK_SIZE : chunk_size,
+                LSC.GZIP_INDEX_PATH : os.path.join(LOG_DIR, 'gzip_index')},
+                                      user_params={LSC.FILENAME : filename,
+                                                   LSC.START_TIME : window[0],
+                                                   LSC.END_TIME : window[1]})
+            _log_scraper.add_regex(name='name', pattern=r'(?:\S+ \S+ )?My name is (?P<name>\w+)\.$')
+            return _log_scraper
+
+        def _expected(window):
+            '''Counts up the names logged in the window by brute force'''
+            counts = {}
+            for timestamp, line in lines:
+                if (window[0] is None or timestamp >= window[0]) \
+                        and (window[1] is None or timestamp < window[1]):
+                    name = line.split('My name is ')[1][:-2]
+                    counts[name] = counts.get(name, 0) + 1
+            return counts
+
+        windows = [(start_time + timedelta(minutes=30), start_time + timedelta(minutes=45)),
+                   (start_time + timedelta(minutes=95), None),
+                   (None, start_time + timedelta(minutes=5)),
+                   ('2015-03-01 10:59:30', '2015-03-01 11:03:00'),
+                   (start_time + timedelta(days=1), None)]
+        for window in windows:
+            expected = _expected([_make_scraper(window)._parse_timestamp(value)
+                                  for value in window])
+            for indexed, chunk_size in [(False, 0), (True, 0), (True, 200)]:
+                with _make_scraper(window, indexed=indexed, chunk_size=chunk_size) as _log_scraper:
+                    results = _log_scraper.get_log_data()
+                self.assertEqual(dict(results[LSC.REGEXES]['name'][LSC.GROUP_HITS]['name']),
+                                 expected)
+                self.assertEqual(results[LSC.REGEXES]['name'][LSC.TOTAL_HITS],
+                                 sum(expected.values()))
+            matches = _make_scraper(window).get_regex_matches()
+            self.assertEqual(len(matches[0][LSC.REGEXES]['name'][LSC.MATCHES]),
+                             sum(expected.values()))
+
+        # Overridden line reading isn't bypassed by the index
+        expected = _expected(windows[0])
+        del expected['Trace']
+        for indexed, chunk_size in [(False, 0), (True, 0), (True, 200)]:
+            with _make_scraper(windows[0], indexed=indexed, chunk_size=chunk_size,
+                               scraper_class=NoTraceScraper) as _log_scraper:
+                results = _log_scraper.get_log_data()
+            self.assertEqual(dict(results[LSC.REGEXES]['name'][LSC.GROUP_HITS]['name']), expected)
+
+        # Only the part of the file the window is in gets read
+        _log_scraper = _make_scraper(windows[0])
+        start, end = _log_scraper._get_time_range(log_file)
+        self.assertLessEqual(start, contents.index('2015-03-01 10:30:00'))
+        self.assertGreaterEqual(end, contents.index('2015-03-01 10:45:00'))
+        self.assertLess(end - start, len(contents) / 3)
+        index = _log_scraper._get_timestamp_index(log_file)
+        self.assertEqual(index.line_count, len(lines))
+        self.assertEqual(index.entries[:2], [(start_time, 0),
+                                             (start_time + timedelta(minutes=6),
+                                              contents.index('2015-03-01 10:06:00'))])
+
+        # The index is topped up as the file grows, ignoring a partial last line
+        with open(log_file, 'a') as handle:
+            handle.write('2015-03-01 11:40:00 My name is Judge.\n2015-03-01 11:41')
+        entries = index.entries
+        index = _log_scraper._get_timestamp_index(log_file)
+        self.assertEqual(index.line_count, len(lines) + 1)
+        self.assertEqual(index.end_offset, len(contents) + 38)
+        self.assertEqual(index.entries, entries)
+
+        # And rebuilt if the file is replaced
+        with open(log_file, 'w') as handle:
+            handle.write(contents[:contents.index('2015-03-01 10:50:00')])
+        self.assertEqual(_log_scraper._get_timestamp_index(log_file).line_count, 55)
+
+        # Gzipped files can be seeked into through their gzip index
+        zip_file = os.path.join(LOG_DIR, 'log4.log.gz')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(zip_file, 'wb') as handle:
+            for part in [contents[:1000], contents[1000:2000]]:
+                handle.write(compressor.compress(part) + compressor.flush(zlib.Z_FULL_FLUSH))
+            handle.write(compressor.compress(contents[2000:]) + compressor.flush())
+        window = windows[0]
+        with _make_scraper(window, filename=zip_file, chunk_size=300) as _log_scraper:
+            self.assertEqual(_log_scraper._get_time_range(zip_file), (start, end))
+            results = _log_scraper.get_log_data()
+        self.assertEqual(dict(results[LSC.REGEXES]['name'][LSC.GROUP_HITS]['name']),
+                         _expected(window))
+
+        # A time window needs a way to tell the time
+        _log_scraper = LogScraper(user_params={LSC.FILENAME : log_file,
+                                               LSC.START_TIME : start_time})
+        self.assertIsNone(_log_scraper.get_log_data())
+        _log_scraper = _make_scraper(('yesterday', None))
+        self.assertRaises(InvalidArgumentException, _log_scraper._validate_timestamps)
+
+    def test_time_buckets(self):
+        '''Bucketed regexes should count their hits per time bucket, across files and chunks'''
+        start_time = datetime(2015, 3, 1, 10, 0, 0)
+        names = ['Judge', 'Franklin', 'Bob']
+        expected = {}
+        for index, log_file in enumerate(['log3.log', 'log4.log']):
+            lines = []
+            for minute in xrange(index * 60, index * 60 + 150, 3):
+                timestamp = start_time + timedelta(minutes=minute)
+                name = names[minute % len(names)]
+                lines.append('{} My name is {}.\n'.format(timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                                                          name))
+                hour = timestamp.replace(minute=0)
+                expected.setdefault(name, {}).setdefault(hour, 0)
+                expected[name][hour] += 1
+            _write_file(log_file, ''.join(lines))
+
+        def _scrape(**optional_params):
+            '''Scrapes both files, bucketing the names by the hour'''
+            optional_params.update({LSC.TIMESTAMP_REGEX : r'(?P<timestamp>\S+ \S+) ',
+                                    LSC.TIMESTAMP_FORMAT : '%Y-%m-%d %H:%M:%S'})
+            with LogScraper(optional_params=optional_params,
+                            user_params={LSC.FILENAME : os.path.join(LOG_DIR, 'log[34].log')}) \
+                    as _log_scraper:
+                _log_scraper.add_regex(name='name', pattern=r'\S+ \S+ My name is (?P<name>\w+)',
+                                       bucket_size=3600)
+                return _log_scraper.get_log_data()
+
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 500}]:
+            results = _scrape(**optional_params)
+            bucket_hits = results[LSC.REGEXES]['name'][LSC.BUCKET_HITS]
+            self.assertEqual(bucket_hits['name'].to_dict(), expected)
+            self.assertEqual(bucket_hits[LSC.TOTAL_HITS].series(),
+                             [(start_time + timedelta(hours=hour),
+                               sum(hits.get(start_time + timedelta(hours=hour), 0)
+                                   for hits in expected.values()))
+                              for hour in xrange(4)])
+            # Each file's result keeps its own counts
+            self.assertEqual(sum(count for _, count in results[LSC.FILE_HITS][0][LSC.REGEXES]
+                                 ['name'][LSC.BUCKET_HITS][LSC.TOTAL_HITS].series()), 50)
+
+        # Each line's match is bucketed as it is, without running the regex again
+        _log_scraper = LogScraper(optional_params={LSC.TIMESTAMP_REGEX : r'(?P<timestamp>\S+ \S+) ',
+                                                   LSC.TIMESTAMP_FORMAT : '%Y-%m-%d %H:%M:%S'})
+        _log_scraper.add_regex(name='name', pattern=r'\S+ \S+ My name is (?P<name>\w+)',
+                               bucket_size=3600)
+        regex = _log_scraper._regexes[0]
+        matched = []
+        regex.match = lambda line: matched.append(line) or regex.get_matcher().match(line)
+        regex_hits = _log_scraper._new_file_hits(None)
+        _log_scraper._aggregate_lines(lines, regex_hits)
+        self.assertEqual(matched, lines)
+        bucket_hits = regex_hits[LSC.REGEXES]['name'][LSC.BUCKET_HITS]
+        self.assertEqual(sum(count for _, count in bucket_hits[LSC.TOTAL_HITS].series()), 50)
+        self.assertEqual(sum(sum(hits.values()) for hits in bucket_hits['name'].to_dict().values()),
+                         50)
+
+        # Cached results for bucketed regexes go stale when timestamps are read differently
+        fingerprints = []
+        for bucket_size in [None, 3600]:
+            for timestamp_format in ['%Y-%m-%d %H:%M:%S', '%Y%m%d %H%M%S']:
+                _log_scraper = LogScraper(optional_params={
+                    LSC.TIMESTAMP_REGEX : r'(?P<timestamp>\S+ \S+) ',
+                    LSC.TIMESTAMP_FORMAT : timestamp_format})
+                _log_scraper.add_regex(name='name', pattern='My name', bucket_size=bucket_size)
+                fingerprints.append(_log_scraper._regex_fingerprint())
+        self.assertEqual(len(set(fingerprints)), 3)
+        self.assertEqual(fingerprints[0], fingerprints[1])
+
+        # Bucketing needs timestamps that can be turned into times
+        _log_scraper = LogScraper(optional_params={LSC.TIMESTAMP_REGEX : r'\S+ \S+ '})
+        _log_scraper.add_regex(name='name', pattern='My name', bucket_size=60)
+        self.assertRaises(InvalidArgumentException, _log_scraper._validate_timestamps)
+
+        # Aggregators can't be made without everything they need to be merged
+        self.assertRaises(TypeError,
+                          type('Unmergeable', (Aggregator,), {'empty' : lambda self: None}))
+
+        # Counters grow either way, and merge over different ranges and values
+        counter = BucketedCounter(60)
+        counter.add(600, 'a')
+        counter.add(725, 'b', 2)
+        counter.add(480, 'a')
+        self.assertEqual(counter.origin, 8)
+        self.assertEqual(list(counter.counts[0]), [1, 0, 1, 0, 0])
+        self.assertEqual(list(counter.counts[1]), [0, 0, 0, 0, 2])
+        other = BucketedCounter(60)
+        other.add(datetime(1970, 1, 1, 0, 15), 'c')
+        other.add(datetime(1970, 1, 1, 0, 9), 'a')
+        merged = counter.copy()
+        merged += other
+        self.assertEqual(list(counter.counts[0]), [1, 0, 1, 0, 0])
+        self.assertEqual(merged.to_dict(), {'a' : {datetime(1970, 1, 1, 0, 8) : 1,
+                                                   datetime(1970, 1, 1, 0, 9) : 1,
+                                                   datetime(1970, 1, 1, 0, 10) : 1},
+                                            'b' : {datetime(1970, 1, 1, 0, 12) : 2},
+                                            'c' : {datetime(1970, 1, 1, 0, 15) : 1}})
+        self.assertEqual(len(merged.series('c')), 8)
+        self.assertEqual(merged.series('missing')[0], (datetime(1970, 1, 1, 0, 8), 0))
+        with self.assertRaises(ValueError):
+            merged += BucketedCounter(3600)
+
+    def test_numeric_groups(self):
+        '''Numeric groups should be summarized with quantiles across files and chunks'''
+        latencies = [(index * 7919) % 1000 + index % 3 for index in xrange(3000)]
+        for index, log_file in enumerate(['log3.log', 'log4.log']):
+            _write_file(log_file, ''.join('GET /page latency={}\nGET /page latency=n/a\n'.format(latency)
+                                          for latency in latencies[index::2]))
+
+        def _scrape(**optional_params):
+            '''Scrapes both files for latencies'''
+            with LogScraper(optional_params=optional_params,
+                            user_params={LSC.FILENAME : os.path.join(LOG_DIR, 'log[34].log')}) \
+                    as _log_scraper:
+                _log_scraper.add_regex(name='latency', pattern=r'GET \S+ latency=(?P<latency_ms>\S+)',
+                                       group_aggregators={'latency_ms' : QuantileSketch(0.01)})
+                return _log_scraper.get_log_data()
+
+        ordered = sorted(latencies)
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 5000}, {LSC.USE_MMAP : True}]:
+            results = _scrape(**optional_params)
+            self.assertEqual(results[LSC.REGEXES]['latency'][LSC.TOTAL_HITS], 6000)
+            sketch = results[LSC.REGEXES]['latency'][LSC.GROUP_HITS]['latency_ms']
+            self.assertEqual((sketch.count, sketch.invalid, sketch.sum, sketch.min, sketch.max),
+                             (3000, 3000, sum(latencies), min(latencies), max(latencies)))
+            for quantile in [0.01, 0.5, 0.95, 0.99]:
+                exact = ordered[int(quantile * (len(ordered) - 1))]
+                self.assertLessEqual(abs(sketch.quantile(quantile) - exact), exact * 0.01)
+            self.assertEqual(results[LSC.FILE_HITS][0][LSC.REGEXES]['latency'][LSC.GROUP_HITS]
+                             ['latency_ms'].count, 1500)
+
+        out = StringIO()
+        _log_scraper = LogScraper(user_params={LSC.DEBUG : True})
+        _log_scraper.print_total_stats(results, out=out)
+        self.assertIn('Latency Latency_ms: count: 3000', out.getvalue())
+
+        # Negative numbers and zeros, and memory capped by collapsing the smallest bins
+        sketch = QuantileSketch(0.05, max_bins=20)
+        for value in range(-100, 101) + ['1e6']:
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0), -100)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.quantile(1), 1e6)
+        self.assertLessEqual(len(sketch.positive), 20)
+        self.assertLessEqual(abs(sketch.quantile(0.1) + 80), 80 * 0.05)
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+        with self.assertRaises(ValueError):
+            sketch += QuantileSketch()
+        self.assertRaises(BadRegexException, RegexObject, name='latency', pattern=r'(?P<ms>\d+)',
+                          group_aggregators={'latency_ms' : QuantileSketch()})
+
+    def test_top_k_groups(self):
+        '''Top-k counts should find the most common values within their error bounds'''
+        # 20 heavy users, and a long tail of 2000 users seen once or twice
+        users = ['heavy{}'.format(index) for index in xrange(20) for _ in xrange(100 + index * 10)]
+        users += ['user{}'.format(index) for index in xrange(2000) for _ in xrange(1 + index % 2)]
+        random.Random(5).shuffle(users)
+        for index, log_file in enumerate(['log3.log', 'log4.log']):
+            _write_file(log_file, ''.join('login user={}\n'.format(user) for user in users[index::2]))
+        exact = {}
+        for user in users:
+            exact[user] = exact.get(user, 0) + 1
+        heavy = sorted(exact, key=exact.get, reverse=True)[:10]
+
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 5000}]:
+            with LogScraper(optional_params=optional_params,
+                            user_params={LSC.FILENAME : os.path.join(LOG_DIR, 'log[34].log')}) \
+                    as _log_scraper:
+                _log_scraper.add_regex(name='login', pattern=r'login user=(?P<user>\S+)',
+                                       group_aggregators={'user' : TopK(10, capacity=100)})
+                results = _log_scraper.get_log_data()
+            top_k = results[LSC.REGEXES]['login'][LSC.GROUP_HITS]['user']
+            self.assertEqual(top_k.total, len(users))
+            self.assertLessEqual(len(top_k.counts), 100)
+            top = top_k.top()
+            self.assertEqual([user for user, _, _ in top], heavy)
+            for user, count, error in top:
+                self.assertLessEqual(error, len(users) / 100)
+                self.assertTrue(count - error <= exact[user] <= count)
+
+        # Small enough to count exactly, and merged the same way
+        top_k = TopK(2, capacity=4)
+        for user in 'aaabbc':
+            top_k.add(user)
+        other = top_k.empty()
+        for user in 'ccccd':
+            other.add(user)
+        top_k += other
+        self.assertEqual(top_k.top(), [('c', 5, 0), ('a', 3, 0)])
+        with self.assertRaises(ValueError):
+            top_k += TopK(3)
+
+    def test_distinct_groups(self):
+        '''Distinct counts should be estimated closely, and merged across files and chunks'''
+        # 20000 users, some of them in both files
+        for index, log_file in enumerate(['log3.log', 'log4.log']):
+            _write_file(log_file, ''.join('login user=user{}\n'.format(user)
+                                          for user in xrange(index * 8000, index * 8000 + 12000)))
+
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 50000}]:
+            with LogScraper(optional_params=optional_params,
+                            user_params={LSC.FILENAME : os.path.join(LOG_DIR, 'log[34].log')}) \
+                    as _log_scraper:
+                _log_scraper.add_regex(name='login', pattern=r'login user=(?P<user>\S+)',
+                                       group_aggregators={'user' : DistinctCount(12)})
+                results = _log_scraper.get_log_data()
+            distinct = results[LSC.REGEXES]['login'][LSC.GROUP_HITS]['user']
+            self.assertEqual(results[LSC.REGEXES]['login'][LSC.TOTAL_HITS], 24000)
+            self.assertEqual(distinct.total, 24000)
+            self.assertLessEqual(abs(distinct.estimate() - 20000), 20000 * 0.05)
+            self.assertLessEqual(abs(results[LSC.FILE_HITS][0][LSC.REGEXES]['login']
+                                     [LSC.GROUP_HITS]['user'].estimate() - 12000), 12000 * 0.05)
+
+        # Small counts are close to exact, and repeats don't count
+        distinct = DistinctCount()
+        for user in range(50) * 3:
+            distinct.add(user)
+        self.assertLessEqual(abs(distinct.estimate() - 50), 1)
+        self.assertEqual(DistinctCount(4).estimate(), 0)
+
+        # Missing values aren't a value of their own
+        other = DistinctCount()
+        for user in [None, 'None', None]:
+            other.add(user)
+        self.assertEqual((other.total, other.invalid, other.estimate()), (1, 2, 1))
+        distinct += other
+        self.assertEqual((distinct.total, distinct.invalid), (151, 2))
+        with self.assertRaises(ValueError):
+            distinct += DistinctCount(10)
+        self.assertRaises(ValueError, DistinctCount, 20)
+
+    def test_instrumentation(self):
+        '''Instrumented runs should report what was read and run on each file, and emit it'''
+        plain_lines = ['GET /a user={}\n'.format(index % 7) for index in xrange(500)]
+        gzipped_lines = ['POST /b user={}\n'.format(index % 5) for index in xrange(300)]
+        _write_file('log3.log', ''.join(plain_lines))
+        with gzip.open(os.path.join(LOG_DIR, 'log4.log'), 'wb') as handle:
+            handle.write(''.join(gzipped_lines))
+        sizes = {'log3.log' : len(''.join(plain_lines)), 'log4.log' : len(''.join(gzipped_lines))}
+        line_counts = {'log3.log' : 500, 'log4.log' : 300}
+        user_params = {LSC.FILENAME : os.path.join(LOG_DIR, 'log[34].log')}
+
+        def _scrape(**optional_params):
+            '''Scrapes both files with instrumentation on'''
+            optional_params[LSC.INSTRUMENT] = True
+            _log_scraper = MetricsCollectingScraper(optional_params=optional_params,
+                                                    user_params=user_params)
+            with _log_scraper:
+                _log_scraper.add_regex(name='get', pattern=r'GET (?P<path>\S+)')
+                _log_scraper.add_regex(name='user', pattern=r'\S+ \S+ user=(?P<user>\d+)')
+                return _log_scraper, _log_scraper.get_log_data()
+
+        for optional_params in [{}, {LSC.CHUNK_SIZE : 2000}, {LSC.USE_MMAP : True}]:
+            _log_scraper, results = _scrape(**optional_params)
+            metrics = results[LSC.METRICS]
+            self.assertEqual(_log_scraper.emitted, [metrics])
+            self.assertIs(_log_scraper.get_metrics(), metrics)
+            self.assertEqual(sorted(metrics[LSC.FILE_HITS]),
+                             sorted(os.path.join(LOG_DIR, name) for name in sizes))
+            for filename, file_metrics in metrics[LSC.FILE_HITS].items():
+                name = os.path.basename(filename)
+                self.assertEqual((file_metrics[LSC.LINES_READ], file_metrics[LSC.BYTES_READ]),
+                                 (line_counts[name], sizes[name]))
+                self.assertGreater(file_metrics[LSC.WALL_TIME], 0)
+                self.assertEqual(file_metrics[LSC.DECOMPRESS_TIME] > 0, name == 'log4.log')
+                if name == 'log4.log':
+                    self.assertLess(file_metrics[LSC.DECOMPRESS_TIME],
+                                    file_metrics[LSC.READ_TIME])
+            for regex_name, total_hits in [('get', 500), ('user', 800)]:
+                regex_metrics = metrics[LSC.REGEXES][regex_name]
+                self.assertEqual(regex_metrics[LSC.TOTAL_HITS], total_hits)
+                self.assertEqual(results[LSC.REGEXES][regex_name][LSC.TOTAL_HITS], total_hits)
+                self.assertGreaterEqual(regex_metrics[LSC.EVALUATIONS], total_hits)
+                self.assertLessEqual(regex_metrics[LSC.EVALUATIONS], 800)
+                self.assertGreater(regex_metrics[LSC.MATCH_TIME], 0)
+            self.assertGreater(metrics[LSC.WALL_TIME], 0)
+            self.assertGreaterEqual(metrics[LSC.MERGE_TIME], 0)
+            self.assertGreaterEqual(metrics[LSC.COPY_TIME], 0)
+
+        # Only the time spent decompressing counts as such, not the time spent reading
+        for optional_params in [{LSC.INSTRUMENT : True},
+                                {LSC.INSTRUMENT : True, LSC.CHUNK_SIZE : 2000}]:
+            _log_scraper = SlowDiskScraper(optional_params=optional_params,
+                                           user_params={LSC.FILENAME :
+                                                        os.path.join(LOG_DIR, 'log4.log')})
+            with _log_scraper:
+                _log_scraper.add_regex(name='get', pattern=r'GET (?P<path>\S+)')
+                _log_scraper.get_log_data()
+            for file_metrics in _log_scraper.emitted[0][LSC.FILE_HITS].values():
+                self.assertGreater(file_metrics[LSC.DECOMPRESS_TIME], 0)
+                self.assertGreaterEqual(file_metrics[LSC.READ_TIME]
+                                        - file_metrics[LSC.DECOMPRESS_TIME], 0.05)
+
+        # File handles can still be opened straight off the class
+        for name, lines in [('log3.log', plain_lines), ('log4.log', gzipped_lines)]:
+            with LogScraper._get_file_handle(os.path.join(LOG_DIR, name)) as handle:
+                self.assertEqual(handle.read(), ''.join(lines))
+
+        # Matches get the same per-file metrics
+        _log_scraper = MetricsCollectingScraper(optional_params={LSC.INSTRUMENT : True},
+                                                user_params=user_params)
+        with _log_scraper:
+            _log_scraper.add_regex(name='get', pattern=r'GET (?P<path>\S+)')
+            matches = _log_scraper.get_regex_matches()
+        self.assertEqual(sorted((os.path.basename(result[LSC.FILENAME]),
+                                 result[LSC.METRICS][LSC.LINES_READ],
+                                 result[LSC.METRICS][LSC.REGEXES]['get'][LSC.TOTAL_HITS])
+                                for result in matches),
+                         [('log3.log', 500, 500), ('log4.log', 300, 0)])
+        self.assertEqual(len(_log_scraper.emitted[0][LSC.FILE_HITS]), 2)
+
+        # Nothing is timed unless asked for
+        with LogScraper(user_params=user_params) as _log_scraper:
+            _log_scraper.add_regex(name='get', pattern=r'GET (?P<path>\S+)')
+            results = _log_scraper.get_log_data()
+            self.assertNotIn(LSC.METRICS, results)
+            self.assertNotIn(LSC.METRICS, results[LSC.FILE_HITS][0])
+            self.assertIsNone(_log_scraper.get_metrics())
+
+    def test_result_cache(self):
+        '''Results for archived files should be cached until the files or the regexes change'''
+        user_params = {LSC.DATE : '20150301'}
+        cache_dir = os.path.join(LOG_DIR, 'result_cache')
+        expected = LogScraperWithOptions(user_params=user_params).get_log_data()
+
+        def _scrape():
+            '''Scrapes the archived files through the cache'''
+            with LogScraperWithOptions(user_params=user_params) as _option_scraper:
+                _option_scraper._optional_params[LSC.RESULT_CACHE_PATH] = cache_dir
+                return _option_scraper.get_log_data()
+
+        self.assertDictEqual(_scrape(), expected)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        # Answered from the cache, as long as the file hasn't changed
+        archived_file = os.path.join(LOG_DIR, ARCHIVE_DIR, 'log1-20150301.log')
+        _option_scraper = LogScraperWithOptions(user_params=user_params)
+        _option_scraper._optional_params[LSC.RESULT_CACHE_PATH] = cache_dir
+        cache_key = _option_scraper._get_result_cache_key(archived_file)
+        cache = FileStore(cache_dir)
+        result = cache.get(cache_key)
+        result[LSC.REGEXES]['no_group'][LSC.TOTAL_HITS] = 100
+        cache.put(cache_key, result)
+        self.assertEqual(_scrape()[LSC.REGEXES]['no_group'][LSC.TOTAL_HITS], 101)
+
+        os.utime(archived_file, (time.time(), time.time() + 10))
+        self.assertDictEqual(_scrape(), expected)
+        _option_scraper.add_regex(name='weather', pattern=r'The weather')
+        self.assertNotEqual(_option_scraper._get_result_cache_key(archived_file), cache_key)
+
+        # Results cached under one path to a file are reported under the path asked for
+        _write_file_from_pair((LOG_FILE_1[0].split('.')[0] + '-20150303.log', LOG_FILE_2[1]),
+                              os.path.join(LOG_DIR, ARCHIVE_DIR))
+        range_params = {LSC.DATE : '20150301', LSC.END_DATE : '20150303'}
+        archive_path = os.path.join(LOG_DIR, ARCHIVE_DIR)
+        for path in [archive_path, os.path.abspath(archive_path)]:
+            with ArchivePathScraper(range_params, path) as _range_scraper:
+                _range_scraper._optional_params[LSC.RESULT_CACHE_PATH] = cache_dir
+                results = _range_scraper.get_log_data()
+                file_list = _range_scraper._file_list
+            self.assertEqual(results[LSC.DAY_HITS].keys(), ['20150301', '20150303'])
+            self.assertEqual([result[LSC.FILENAME] for result in results[LSC.FILE_HITS]],
+                             file_list)
+        self.assertTrue(all(os.path.isabs(filename) for filename in file_list))
+
+        # Files that aren't archived are never cached
+        self.assertIsNone(_option_scraper._get_result_cache_key(
+            os.path.join(LOG_DIR, LOG_FILE_1[0])))
+
+        # The least recently used entries are evicted to stay under the size cap
+        cache = FileStore(os.path.join(LOG_DIR, 'lru'), max_size=2500)
+        for age, key in [(30, 'a'), (20, 'b'), (10, 'c')]:
+            cache.put(key, 'x' * 1000)
+            os.utime(cache._path(key), (time.time() - age, time.time() - age))
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        cache.put('d', 'x' * 1000)
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNone(cache.get('c'))
+
     def test_printing(self):
         '''Test the functions that print stuff out'''
         _log_scraper = LogScraper()